@@ -0,0 +1,141 @@
+"""
+Persisted registry of the EB alignment offsets found for the continuum in
+step2_phase_alignment.py, read back by step4_detour.py (and anyone else) to
+shift the line MSs, instead of copying the offsets around by hand.
+Written for the AB Aur program
+Author: J. Speedie
+
+The registry is a small json file, keyed by EB, e.g.
+    {"LB_EB2": {"ms": "workflow/step1/ABAur_LB_EB2_initcont_selfcal.ms",
+                "checksum": "...",          # of the MS the offset was measured on
+                "offset": [-0.019783, 0.0046808],   # [dRA, dDec] arcsec, as for align_offsets
+                "uncertainty": [1.2e-4, 1.1e-4],    # arcsec, or null
+                "reference": "workflow/step1/ABAur_LB_EB1_initcont_selfcal.ms",
+                "date": "2023-07-24 16:03:11"}, ...}
+An entry is stale when the MS it was measured on has changed since (its checksum
+differs), so alignment only needs to be re-derived when its input actually changed.
+"""
+import os
+import json
+import time
+import hashlib
+
+
+def _is_table_data_file(filename):
+    """ The files of a casacore table that hold its contents: table.dat and the storage managers' table.f*. """
+    return (filename=='table.dat') or filename.startswith('table.f')
+
+
+def ms_checksum(msfile, content=False):
+    """
+    Cheap checksum of a measurement set (or any casacore table): md5 of the relative
+    path, size and modification time of the files holding its contents (table.dat and
+    table.f*, of the main table and the subtables), not of the GBs of data themselves.
+    Lock files (table.lock) and the like are left out: merely opening a table can
+    rewrite them, without the table changing.
+
+    Args:
+        msfile (string): Name of the measurement set (or table)
+        content (bool): Hash the contents of those files instead of their sizes and
+            mtimes; only sensible for small tables, e.g. caltables
+    Returns:
+        checksum (string)
+    """
+    md5 = hashlib.md5()
+    for root, dirs, files in sorted(os.walk(msfile)):
+        dirs.sort()
+        for f in sorted(files):
+            if not _is_table_data_file(f):
+                continue
+            path = os.path.join(root, f)
+            md5.update(os.path.relpath(path, msfile).encode())
+            if content:
+                with open(path, 'rb') as data:
+                    for block in iter(lambda: data.read(2**20), b''):
+                        md5.update(block)
+            else:
+                md5.update((' %d %.6f\n' % (os.path.getsize(path), os.path.getmtime(path))).encode())
+    return md5.hexdigest()
+
+
+def load_registry(registry):
+    """ Reads the registry (a json file); an empty one if it doesn't exist yet. """
+    if not os.path.exists(registry):
+        return {}
+    with open(registry, 'r') as f:
+        return json.load(f)
+
+
+def record_offset(registry, EB, msfile, offset, reference, uncertainty=None):
+    """
+    Stores the alignment offset of an EB in the registry.
+
+    Args:
+        registry (string): Name of the json file
+        EB (string): Key of the EB in data_dict, e.g. 'LB_EB2'
+        msfile (string): The (continuum) MS the offset was measured on
+        offset (list): [dRA, dDec] in arcsec, as passed to alignment.align_measurement_sets(align_offsets=...)
+        reference (string): The MS the EB was aligned to
+        uncertainty (list): [dRA, dDec] 1 sigma uncertainties in arcsec, if known
+    """
+    entries = load_registry(registry)
+    entries[EB] = {'ms': os.path.abspath(msfile), # so the entry can be checked from any directory
+                   'checksum': ms_checksum(msfile),
+                   'offset': [float(x) for x in offset],
+                   'uncertainty': None if uncertainty is None else [float(x) for x in uncertainty],
+                   'reference': os.path.abspath(reference),
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    # write to a temporary file first, so an interrupted run can't leave a broken registry behind
+    tmpfile = registry+'.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(entries, f, indent=4, sort_keys=True)
+    os.replace(tmpfile, registry)
+    print("Recorded alignment offset of %s: %s (in %s)" % (EB, entries[EB]['offset'], registry))
+
+
+def is_stale(registry, EB, msfile=None):
+    """
+    Whether the offset of an EB needs to be (re-)derived: there is no entry for it,
+    the entry was measured on another MS than msfile, or that MS has changed since
+    (or can't be found any more, so it can't be checked).
+
+    Args:
+        registry (string): Name of the json file
+        EB (string): Key of the EB in data_dict, e.g. 'LB_EB2'
+        msfile (string): The MS the offset should have been measured on. Default: the recorded one
+    """
+    entries = load_registry(registry)
+    if EB not in entries:
+        return True
+    entry = entries[EB]
+    if (msfile is not None) and (os.path.abspath(msfile)!=os.path.abspath(entry['ms'])):
+        return True
+    if not os.path.exists(entry['ms']):
+        print('Warning: cannot find '+entry['ms']+', on which the alignment offset of '+EB+' was measured; treating it as stale')
+        return True
+    return ms_checksum(entry['ms'])!=entry['checksum']
+
+
+def get_offsets(registry, EBs, allow_stale=False):
+    """
+    Reads the alignment offsets of several EBs, e.g. to pass to
+    alignment.align_measurement_sets(align_offsets=...).
+
+    Args:
+        registry (string): Name of the json file
+        EBs (list): Keys of the EBs in data_dict, e.g. data_dict['LB_EBs']
+        allow_stale (bool): If False (default), raise an error if any entry is missing or stale
+    Returns:
+        offsets (list): List of [dRA, dDec] (arcsec), in the order of EBs
+    """
+    entries = load_registry(registry)
+    offsets = []
+    for EB in EBs:
+        if EB not in entries:
+            raise ValueError('There is no alignment offset for '+EB+' in '+registry+'; run step2_phase_alignment.py first')
+        if is_stale(registry, EB) and not allow_stale:
+            raise RuntimeError('The alignment offset of '+EB+' in '+registry+' is stale: '+entries[EB]['ms']+
+                               ' changed since, or is gone. Re-run step2_phase_alignment.py (or pass allow_stale=True)')
+        offsets.append(entries[EB]['offset'])
+    return offsets
@@ -0,0 +1,128 @@
+"""
+Non-interactive clean masks and stopping thresholds for tclean_wrapper, so that
+the self-cal rounds (and the initial models of step1) can run unattended.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+Two methods, chosen by automask['method'] (see mask_dict['continuum automask']):
+    'threshold'         the mask is where the previous image (e.g. contp2.image, when
+                        making contp3) is above nsigma_mask times its rms in the noise
+                        annulus, dilated by dilate_beams beams and cut to the user mask
+                        region. Cleaning stops at nsigma_stop times that same rms.
+    'auto-multithresh'  tclean's own automasking, with the parameters saved in automask;
+                        cleaning stops at nsigma_stop times tclean's own (robust) rms.
+Without a previous image (the first image of an MS), 'threshold' falls back on
+'auto-multithresh'.
+"""
+import numpy as np
+import casatools
+from image_metrics import read_image, measure_image
+from region_masks import rasterize_region, _direction_axes
+
+ia = casatools.image()
+
+# the tclean parameters of auto-multithresh, copied from automask if present
+AUTOMULTITHRESH_KEYS = ['sidelobethreshold', 'noisethreshold', 'lownoisethreshold', 'negativethreshold',
+                        'minbeamfrac', 'growiterations', 'dogrowprune', 'minpercentchange', 'fastnoise']
+
+
+def _image_name(imagename):
+    """ The CASA image of a tclean imagename (e.g. 'contp2' -> 'contp2.image'). """
+    return imagename if imagename.endswith(('.image', '.fits')) else imagename+'.image'
+
+
+def _dilate(mask, radius):
+    """ Binary dilation of a 2D mask by a disk of radius pixels, as an FFT convolution. """
+    shape  = [n + 2*radius + 1 for n in mask.shape] # padded, so the convolution doesn't wrap around
+    yy, xx = np.mgrid[-radius:radius+1, -radius:radius+1]
+    disk   = (xx**2 + yy**2 <= radius**2).astype('float64')
+    conv   = np.fft.irfft2(np.fft.rfft2(mask.astype('float64'), shape)*np.fft.rfft2(disk, shape), shape)
+    return conv[radius:radius+mask.shape[0], radius:radius+mask.shape[1]] > 0.5
+
+
+def noise_threshold(previous_image, noise_mask, nsigma=3.):
+    """
+    A tclean threshold of nsigma times the rms of an image in the noise annulus.
+
+    Args:
+        previous_image (string): tclean imagename (or CASA image) to measure the rms on
+        noise_mask (string): Annulus to measure image rms, in the CASA region format
+        nsigma (float): Threshold in units of the rms
+    Returns:
+        threshold (string): e.g. '0.0612mJy'
+    """
+    rms = measure_image(_image_name(previous_image), noise_mask=noise_mask)['rms']
+    return '%.4fmJy' % (nsigma*rms*1.e3)
+
+
+def threshold_mask(previous_image, outfile, noise_mask, nsigma=5., dilate_beams=1., region='', overwrite=True):
+    """
+    Writes a clean mask from the previous image: the pixels above nsigma times its
+    rms, grown by dilate_beams beams (FWHM of the major axis), inside region.
+
+    Args:
+        previous_image (string): tclean imagename (or CASA image) to threshold
+        outfile (string): Name of the mask image, to pass to tclean as mask=outfile
+        noise_mask (string): Annulus to measure image rms, in the CASA region format
+        nsigma (float): Mask threshold in units of the rms
+        dilate_beams (float): Radius of the dilation, in units of the beam major axis
+        region (string): CASA circle or annulus region the mask is limited to ('' for none)
+        overwrite (bool): Whether to overwrite an existing outfile
+    Returns:
+        outfile (string): Name of the mask image
+    """
+    imagename = _image_name(previous_image)
+    image = read_image(imagename)
+    rms   = measure_image(imagename, noise_mask=noise_mask)['rms']
+    data  = image['data']
+    mask  = image['good'] & (data > nsigma*rms)
+
+    if (dilate_beams > 0) and (image['beam'] is not None):
+        cdelt  = np.abs(_direction_axes(image['csys'])[2][0])*180./np.pi*3600. # arcsec per pixel
+        radius = max(int(np.ceil(dilate_beams*image['beam'][0]/cdelt)), 1)
+        mask   = _dilate(mask, radius)
+    if region!='':
+        mask &= rasterize_region(region, data.shape, image['csys'])
+
+    print("Mask from %s > %.1f sigma, dilated by %.1f beams: %d pixels" % (imagename, nsigma, dilate_beams, np.sum(mask)))
+
+    ia.open(imagename)
+    shape = ia.shape()
+    ia.close()
+    mask = np.broadcast_to(mask.astype('float32').reshape(tuple(shape[:2])+(1,)*(len(shape)-2)), tuple(shape))
+    ia.fromarray(outfile=outfile, pixels=np.ascontiguousarray(mask), csys=image['csys'], overwrite=overwrite)
+    ia.close()
+    print("Mask written to: "+outfile)
+    return outfile
+
+
+def automask_tclean_args(imagename, automask, mask='', previous_image=None, noise_mask=''):
+    """
+    The tclean arguments (mask, usemask, threshold, nsigma, ...) for a non-interactive clean.
+
+    Args:
+        imagename (string): imagename of the tclean call to be made
+        automask (dictionary): Method and parameters, e.g. mask_dict['continuum automask']
+        mask (string): User mask region; the 'threshold' mask is limited to it
+        previous_image (string): tclean imagename of the previous image of these data, if any
+        noise_mask (string): Annulus to measure image rms, in the CASA region format
+    Returns:
+        args (dictionary): Keyword arguments for tclean
+    """
+    method = automask.get('method', 'threshold')
+    if method not in ['threshold', 'auto-multithresh']:
+        raise ValueError("automask['method'] must be 'threshold' or 'auto-multithresh'")
+
+    if (method=='threshold') and (previous_image is not None):
+        if noise_mask=='':
+            raise ValueError('You need to specify a noise_mask to derive a mask from the previous image')
+        maskname = threshold_mask(previous_image, imagename+'.automask', noise_mask,
+                                  nsigma       = automask.get('nsigma_mask', 5.),
+                                  dilate_beams = automask.get('dilate_beams', 1.),
+                                  region       = mask)
+        return {'usemask': 'user', 'mask': maskname, 'nsigma': 0.,
+                'threshold': noise_threshold(previous_image, noise_mask, automask.get('nsigma_stop', 3.))}
+
+    args = {'usemask': 'auto-multithresh', 'mask': '', 'threshold': '0mJy', 'nsigma': automask.get('nsigma_stop', 3.)}
+    args.update({key: automask[key] for key in AUTOMULTITHRESH_KEYS if key in automask})
+    return args
@@ -0,0 +1,182 @@
+"""
+Runs independent pieces of a step (one per EB, say) concurrently, each in its own
+CASA process with its own log, instead of one after another in the session.
+Written for CASA 6 (monolithic CASA, for the casa executable) and the AB Aur program
+Author: J. Speedie
+
+A job is a bit of CASA code (a string), plus the code that sets up its namespace
+(typically the execfile's at the top of the step script), e.g.
+    job = casa_job(name    = 'LB_EB1_avg_cont',
+                   code    = "avg_cont(msfile=..., outputvis=..., ...)",
+                   setup   = "execfile('dictionary_data.py')\nexecfile('step1_utils.py')",
+                   mem_gb  = 12.)
+    results = run_casa_jobs([job, ...], logdir='./workflow/step1/jobs/')
+Each job is written to a script in logdir and run as
+    casa --nogui --nologger --agg --logfile logdir/<name>.casa.log -c logdir/<name>.py
+(stdout and stderr go to logdir/<name>.out). The setup runs in the directory
+run_casa_jobs was called from, so relative execfile's work; the job itself runs
+in its workdir (default: the same), which is where its *.last files end up; relative
+paths in the code then need os.path.join(launch_dir, ...) (launch_dir is set for it).
+check_casa_jobs(results) raises if any job failed, so the next stage doesn't start on
+missing or partial data.
+
+How many jobs run at once is capped three ways: max_jobs, the memory available
+when the jobs start (each job declares mem_gb), and max_io_jobs for the jobs that
+mostly read and write measurement sets (io=True), as lustre slows down for
+everyone beyond a few of those. A job that fails (raises, or doesn't write the
+outputs it declares) is retried up to retries times; the other jobs carry on.
+"""
+import os
+import time
+import subprocess
+
+
+def casa_job(name, code, setup='', workdir=None, mem_gb=4., io=True, outputs=None):
+    """
+    Describes a job for run_casa_jobs.
+
+    Args:
+        name (string): Unique name of the job, used for its script and logs
+        code (string): CASA (python) code to run
+        setup (string): Code to run first, in the launch directory (execfile's, imports)
+        workdir (string): Directory to run code in (created if needed). Default: the launch directory
+        mem_gb (float): Peak memory the job needs, in GB
+        io (bool): Whether the job is I/O-bound (reads/writes whole measurement sets)
+        outputs (list): Files or directories the job must produce to count as successful
+    Returns:
+        job (dictionary)
+    """
+    return {'name': name, 'code': code, 'setup': setup, 'workdir': workdir,
+            'mem_gb': float(mem_gb), 'io': bool(io), 'outputs': [] if outputs is None else list(outputs)}
+
+
+_job_template = '''import os, sys, traceback
+launch_dir = {launch_dir!r}
+os.chdir(launch_dir)
+try:
+    exec(compile({setup!r}, {name!r}+' (setup)', 'exec'))
+    os.makedirs({workdir!r}, exist_ok=True)
+    os.chdir({workdir!r})
+    exec(compile({code!r}, {name!r}, 'exec'))
+except BaseException:
+    traceback.print_exc()
+    sys.stdout.flush()
+    os._exit(1)
+open({donefile!r}, 'w').close()
+'''
+
+
+def available_memory_gb():
+    """ Memory available for new processes (MemAvailable of /proc/meminfo), in GB. """
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return float(line.split()[1])/1024.**2 # kB -> GB
+    raise ValueError('Cannot find MemAvailable in /proc/meminfo')
+
+
+def _start(job, attempt, logdir, casa):
+    """ Writes the script of a job and starts its CASA process. """
+    base     = os.path.join(logdir, job['name'])
+    script   = base+'.py'
+    donefile = base+'.done'
+    if os.path.exists(donefile):
+        os.remove(donefile)
+    with open(script, 'w') as f:
+        f.write(_job_template.format(launch_dir=os.getcwd(), setup=job['setup'], name=job['name'],
+                                     workdir=os.path.abspath(job['workdir'] or os.getcwd()),
+                                     code=job['code'], donefile=os.path.abspath(donefile)))
+    logfile = base+'.casa.log' if attempt==1 else base+'.attempt%d.casa.log' % attempt
+    outfile = base+'.out' if attempt==1 else base+'.attempt%d.out' % attempt
+    out     = open(outfile, 'w')
+    proc    = subprocess.Popen([casa, '--nogui', '--nologger', '--agg', '--logfile', os.path.abspath(logfile),
+                                '-c', os.path.abspath(script)], stdout=out, stderr=subprocess.STDOUT)
+    print("Started %s (attempt %d, pid %d); log: %s" % (job['name'], attempt, proc.pid, logfile))
+    return {'job': job, 'proc': proc, 'out': out, 'attempt': attempt, 'start': time.time(),
+            'donefile': donefile, 'log': logfile}
+
+
+def run_casa_jobs(jobs, logdir, max_jobs=None, mem_fraction=0.8, max_io_jobs=2, retries=1,
+                  casa='casa', poll=5., on_finish=None):
+    """
+    Runs jobs (see casa_job) concurrently, each in its own CASA process, and waits for all of them.
+
+    Args:
+        jobs (list): Jobs from casa_job
+        logdir (string): Directory for the scripts and logs of the jobs
+        max_jobs (int): Most jobs at once. Default: the number of CPUs
+        mem_fraction (float): Fraction of the memory available at the start that the jobs may use together
+        max_io_jobs (int): Most I/O-bound jobs at once
+        retries (int): Times a failed job is retried
+        casa (string): The casa executable
+        poll (float): Seconds between checks on the running jobs
+        on_finish (function): Called as on_finish(job, result) when a job succeeds, e.g. to export FITS
+    Returns:
+        results (dictionary): Per job name: 'success' (bool), 'attempts', 'returncode',
+            'walltime' (s, of the last attempt), 'maxrss_gb' (peak resident memory), 'log'
+    """
+    names = [job['name'] for job in jobs]
+    if len(set(names))!=len(names):
+        raise ValueError('Job names must be unique, they name the scripts and logs')
+    os.makedirs(logdir, exist_ok=True)
+    if max_jobs is None:
+        max_jobs = os.cpu_count()
+    mem_budget = mem_fraction*available_memory_gb()
+    print("Running %d CASA jobs: at most %d at once, %d I/O-bound, within %.1f GB" % (len(jobs), max_jobs, max_io_jobs, mem_budget))
+
+    queue   = [(job, 1) for job in jobs]
+    running = []
+    results = {}
+    while queue or running:
+        # start whatever fits; always let at least one job run, however big
+        for item in list(queue):
+            job = item[0]
+            mem_used = sum(r['job']['mem_gb'] for r in running)
+            n_io     = sum(r['job']['io'] for r in running)
+            if len(running) >= max_jobs:
+                break
+            if running and (mem_used + job['mem_gb'] > mem_budget):
+                continue
+            if job['io'] and (n_io >= max_io_jobs):
+                continue
+            queue.remove(item)
+            running.append(_start(job, item[1], logdir, casa))
+
+        time.sleep(poll if running else 0)
+        for r in list(running):
+            pid, status, rusage = os.wait4(r['proc'].pid, os.WNOHANG)
+            if pid==0:
+                continue
+            running.remove(r)
+            r['out'].close()
+            r['proc'].returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            job     = r['job']
+            success = os.path.exists(r['donefile']) and all(os.path.exists(output) for output in job['outputs'])
+            result  = {'success': success, 'attempts': r['attempt'], 'returncode': r['proc'].returncode,
+                       'walltime': time.time()-r['start'], 'maxrss_gb': rusage.ru_maxrss/1024.**2, 'log': r['log']}
+            results[job['name']] = result
+            print("%s %s after %.1f min (attempt %d, peak memory %.1f GB)"
+                  % (job['name'], 'finished' if success else 'FAILED', result['walltime']/60., r['attempt'], result['maxrss_gb']))
+            if success and (on_finish is not None):
+                on_finish(job, result)
+            elif (not success) and (r['attempt'] <= retries):
+                queue.append((job, r['attempt']+1))
+
+    failed = [name for name in names if not results[name]['success']]
+    print("All jobs done: %d succeeded, %d failed %s" % (len(jobs)-len(failed), len(failed), failed if failed else ''))
+    return results
+
+
+def check_casa_jobs(results, stage=''):
+    """
+    Raises if any job of run_casa_jobs failed (after its retries), so that the next
+    stage doesn't run on missing or partial outputs.
+
+    Args:
+        results (dictionary): From run_casa_jobs
+        stage (string): Name of the stage, for the error message
+    """
+    failed = [name for name in results if not results[name]['success']]
+    if failed:
+        raise ValueError('%s: jobs %s failed; see their logs: %s' % (stage if stage else 'CASA jobs', failed,
+                                                                    [results[name]['log'] for name in failed]))
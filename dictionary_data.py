@@ -75,7 +75,7 @@ LB_EB4_initcont_selfcal_shift        = step2_path+prefix+'_LB_EB4_initcont_selfc
 LB_EB5_initcont_selfcal_shift        = step2_path+prefix+'_LB_EB5_initcont_selfcal_shift.ms'
 LB_EB6_initcont_selfcal_shift        = step2_path+prefix+'_LB_EB6_initcont_selfcal_shift.ms'
 
-LB_concat_shifted               = step3_path+prefix+'_LB_concat_shifted.ms'
+LB_concat_shifted               = step3_path+prefix+'_LB_concat_shifted.vms' # virtual (see virtual_ms.py)
 SB_concat_shifted_contp0        = step3_path+prefix+'_SB_concat_shifted_contp0.ms'
 BB_concat_shifted_contp0        = step3_path+prefix+'_BB_concat_shifted_contp0.ms' # BB stands for both baselines
 
@@ -94,6 +94,8 @@ BB_contap_cal        = step3_path+prefix+'_BB_concat_shifted_contap.cal'
 
 final_continuum                 = step3_path+prefix+'_continuum.ms'
 
+alignment_offsets_registry      = step2_path+prefix+'_alignment_offsets.json' # written by step2_phase_alignment.py, see alignment_registry.py
+
 line_spws       = np.array([1, 2, 3, 4]) # spws containing emission lines (SO, C18O, 13CO, 12CO)
 line_rest_freqs = np.array([2.19949442e11, 2.19560358e11, 2.20398684e11, 2.30538000e11]) # rest frequencies of the emission lines (SO, C18O, 13CO, 12CO)
 
@@ -177,6 +179,7 @@ data_dict   = {'CANFAR_path' : CANFAR_path,
                'EBs' : ['SB_EB1', 'SB_EB2', 'LB_EB1', 'LB_EB2', 'LB_EB3', 'LB_EB4', 'LB_EB5', 'LB_EB6'],
                'LB_EBs' : ['LB_EB1', 'LB_EB2', 'LB_EB3', 'LB_EB4', 'LB_EB5', 'LB_EB6'],
                'SB_EBs' : ['SB_EB1', 'SB_EB2'],
+               'alignment_offsets' : alignment_offsets_registry,
 
                'continuum' : continuum,
                '12CO' : line_12CO,
@@ -12,6 +12,24 @@ mask_dict['continuum'] = {'circle mask' : 'circle[[%s, %s], %.1farcsec]' %('04h5
                           'noise annulus' : "annulus[[%s, %s],['%.2farcsec', '10.0arcsec']]" % ('04h55m45.8549s', '+30.33.03.733', 6.) # J2000 common/aligned phase center
                          }
 
+# For cleaning the continuum non-interactively (tclean_wrapper(automask=...), see automask.py):
+# with 'threshold', the mask of each round is the previous image above nsigma_mask x rms, grown by
+# dilate_beams beams (and cut to the circle mask); cleaning stops at nsigma_stop x rms. The
+# auto-multithresh parameters are used where there is no previous image yet (and with 'auto-multithresh'),
+# and are the values recommended for ALMA 12m long baseline data.
+mask_dict['continuum automask'] = {'method'            : 'threshold',
+                                   'nsigma_mask'       : 5.,
+                                   'dilate_beams'      : 1.,
+                                   'nsigma_stop'       : 3.,
+                                   'sidelobethreshold' : 3.0,
+                                   'noisethreshold'    : 5.0,
+                                   'lownoisethreshold' : 1.5,
+                                   'negativethreshold' : 0.0,
+                                   'minbeamfrac'       : 0.3,
+                                   'growiterations'    : 75,
+                                   'fastnoise'         : False, # the continuum is bright; use the robust rms
+                                  }
+
 # The following is for cleaning, using with Rich Teague's keplerian_mask, based on experimentation:
 mask_dict['SO_keplerian']   = {'r_max': 3.5,          # Maximum radius in [arcsec] of the mask.
                                'dV0': 400.0,          # The Doppler width of the line in [m/s] at 1 arcsec.
@@ -0,0 +1,92 @@
+"""
+ALMA Program ID: 2021.1.00690.S (PI: R. Dong)
+reducer: J. Speedie
+
+Dictionary of the self-calibration schedules run in step3_continuum_selfcal.py,
+by run_selfcal_schedule() in selfcal_utils.py. One entry per concatenated MS;
+each round is the list of parameters that differ from selfcal_round_defaults.
+Round 'p1' reads contp0.ms and writes contp1.cal and contp1.ms, round 'p2' reads
+contp1.ms, and so on (each round reads the output of the previous one).
+With split_free=True (see step3), every round reads contp0.ms instead, with the
+caltables of the rounds before it applied on the fly; only the last round writes an MS.
+
+Changing a round makes it, and every round after it, stale: the next run of
+step3 redoes only those.
+"""
+
+""" Parameters shared by all rounds, unless a round says otherwise """
+selfcal_round_defaults = {'gaintype'    : 'T',          # could've used 'G', we only have 1 polarization mode
+                          'spw'         : '',
+                          'calmode'     : 'p',          # phase-only
+                          'combine'     : '',
+                          'solint'      : 'inf',
+                          'spwmap'      : [],           # only needed when combine includes 'spw'
+                          'minsnr'      : 2.5,          # don't want this to be too low
+                          'minblperant' : 4,
+                          'solnorm'     : False,        # default is False anyway
+                          'interp'      : 'linearPD',   # PD is overkill but it's fine
+                          'calwt'       : True,
+                          'applymode'   : '',           # '' is applycal's default, 'calflag'
+                         }
+
+SB_spwmap = [0,0,0,0,0,5,5,5,5,5] # with combine=spw, the solutions of an EB are stored in its first spw
+BB_spwmap = [0,0,0,0,0, 5,5,5,5,5, 10,10,10,10,10, 15,15,15,15,15, 20,20,20,20,20, 25,25,25,25,25, 30,30,30,30,30, 35,35,35,35,35]
+calonly   = 'calonly' # default is 'calflag', which applies solns and flags those with SNR<minSNR. Here we follow DSHARP and don't flag those with SNR<mnSNR; use with extreme caution
+
+
+selfcal_schedule = {}
+
+"""
+For reference in choosing solint, here's the number of seconds in each scan, in
+each execution block:
+SB_EB1: 486 486 486 486 486 30
+SB_EB2: 486 486 486 486
+"""
+selfcal_schedule['SB_concat'] = {'imaging' : {'imsize': 500, 'cellsize': '0.04arcsec', 'robust': 0.5},
+                                 'rounds'  : [
+    # We need to not combine spectral windows at least once, to remove any potential per-spw phase offsets
+    {'round': 'p1', 'solint': 'inf'},
+    {'round': 'p2', 'solint': '243s'},                                          # half of a scan
+    {'round': 'p3', 'solint': '120s', 'combine': 'spw', 'spwmap': SB_spwmap},   # quarter of a scan; now reluctantly combining spectral windows
+    {'round': 'p4', 'solint': '60s', 'combine': 'spw', 'spwmap': SB_spwmap},    # an eighth of a scan
+    {'round': 'p5', 'solint': '30s', 'combine': 'spw,scan', 'spwmap': SB_spwmap}, # a 16th of a scan; now scans as well
+    {'round': 'p6', 'solint': '18s', 'combine': 'spw,scan', 'spwmap': SB_spwmap}, # a 27th of a scan
+    # in none of the DSHARP continuum scripts do they combine scan for SB ap selfcal; for HD 163296 they combine 'spw'; but in-text they say they don't.
+    {'round': 'ap', 'calmode': 'ap', 'solint': 'inf', 'combine': '', 'spwmap': SB_spwmap, 'minsnr': 3.},
+                                             ]}
+
+"""
+Same, for the LB EBs:
+LB_EB1: 121 181 181 181 60  121 181 181 181 60  121 181 181 181 60  121 181 181 181
+We want to not combine spectral windows at least once, but it's just too low SNR unfortunately
+"""
+selfcal_schedule['BB_concat'] = {'imaging' : {'imsize': 2000, 'cellsize': '0.01arcsec',
+                                              'robust': 1.0}, # raise this from 0.5 to increase SNR; we can image with lower robust later
+                                 'rounds'  : [
+    # too many failed solns with combine='' or 'scan'; DSHARP uses minsnr=1.5 for combined, but that seems too low
+    {'round': 'p1', 'solint': '900s', 'combine': 'scan, spw', 'spwmap': BB_spwmap, 'applymode': calonly}, # a little over half an entire EB
+    {'round': 'p2', 'solint': '360s', 'combine': 'scan, spw', 'spwmap': BB_spwmap, 'applymode': calonly},
+    {'round': 'p3', 'solint': '180s', 'combine': 'scan, spw', 'spwmap': BB_spwmap, 'applymode': calonly},
+    {'round': 'p4', 'solint': '60s', 'combine': 'scan, spw', 'spwmap': BB_spwmap, 'applymode': calonly},
+    {'round': 'ap', 'calmode': 'ap', 'solint': 'inf', 'combine': 'spw', 'spwmap': BB_spwmap, 'applymode': calonly, 'minsnr': 3.}, # might need to be spw,scan and then 900s solint
+                                             ]}
+
+
+"""
+Adaptive alternative to the phase-only rounds above, run by run_solint_ladder() in selfcal_utils.py:
+start from first_round and keep halving solint while the peak SNR improves by more than
+min_snr_gain (fractional) and at most max_flagged of the solutions are flagged (SNR < minsnr).
+"""
+selfcal_ladder = {}
+selfcal_ladder['SB_concat'] = {'imaging'      : selfcal_schedule['SB_concat']['imaging'],
+                               'first_round'  : {'solint': 'inf'},
+                               'min_snr_gain' : 0.01,
+                               'max_flagged'  : 0.10,
+                               'min_solint'   : '6.05s', # the "average interval (seconds)" of every scan
+                               'max_rounds'   : 8}
+selfcal_ladder['BB_concat'] = {'imaging'      : selfcal_schedule['BB_concat']['imaging'],
+                               'first_round'  : {'solint': '900s', 'combine': 'scan, spw', 'spwmap': BB_spwmap, 'applymode': calonly},
+                               'min_snr_gain' : 0.01,
+                               'max_flagged'  : 0.10,
+                               'min_solint'   : '6.05s',
+                               'max_rounds'   : 8}
@@ -32,32 +32,29 @@ from casatasks import exportfits
 import dictionary_data as ddata # contains data_dict
 import dictionary_mask as dmask # contains mask_dict
 from JvM_correction_casa6 import do_JvM_correction_and_get_epsilon
+from image_metrics import measure_image
 # from calc_uvtaper import calc_taper
 
 def estimate_rms(imagename, region=''):
-    """ Use CASA's imstat task to estimate the rms noise outside the given region (annulus). """
-    rms = casatasks.imstat(imagename = imagename, region = region)['rms'][0]*1e6
+    """ Estimate the rms noise inside the given region (annulus); see image_metrics.measure_image. """
+    rms = measure_image(imagename, noise_mask=region)['rms']*1e6
     print("# rms: %.2f uJy/beam" %(rms))
     return rms
 
 def estimate_disk_flux(imagename, mask=''):
-    """ Use CASA's imstat task to estimate the total flux inside the given region (mask). """
-    disk_stats  = casatasks.imstat(imagename = imagename, region = mask)
-    disk_flux   = disk_stats['flux'][0]*1e3
+    """ Estimate the total flux inside the given region (mask); see image_metrics.measure_image. """
+    disk_flux   = measure_image(imagename, disk_mask=mask)['disk_flux']*1e3
     return disk_flux
 
 def estimate_peak_intensity(imagename, mask=''):
-    """ Use CASA's imstat task to estimate the peak intensity inside the given region (mask). """
-    disk_stats      = casatasks.imstat(imagename = imagename, region = mask)
-    peak_intensity  = disk_stats['max'][0]*1e3
+    """ Estimate the peak intensity inside the given region (mask); see image_metrics.measure_image. """
+    peak_intensity  = measure_image(imagename, disk_mask=mask)['peak_intensity']*1e3
     return peak_intensity
 
 def estimate_SNR(imagename, mask='', region=''):
-    """ Use CASA's imstat task to estimate the SNR as peak intensity inside the
-    given region (mask) divided by the rms noise outside the given region (annulus). """
-    peak_intensity  = estimate_peak_intensity(imagename=imagename, mask=mask)
-    rms             = estimate_rms(imagename=imagename, region=region)
-    SNR             = peak_intensity/(rms/1e3) # rms in [uJy/beam], peak in [mJy/beam]
+    """ Estimate the SNR as peak intensity inside the given region (mask) divided
+    by the rms noise inside the given region (annulus), from a single read of the image. """
+    SNR             = measure_image(imagename, disk_mask=mask, noise_mask=region)['SNR']
     print("SNR of the image: %.2f"%(SNR))
     return SNR
 
@@ -193,11 +190,14 @@ def tclean_wrapper_continuum(vis, imagename, mask='', region='', imsize=None,
 
     rows = []
     for ext in JvM_extensions + JvM_pbcor_extensions:
+        metrics = measure_image(imagename+ext, disk_mask=mask, noise_mask=region) # one read of each image
+        print("# rms: %.2f uJy/beam" %(metrics['rms']*1e6))
+        print("SNR of the image: %.2f"%(metrics['SNR']))
         image_metrics = {}
-        image_metrics['peak intensity (mJy/beam)'] = estimate_peak_intensity(imagename=imagename+ext, mask=mask)
-        image_metrics['disk flux (mJy)'] = estimate_disk_flux(imagename=imagename+ext, mask=mask)
-        image_metrics['rms noise (uJy/beam)'] = estimate_rms(imagename=imagename+ext, region=region)
-        image_metrics['SNR'] = estimate_SNR(imagename=imagename+ext, mask=mask, region=region)
+        image_metrics['peak intensity (mJy/beam)'] = metrics['peak_intensity']*1e3
+        image_metrics['disk flux (mJy)'] = metrics['disk_flux']*1e3
+        image_metrics['rms noise (uJy/beam)'] = metrics['rms']*1e6
+        image_metrics['SNR'] = metrics['SNR']
         rows.append(pd.Series(image_metrics, name=ext))
 
     image_info = pd.concat(rows, axis=1)
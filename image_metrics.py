@@ -0,0 +1,147 @@
+"""
+Image metrics (beam, peak intensity and flux inside the disk mask, rms in the
+noise annulus, SNR) from a single read of each image, instead of one imstat
+(plus imhead) call per metric.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+The numbers match imstat's: 'max' is the peak inside the region, 'flux' is the
+sum inside the region divided by the beam area in pixels, and 'rms' is the root
+mean square sqrt(mean(x^2)) inside the region. Masked (e.g. beyond the pb
+cutoff) and NaN pixels are ignored, as in imstat.
+"""
+import os
+import numpy as np
+import casatools
+from region_masks import compile_region, rasterize_region, _direction_axes
+from alignment_registry import _is_table_data_file
+
+ia = casatools.image()
+qa = casatools.quanta()
+
+
+def _image_fingerprint(imagename):
+    """
+    Cheap marker of the on-disk state of an image: the modification time and size of a
+    FITS file, or the latest modification time among the table data files of a CASA
+    image (not its table.lock, which merely opening the image rewrites).
+    """
+    if not os.path.isdir(imagename):
+        st = os.stat(imagename)
+        return (st.st_mtime, st.st_size)
+    return max([os.path.getmtime(os.path.join(imagename, f)) for f in os.listdir(imagename) if _is_table_data_file(f)])
+
+
+# The most recently read image: (abspath, fingerprint, image dictionary)
+_image_cache = [None, None, None]
+
+def read_image(imagename):
+    """
+    Reads the first plane of a CASA image, its pixel mask, coordinate system and
+    restoring beam, in one go. The last image read is kept, so several metrics
+    of the same image (estimate_rms, estimate_peak_intensity, ...) cost one read.
+
+    Args:
+        imagename (string): Name of the CASA image (or FITS file)
+    Returns:
+        image (dictionary): 'data' (2D array, [x, y]), 'good' (2D boolean array of
+            unmasked, finite pixels), 'csys' (coordsys record), 'beam' (major, minor
+            in arcsec, pa in deg; or None), 'beam_area_pix' (beam area in pixels; or None)
+    """
+    key = os.path.abspath(imagename)
+    fingerprint = _image_fingerprint(imagename)
+    if (_image_cache[0]==key) and (_image_cache[1]==fingerprint):
+        return _image_cache[2]
+
+    ia.open(imagename)
+    shape = ia.shape()
+    blc   = [0]*len(shape)
+    trc   = [shape[0]-1, shape[1]-1] + [0]*(len(shape)-2)
+    data  = np.array(ia.getchunk(blc=blc, trc=trc, dropdeg=False)).reshape(shape[0], shape[1])
+    pmask = np.array(ia.getchunk(blc=blc, trc=trc, dropdeg=False, getmask=True)).reshape(shape[0], shape[1])
+    csys  = ia.coordsys()
+    csys_record = csys.torecord()
+    csys.done()
+    beam  = ia.restoringbeam()
+    ia.close()
+
+    image = {'data': data, 'good': pmask & np.isfinite(data), 'csys': csys_record,
+             'beam': None, 'beam_area_pix': None}
+    if 'major' in beam:
+        bmaj = qa.convert(beam['major'], 'arcsec')['value']
+        bmin = qa.convert(beam['minor'], 'arcsec')['value']
+        bpa  = qa.convert(beam['positionangle'], 'deg')['value']
+        cdelt = _direction_axes(csys_record)[2] # radians
+        pix_area = np.abs(cdelt[0]*cdelt[1])*(180./np.pi*3600.)**2 # arcsec^2
+        image['beam'] = (bmaj, bmin, bpa)
+        image['beam_area_pix'] = np.pi*bmaj*bmin/(4.*np.log(2.))/pix_area
+
+    _image_cache[:] = [key, fingerprint, image]
+    return image
+
+
+def measure_image(imagename, disk_mask='', noise_mask=''):
+    """
+    All the image metrics we track, from one read of the image.
+
+    Args:
+        imagename (string): Name of the CASA image
+        disk_mask (string): CASA region in which to measure the peak intensity and flux
+        noise_mask (string): CASA region (annulus) in which to measure the rms
+    Returns:
+        metrics (dictionary): 'beammajor', 'beamminor' (arcsec), 'beampa' (deg),
+            'disk_flux' (Jy), 'peak_intensity' (Jy/beam), 'rms' (Jy/beam), 'SNR'.
+            Beam and flux are NaN if the image has no restoring beam.
+    """
+    image = read_image(imagename)
+    data  = image['data']
+
+    # compiled regions are flat pixel indices; keep the good (unmasked, finite) ones
+    flat  = data.ravel()
+    good  = image['good'].ravel()
+    disk  = compile_region(disk_mask, data.shape, image['csys'])
+    noise = compile_region(noise_mask, data.shape, image['csys'])
+    disk  = flat[disk[good[disk]]]
+    noise = flat[noise[good[noise]]]
+
+    peak_intensity = np.max(disk)
+    rms            = np.sqrt(np.mean(noise**2))
+    if image['beam'] is not None:
+        beammajor, beamminor, beampa = image['beam']
+        disk_flux = np.sum(disk)/image['beam_area_pix']
+    else:
+        beammajor, beamminor, beampa, disk_flux = np.nan, np.nan, np.nan, np.nan
+
+    return {'beammajor': beammajor, 'beamminor': beamminor, 'beampa': beampa,
+            'disk_flux': disk_flux, 'peak_intensity': peak_intensity, 'rms': rms,
+            'SNR': peak_intensity/rms}
+
+
+def write_region_mask(region, template, outfile, overwrite=True):
+    """
+    Writes a CASA mask image (1 inside the region, 0 outside) on the grid of a
+    template image, e.g. to pass to tclean as mask=outfile instead of the region
+    string. Every plane (Stokes, channel) gets the same mask.
+
+    Args:
+        region (string): CASA circle or annulus region
+        template (string): Name of the CASA image whose grid the mask is written on
+        outfile (string): Name of the mask image
+        overwrite (bool): Whether to overwrite an existing outfile
+    Returns:
+        outfile (string): Name of the mask image
+    """
+    ia.open(template)
+    shape = ia.shape()
+    csys  = ia.coordsys()
+    csys_record = csys.torecord()
+    csys.done()
+    ia.close()
+
+    mask = rasterize_region(region, shape[:2], csys_record).astype('float32')
+    mask = np.broadcast_to(mask.reshape(tuple(shape[:2])+(1,)*(len(shape)-2)), tuple(shape))
+
+    ia.fromarray(outfile=outfile, pixels=np.ascontiguousarray(mask), csys=csys_record, overwrite=overwrite)
+    ia.close()
+    print("Mask written to: "+outfile)
+    return outfile
@@ -0,0 +1,279 @@
+"""
+Deduplicating, compressed backups of measurement sets (or any directory), as a
+replacement for os.system('tar cvzf backups/<ms>.tgz <ms>'): multi-threaded,
+and files that haven't changed since the last backup aren't re-archived.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+A backup directory, e.g. backups/, holds
+    chunks/ab/ab12...ef.zst     the contents of the backed-up files, cut in chunks of
+                                chunk_mb, each compressed on its own and named by the
+                                sha256 of its (uncompressed) contents
+    <ms name>.manifest.json     per MS: its files, their sizes and mtimes, and their chunks
+                                (with the chunk size they were cut with)
+A chunk that's already in chunks/ (from this MS, an earlier backup of it, or
+another MS) is not written again, and a file with the same size and mtime as in
+the previous manifest isn't even read. The chunks are hashed and compressed (and,
+to restore, decompressed and written in place) by a pool of threads (hashlib, zlib
+and zstandard release the GIL), so a backup runs at about the speed of the disk.
+
+Compression is zstd if the zstandard module is installed, zlib otherwise; the
+extension of a chunk says which, so backups made with either restore anywhere
+zstandard is available (and the .zz ones restore everywhere).
+
+restore_ms() restores one MS from its manifest, or only some of its files (e.g.
+patterns=['table.*', 'SPECTRAL_WINDOW/*'] to look at the metadata without the data).
+"""
+import os
+import json
+import time
+import zlib
+import fnmatch
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_EXT = {'zstd': '.zst', 'zlib': '.zz'}
+
+
+def _default_codec():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def _compress(data, codec, level):
+    if codec=='zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def _decompress(data, codec):
+    if codec=='zstd':
+        if zstandard is None:
+            raise ValueError('This chunk is zstd-compressed; you need the zstandard module to restore it')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _chunk_path(backupdir, digest, codec):
+    return os.path.join(backupdir, 'chunks', digest[:2], digest+CODEC_EXT[codec])
+
+
+def _find_chunk(backupdir, digest):
+    """ The path and codec of a stored chunk, or (None, None) if it isn't stored yet. """
+    for codec in CODEC_EXT:
+        path = _chunk_path(backupdir, digest, codec)
+        if os.path.exists(path):
+            return path, codec
+    return None, None
+
+
+def manifest_name(msname, backupdir='backups/'):
+    """ The manifest of the backup of msname in backupdir. """
+    return os.path.join(backupdir, os.path.basename(os.path.normpath(msname))+'.manifest.json')
+
+
+def _store_chunk(backupdir, data, codec, level):
+    """ Stores a chunk, unless it's stored already. Returns its digest and whether it was written. """
+    digest = hashlib.sha256(data).hexdigest()
+    if _find_chunk(backupdir, digest)[0] is not None:
+        return digest, False
+    path = _chunk_path(backupdir, digest, codec)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp  = '%s.tmp%d_%d' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(_compress(data, codec, level))
+    os.replace(tmp, path) # atomic, so an interrupted backup never leaves a broken chunk behind
+    return digest, True
+
+
+def _backup_files(msname, relpaths, backupdir, chunk_bytes, codec, level, max_workers):
+    """
+    Cuts files in chunks and stores them, the chunks (not the files) spread over a pool
+    of threads, so one big table.f* file is as parallel as many small ones. The files
+    are read in order, with at most a couple of chunks per thread in memory at once.
+    Returns the chunk digests of every file, and the bytes written (uncompressed).
+    """
+    digests = {relpath: [] for relpath in relpaths}
+    written = 0
+    pending = deque()
+    def collect():
+        relpath, future, nbytes = pending.popleft()
+        digest, new = future.result()
+        digests[relpath].append(digest)
+        return nbytes if new else 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for relpath in relpaths:
+            with open(os.path.join(msname, relpath), 'rb') as f:
+                while True:
+                    data = f.read(chunk_bytes)
+                    if not data:
+                        break
+                    pending.append((relpath, pool.submit(_store_chunk, backupdir, data, codec, level), len(data)))
+                    if len(pending) >= 2*max_workers:
+                        written += collect()
+        while pending:
+            written += collect()
+    return digests, written
+
+
+def backup_ms(msname, backupdir='backups/', chunk_mb=16, level=3, max_workers=None, codec=None):
+    """
+    Backs up a measurement set (any directory, really) into backupdir, skipping the
+    files unchanged since its last backup and the chunks already stored.
+
+    Args:
+        msname (string): Name of the measurement set
+        backupdir (string): Backup directory (see top of file), shared between MSs
+        chunk_mb (float): Size of the chunks, in MB
+        level (int): Compression level (zstd: 1-22, zlib: 1-9); low levels are already fast and decent
+        max_workers (int): Number of threads. Default: the number of CPUs
+        codec (string): 'zstd' or 'zlib'. Default: zstd if the zstandard module is installed
+    Returns:
+        manifest (string): Name of the manifest of the backup
+    """
+    if not os.path.isdir(msname):
+        raise ValueError('Cannot find measurement set '+msname)
+    codec = _default_codec() if codec is None else codec
+    if codec not in CODEC_EXT:
+        raise ValueError("codec must be 'zstd' or 'zlib'")
+    if (codec=='zstd') and (zstandard is None):
+        raise ValueError('You need the zstandard module for codec=zstd')
+    os.makedirs(os.path.join(backupdir, 'chunks'), exist_ok=True)
+    manifest = manifest_name(msname, backupdir)
+    previous = {}
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            previous = json.load(f)['files']
+
+    start = time.time()
+    files = {}
+    todo  = []
+    for root, dirs, filenames in os.walk(msname):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path    = os.path.join(root, filename)
+            relpath = os.path.relpath(path, msname)
+            st      = os.stat(path)
+            files[relpath] = {'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode & 0o777}
+            old = previous.get(relpath)
+            if (old is not None) and (old['size']==st.st_size) and (old['mtime']==st.st_mtime) \
+               and all(_find_chunk(backupdir, digest)[0] is not None for digest in old['chunks']):
+                files[relpath].update(chunks=old['chunks'], chunk_bytes=old['chunk_bytes']) # unchanged since the last backup
+            else:
+                todo.append(relpath)
+
+    chunk_bytes      = int(chunk_mb*1024**2)
+    digests, written = _backup_files(msname, todo, backupdir, chunk_bytes, codec, level, max_workers or os.cpu_count())
+    for relpath in todo:
+        files[relpath].update(chunks=digests[relpath], chunk_bytes=chunk_bytes)
+
+    tmp = manifest+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'msname': os.path.normpath(msname), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'files': files}, f, indent=1)
+    os.replace(tmp, manifest)
+
+    total = sum(entry['size'] for entry in files.values())
+    print("Backed up %s (%.2f GB in %d files) in %.1f s: %d files changed, %.2f GB of new chunks; manifest: %s"
+          % (msname, total/1024.**3, len(files), time.time()-start, len(todo), written/1024.**3, manifest))
+    return manifest
+
+
+def _restore_chunk(backupdir, digest, fd, offset, path):
+    """ Decompresses a chunk, checks it, and writes it at offset of the open file fd. """
+    chunk, codec = _find_chunk(backupdir, digest)
+    if chunk is None:
+        raise ValueError('Chunk %s of %s is missing from %s' % (digest, path, backupdir))
+    with open(chunk, 'rb') as c:
+        data = _decompress(c.read(), codec)
+    if hashlib.sha256(data).hexdigest()!=digest:
+        raise ValueError('Chunk %s of %s is corrupted' % (digest, path))
+    os.pwrite(fd, data, offset)
+
+
+def restore_ms(manifest, outputname=None, patterns=None, max_workers=None, overwrite=False):
+    """
+    Restores a backed-up measurement set, or only some of its files.
+
+    Args:
+        manifest (string): Manifest of the backup (see manifest_name), in its backup directory
+        outputname (string): Where to restore it. Default: the name it was backed up from
+        patterns (list): Restore only the files matching one of these (fnmatch) patterns,
+            relative to the MS, e.g. ['table.*', 'SPECTRAL_WINDOW/*']. Default: all files
+        max_workers (int): Number of threads. Default: the number of CPUs
+        overwrite (bool): Whether to restore into an existing directory (files are replaced)
+    Returns:
+        outputname (string): Name of the restored measurement set
+    """
+    backupdir = os.path.dirname(manifest)
+    with open(manifest, 'r') as f:
+        backup = json.load(f)
+    if outputname is None:
+        outputname = backup['msname']
+    if os.path.exists(outputname) and not overwrite:
+        raise ValueError(outputname+' already exists; set overwrite=True to restore into it')
+
+    files = backup['files']
+    if patterns is not None:
+        files = {relpath: entry for relpath, entry in files.items() if any(fnmatch.fnmatch(relpath, p) for p in patterns)}
+        if len(files)==0:
+            raise ValueError('No files of %s match %s' % (backup['msname'], patterns))
+
+    start = time.time()
+    os.makedirs(outputname, exist_ok=True)
+    fds = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            futures = []
+            for relpath, entry in files.items():
+                path = os.path.join(outputname, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fds[relpath] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, entry['mode'])
+                futures += [pool.submit(_restore_chunk, backupdir, digest, fds[relpath], i*entry['chunk_bytes'], path) # all chunks but the last are chunk_bytes long
+                            for i, digest in enumerate(entry['chunks'])]
+            for future in futures:
+                future.result() # raises if a chunk is missing or corrupted
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+    for relpath, entry in files.items():
+        os.chmod(os.path.join(outputname, relpath), entry['mode'])
+        os.utime(os.path.join(outputname, relpath), (entry['mtime'], entry['mtime']))
+    print("Restored %d files (%.2f GB) of %s to %s in %.1f s"
+          % (len(files), sum(entry['size'] for entry in files.values())/1024.**3, backup['msname'], outputname, time.time()-start))
+    return outputname
+
+
+def remove_unused_chunks(backupdir='backups/'):
+    """
+    Deletes the chunks that no manifest in backupdir refers to any more (e.g. of
+    files that changed since), to get the space back.
+
+    Args:
+        backupdir (string): Backup directory
+    Returns:
+        nremoved (int): Number of chunks deleted
+    """
+    used = set()
+    for name in os.listdir(backupdir):
+        if name.endswith('.manifest.json'):
+            with open(os.path.join(backupdir, name), 'r') as f:
+                for entry in json.load(f)['files'].values():
+                    used.update(entry['chunks'])
+    nremoved, freed = 0, 0
+    for root, dirs, filenames in os.walk(os.path.join(backupdir, 'chunks')):
+        for filename in filenames:
+            if filename.split('.')[0] not in used:
+                path   = os.path.join(root, filename)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                nremoved += 1
+    print("Removed %d unused chunks (%.2f GB) from %s" % (nremoved, freed/1024.**3, backupdir))
+    return nremoved
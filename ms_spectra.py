@@ -0,0 +1,373 @@
+"""
+Time- and baseline-averaged spectra of a measurement set, accumulated in numpy
+from one chunked pass over the main table, as a replacement for the
+plotms(avgtime='1e8', avgscan=True) diagnostics that each re-read the whole MS.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+Per spw and channel, the pass accumulates the weighted sums of the amplitudes and of
+the visibilities (the polarizations together), the sum of the weights, and the
+number of unflagged visibilities, so that
+    amplitude        = sum(weight |V|) / sum(weight)  (scalar average)
+    vector_amplitude = |sum(weight V)| / sum(weight)  (vector average, what plotms shows when it averages)
+    weight           = sum(weight) / number           (the mean wtsp, after initweights(wtmode='weight'))
+With uv_binwidth, the same pass also bins the (vector-averaged, over channels) visibilities
+by uv distance, for amp vs. uv-distance plots (plot_amp_vs_uvdist).
+The spectrum after the line channels are flagged is the same, with those channels
+left out: flagdata(mode='manual') flags a channel for all rows, so once it's flagged
+only the FLAG column is read again (unflagged_channels), to see which channels it did flag.
+
+The rows are read in chunks of about MAX_CHUNK_ELEMENTS visibilities (so the number of
+rows per chunk goes down as the number of channels goes up), and the products are
+computed in single precision, as the columns are stored; only the sums are double.
+
+The spectra are saved to a .npz file, so the plots can be re-made without the MS.
+They replace the plotms calls of avg_cont (step1) and of the applycal and
+continuum-subtraction stages of step4: every MS is read once for all its plots.
+"""
+import os
+import numpy as np
+import casatools
+
+tb = casatools.table()
+
+MAX_CHUNK_ELEMENTS = 2**23 # visibilities (ncorr*nchan*nrow) per chunk: ~250 MB of DATA, FLAG, weights and temporaries
+
+
+class SpectrumAccumulator:
+    """
+    Running sums for the averaged spectrum of one spw, fed chunk by chunk
+    (add(data, flag, weight), with the arrays of tb.getcol).
+    """
+
+    def __init__(self, nchan):
+        self.amp_sum    = np.zeros(nchan)
+        self.vis_sum    = np.zeros(nchan, dtype='complex128')
+        self.weight_sum = np.zeros(nchan)
+        self.count      = np.zeros(nchan, dtype='int64')
+
+    def add(self, data, flag, weight):
+        """ data, flag: [ncorr, nchan, nrow]; weight: [ncorr, nrow] (or [ncorr, nchan, nrow], a weight spectrum). """
+        if weight.ndim==2:
+            weight = weight[:,None,:]
+        w = np.where(flag, np.float32(0.), weight.astype('float32', copy=False))
+        self.amp_sum    += np.sum(w*np.abs(data), axis=(0,2), dtype='float64')
+        self.vis_sum    += np.sum(w*data, axis=(0,2), dtype='complex128')
+        self.weight_sum += np.sum(w, axis=(0,2), dtype='float64')
+        self.count      += np.sum(~flag, axis=(0,2))
+
+    def amplitude(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.amp_sum/self.weight_sum
+
+    def vector_amplitude(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.abs(self.vis_sum)/self.weight_sum
+
+    def mean_weight(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.weight_sum/self.count
+
+
+class UVProfileAccumulator:
+    """
+    Running sums for the amplitude vs. uv distance of one spw, in bins of binwidth
+    metres (grown as longer baselines come in), fed chunk by chunk
+    (add(data, flag, weight, uvw), with the arrays of tb.getcol).
+    """
+
+    def __init__(self, binwidth):
+        self.binwidth   = float(binwidth)
+        self.vis_sum    = np.zeros(0, dtype='complex128')
+        self.weight_sum = np.zeros(0)
+        self.count      = np.zeros(0, dtype='int64')
+
+    def add(self, data, flag, weight, uvw):
+        """ data, flag: [ncorr, nchan, nrow]; weight: [ncorr, nrow] (or [ncorr, nchan, nrow]); uvw: [3, nrow] (m). """
+        if weight.ndim==2:
+            weight = weight[:,None,:]
+        w      = np.where(flag, np.float32(0.), weight.astype('float32', copy=False))
+        ibin   = (np.hypot(uvw[0], uvw[1])/self.binwidth).astype('int64')
+        nbins  = max(len(self.count), ibin.max()+1 if len(ibin) else 0)
+        self.vis_sum    = np.pad(self.vis_sum, (0, nbins-len(self.vis_sum)))
+        self.weight_sum = np.pad(self.weight_sum, (0, nbins-len(self.weight_sum)))
+        self.count      = np.pad(self.count, (0, nbins-len(self.count)))
+        vis_row = np.sum(w*data, axis=(0,1), dtype='complex128') # per row, over polarizations and channels
+        self.vis_sum    += np.bincount(ibin, weights=vis_row.real, minlength=nbins) + 1j*np.bincount(ibin, weights=vis_row.imag, minlength=nbins)
+        self.weight_sum += np.bincount(ibin, weights=np.sum(w, axis=(0,1), dtype='float64'), minlength=nbins)
+        self.count      += np.bincount(ibin, weights=np.sum(~flag, axis=(0,1)), minlength=nbins).astype('int64')
+
+    def uvdist(self):
+        """ Centres of the bins (m). """
+        return (np.arange(len(self.count))+0.5)*self.binwidth
+
+    def vector_amplitude(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.abs(self.vis_sum)/self.weight_sum
+
+
+def chunk_rows(table, columns, max_elements=MAX_CHUNK_ELEMENTS):
+    """
+    Number of rows of an open table (or table query) to read at a time so that a chunk
+    holds about max_elements elements of the largest of columns (e.g. ncorr*nchan per
+    row for DATA), as the cells of a spw all have the same shape.
+    """
+    if table.nrows()==0:
+        return 1
+    rowsize = max(np.size(table.getcell(column, 0)) for column in columns)
+    return max(1, int(max_elements//rowsize))
+
+
+def iter_rows(table, columns, chunksize=None, max_elements=MAX_CHUNK_ELEMENTS):
+    """
+    Reads columns of an open table (or table query) in chunks of rows.
+
+    Args:
+        table: casatools table (e.g. tb, or the result of tb.query)
+        columns (list): Column names
+        chunksize (int): Number of rows read at a time. Default: as many as fit in max_elements
+        max_elements (int): Number of elements per row (e.g. ncorr*nchan for DATA, the largest of
+            the columns) times number of rows to read at a time, when chunksize isn't given
+    Yields:
+        chunk (dictionary): Column name -> array of the chunk
+    """
+    nrows = table.nrows()
+    if chunksize is None:
+        chunksize = chunk_rows(table, columns, max_elements)
+    for startrow in range(0, nrows, chunksize):
+        nrow = min(chunksize, nrows-startrow)
+        yield {column: table.getcol(column, startrow, nrow) for column in columns}
+
+
+def parse_flagchannels(flagchannels):
+    """
+    The channels of a flagdata/split spw string, per spw.
+
+    Args:
+        flagchannels (string): e.g. '1:517~589, 2:504~600' or '1:0~516;590~959'
+    Returns:
+        channels (dictionary): spw (int) -> list of (first, last) channel ranges
+    """
+    channels = {}
+    for selection in flagchannels.split(','):
+        selection = selection.strip()
+        if selection=='':
+            continue
+        spw, ranges = selection.split(':')
+        for chanrange in ranges.split(';'):
+            first, _, last = chanrange.partition('~')
+            channels.setdefault(int(spw), []).append((int(first), int(last if last else first)))
+    return channels
+
+
+def _spw_selections(msfile, field='', spws=None):
+    """
+    The channel frequencies of the spws of a measurement set, and the table query of the rows of each.
+
+    Args:
+        msfile (string): Name of measurement set
+        field (string): Field name to select ('' for all fields)
+        spws (list): Spectral windows. Default: all
+    Returns:
+        chanfreqs (list): CHAN_FREQ of every spw
+        queries (dictionary): spw -> TaQL selection of its rows
+    """
+    tb.open(msfile+'/SPECTRAL_WINDOW')
+    chanfreqs = [tb.getcell('CHAN_FREQ', i) for i in range(tb.nrows())]
+    tb.close()
+    tb.open(msfile+'/DATA_DESCRIPTION')
+    ddid_to_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    fieldquery = ''
+    if field!='':
+        tb.open(msfile+'/FIELD')
+        fieldids = np.where(tb.getcol('NAME')==field)[0]
+        tb.close()
+        if len(fieldids)==0:
+            raise ValueError('There is no field '+field+' in '+msfile)
+        fieldquery = ' && FIELD_ID IN [%s]' % ','.join(['%d' % i for i in fieldids])
+    if spws is None:
+        spws = sorted(set(ddid_to_spw.tolist()))
+    queries = {spw: 'DATA_DESC_ID IN [%s]%s' % (','.join(['%d' % i for i in np.where(ddid_to_spw==spw)[0]]), fieldquery)
+               for spw in spws}
+    return chanfreqs, queries
+
+
+def accumulate_spectra(msfile, datacolumn='data', field='', spws=None, chunksize=None, uv_binwidth=None):
+    """
+    Averaged spectrum of every spw of a measurement set, from a single pass over its
+    rows (each spw is read through its own table query, but every row is read once),
+    and optionally the amplitude vs. uv distance from the same pass.
+
+    Args:
+        msfile (string): Name of measurement set
+        datacolumn (string): 'data', 'corrected' or 'model'
+        field (string): Field name to select ('' for all fields)
+        spws (list): Spectral windows to read. Default: all
+        chunksize (int): Number of rows read at a time. Default: chunks of about MAX_CHUNK_ELEMENTS visibilities
+        uv_binwidth (float): Width of the uv-distance bins (m). Default: no uv-distance profile
+    Returns:
+        spectra (dictionary): spw -> {'freq' (Hz), 'amplitude', 'vector_amplitude', 'weight', 'count'}
+            arrays per channel, plus {'uvdist' (m), 'uv_amplitude', 'uv_count'} arrays per uv bin with uv_binwidth
+    """
+    column = {'data': 'DATA', 'corrected': 'CORRECTED_DATA', 'model': 'MODEL_DATA'}[datacolumn.lower()]
+    chanfreqs, queries = _spw_selections(msfile, field=field, spws=spws)
+
+    spectra = {}
+    tb.open(msfile)
+    for spw, query in queries.items():
+        subtable = tb.query(query)
+        spectrum = SpectrumAccumulator(len(chanfreqs[spw]))
+        profile  = None if uv_binwidth is None else UVProfileAccumulator(uv_binwidth)
+        columns  = [column, 'FLAG', 'WEIGHT'] + ([] if profile is None else ['UVW'])
+        for chunk in iter_rows(subtable, columns, chunksize=chunksize):
+            spectrum.add(chunk[column], chunk['FLAG'], chunk['WEIGHT'])
+            if profile is not None:
+                profile.add(chunk[column], chunk['FLAG'], chunk['WEIGHT'], chunk['UVW'])
+        subtable.close()
+        spectra[spw] = {'freq': chanfreqs[spw], 'amplitude': spectrum.amplitude(), 'vector_amplitude': spectrum.vector_amplitude(),
+                        'weight': spectrum.mean_weight(), 'count': spectrum.count}
+        if profile is not None:
+            spectra[spw].update({'uvdist': profile.uvdist(), 'uv_amplitude': profile.vector_amplitude(), 'uv_count': profile.count})
+    tb.close()
+    return spectra
+
+
+def unflagged_channels(msfile, field='', spws=None, chunksize=None):
+    """
+    Which channels of every spw still have unflagged visibilities, from the FLAG column
+    alone, e.g. after flagdata to check that the line channels (and only those) were flagged.
+
+    Args:
+        msfile (string): Name of measurement set
+        field (string): Field name to select ('' for all fields)
+        spws (list): Spectral windows to read. Default: all
+        chunksize (int): Number of rows read at a time. Default: chunks of about MAX_CHUNK_ELEMENTS visibilities
+    Returns:
+        unflagged (dictionary): spw -> boolean array per channel
+    """
+    chanfreqs, queries = _spw_selections(msfile, field=field, spws=spws)
+    unflagged = {}
+    tb.open(msfile)
+    for spw, query in queries.items():
+        subtable = tb.query(query)
+        unflagged[spw] = np.zeros(len(chanfreqs[spw]), dtype=bool)
+        for chunk in iter_rows(subtable, ['FLAG'], chunksize=chunksize):
+            unflagged[spw] |= np.any(~chunk['FLAG'], axis=(0,2))
+        subtable.close()
+    tb.close()
+    return unflagged
+
+
+def save_spectra(spectra, filename):
+    """ Saves the spectra of accumulate_spectra to a .npz file. """
+    arrays = {}
+    for spw, spectrum in spectra.items():
+        arrays.update({'spw%d_%s' % (spw, key): value for key, value in spectrum.items()})
+    np.savez(filename, **arrays)
+    print("Spectra saved to %s" % filename)
+
+
+def load_spectra(filename):
+    """ Reads back the spectra saved by save_spectra. """
+    spectra = {}
+    with np.load(filename) as f:
+        for name in f.files:
+            spw, key = name.split('_', 1)
+            spectra.setdefault(int(spw[3:]), {})[key] = f[name]
+    return spectra
+
+
+def plot_avg_cont_spectra(spectra, outputvis, plotrange=(0., 1.8)):
+    """
+    The diagnostic plots of avg_cont, from the spectra instead of from plotms: amplitude
+    (vector-averaged, as plotms averages) vs. channel and vs. frequency per spw, before and after flagging the line channels,
+    and the weights vs. frequency. Same file names as the plotms versions.
+
+    Args:
+        spectra (dictionary): From accumulate_spectra (or load_spectra), with the 'unflagged'
+            channels of every spw after the line channels were flagged (from unflagged_channels)
+        outputvis (string): Name of the averaged MS, which the plot names start with
+        plotrange (tuple): Amplitude range (Jy)
+    """
+    import matplotlib.pyplot as plt
+
+    keep = {}
+    for spw in sorted(spectra):
+        if 'unflagged' not in spectra[spw]:
+            raise ValueError('You need to specify the unflagged channels of spw %d (see unflagged_channels)' % spw)
+        amplitude = spectra[spw]['vector_amplitude']
+        freq      = spectra[spw]['freq']/1.e9
+        keep[spw] = spectra[spw]['unflagged'].astype(bool)
+        for when, mask in [('before_lines_flagged', np.ones_like(keep[spw])), ('check_lines_flagged_correctly', keep[spw])]:
+            for xaxis, x, xlabel in [('channel', np.arange(len(amplitude)), 'Channel'), ('freq', freq, 'Frequency (GHz)')]:
+                fig, ax = plt.subplots(figsize=(8, 5))
+                ax.plot(x[mask], amplitude[mask], '.', ms=2, color='k')
+                ax.set_ylim(plotrange)
+                ax.set_xlabel(xlabel)
+                ax.set_ylabel('Amp (Jy), vector-averaged over time and baselines')
+                ax.set_title('spw %d, %s' % (spw, when.replace('_', ' ')))
+                fig.savefig(outputvis+'_'+when+'_'+xaxis+'_spw'+str(spw)+'.png', bbox_inches='tight', dpi=150)
+                plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for spw in sorted(spectra): # the line channels are flagged by now, as in the plotms version
+        ax.plot(spectra[spw]['freq'][keep[spw]]/1.e9, spectra[spw]['weight'][keep[spw]], '.', ms=2, label='spw %d' % spw)
+    ax.set_xlabel('Frequency (GHz)')
+    ax.set_ylabel('Mean weight per channel')
+    ax.legend()
+    fig.savefig(outputvis+'_check_weights.png', bbox_inches='tight', dpi=150)
+    plt.close(fig)
+
+
+def plot_amp_vs_channel(spectra, vis, spw_labels=None):
+    """
+    Amplitude (vector-averaged over time and baselines) vs. channel per spw, from the
+    spectra instead of from plotms(xaxis='channel', avgtime='1e8', avgscan=True, avgbaseline=True).
+    Writes vis+'_amp-vs-channel_spw<spw>.png', as the plotms version did.
+
+    Args:
+        spectra (dictionary): From accumulate_spectra (or load_spectra)
+        vis (string): Name of the MS, which the plot names start with
+        spw_labels (dictionary): spw -> the number in the plot name and title, e.g. the spw
+            before uvcontsub renumbered it. Default: the spw itself
+    """
+    import matplotlib.pyplot as plt
+
+    for spw in sorted(spectra):
+        label = spw if spw_labels is None else spw_labels.get(spw, spw)
+        fig, ax = plt.subplots(figsize=(8, 5))
+        ax.plot(np.arange(len(spectra[spw]['vector_amplitude'])), spectra[spw]['vector_amplitude'], '.', ms=2, color='k')
+        ax.set_xlabel('Channel')
+        ax.set_ylabel('Amp (Jy), averaged over time and baselines')
+        ax.set_title('%s, spw %s' % (os.path.basename(vis), label))
+        fig.savefig(vis+'_amp-vs-channel_spw'+str(label)+'.png', bbox_inches='tight', dpi=150)
+        plt.close(fig)
+
+
+def plot_amp_vs_uvdist(spectra, vis, spw_labels=None):
+    """
+    Amplitude (vector-averaged over channels and in bins of uv distance) vs. uv distance
+    per spw, from the spectra of accumulate_spectra(..., uv_binwidth=...) instead of from
+    plotms(xaxis='UVdist', avgtime='1e8'). Writes vis+'_amp-vs-UVdist_spw<spw>.png', as the
+    plotms version did.
+
+    Args:
+        spectra (dictionary): From accumulate_spectra with uv_binwidth (or load_spectra)
+        vis (string): Name of the MS, which the plot names start with
+        spw_labels (dictionary): spw -> the number in the plot name and title. Default: the spw itself
+    """
+    import matplotlib.pyplot as plt
+
+    for spw in sorted(spectra):
+        if 'uvdist' not in spectra[spw]:
+            raise ValueError('You need to specify uv_binwidth in accumulate_spectra to plot amp vs. uv distance')
+        label = spw if spw_labels is None else spw_labels.get(spw, spw)
+        good  = spectra[spw]['uv_count'] > 0
+        fig, ax = plt.subplots(figsize=(8, 5))
+        ax.plot(spectra[spw]['uvdist'][good], spectra[spw]['uv_amplitude'][good], '.', ms=3, color='k')
+        ax.set_xlabel('UV distance (m)')
+        ax.set_ylabel('Amp (Jy), averaged in uv-distance bins')
+        ax.set_title('%s, spw %s' % (os.path.basename(vis), label))
+        fig.savefig(vis+'_amp-vs-UVdist_spw'+str(label)+'.png', bbox_inches='tight', dpi=150)
+        plt.close(fig)
@@ -0,0 +1,164 @@
+"""
+Quick-look imager for exported visibilities: a dirty image and PSF in seconds,
+to compare rounds of self-calibration without a full tclean run.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+Reads what export_MS writes (a visibility store, or an old .vis.npz; see
+vis_store.py). The visibilities are gridded in chunks with a Kaiser-Bessel
+convolution kernel, weighted naturally or with Briggs weighting, and Fourier
+transformed once. The gridding kernel is divided out of the image afterwards.
+This is for quick looks only: no w-term, no primary beam, no deconvolution.
+
+Usage:
+    image, psf, extent = quicklook_image('ABAur_SB_contp1.vis', npix=1024, cell=0.02)
+    plot_quicklook(image, extent, 'ABAur_SB_contp1_quicklook.png')
+"""
+import numpy as np
+from vis_store import load_vis
+
+arcsec_per_rad = 180./np.pi*3600.
+
+
+def _kaiser_bessel(d, support, beta):
+    """ Kaiser-Bessel gridding kernel at distance d (grid cells) from the visibility. """
+    arg = np.clip(1.-(2.*d/support)**2, 0., None)
+    return np.i0(beta*np.sqrt(arg))/np.i0(beta)
+
+
+def _grid_correction(npix, support, beta):
+    """ Fourier transform of the gridding kernel at each image pixel, to divide out of the image. """
+    x  = np.linspace(-support/2., support/2., 40*support+1)
+    k  = _kaiser_bessel(x, support, beta)
+    nu = (np.arange(npix)-npix//2)/float(npix)
+    corr = np.sum(k[None,:]*np.cos(2.*np.pi*nu[:,None]*x[None,:]), axis=1)*(x[1]-x[0])
+    return corr/corr[npix//2]
+
+
+def _grid_chunk(gu, gv, values, npix, support, beta):
+    """
+    Grids values at (fractional) grid positions gu, gv with the convolution kernel.
+    One np.bincount over all kernel taps of the chunk. Returns a flat complex grid.
+    """
+    offsets = np.arange(support) - (support//2 - 1)
+    iu = np.floor(gu).astype('int64')[:,None] + offsets[None,:] # (nvis, support)
+    iv = np.floor(gv).astype('int64')[:,None] + offsets[None,:]
+    ku = _kaiser_bessel(iu - gu[:,None], support, beta)
+    kv = _kaiser_bessel(iv - gv[:,None], support, beta)
+
+    idx = (iu[:,:,None]*npix + iv[:,None,:]).ravel()          # (nvis, support, support)
+    w   = (ku[:,:,None]*kv[:,None,:]*values[:,None,None]).ravel()
+    grid  = np.bincount(idx, weights=w.real, minlength=npix*npix).astype('complex128')
+    grid += 1j*np.bincount(idx, weights=w.imag, minlength=npix*npix)
+    return grid
+
+
+def quicklook_image(filename, npix=1024, cell=0.02, weighting='briggs', robust=0.5,
+                    support=6, chunksize=200000):
+    """
+    Makes a dirty image and PSF from exported visibilities.
+
+    Args:
+        filename (string): Visibility store (or .vis.npz file) from export_MS
+        npix (int): Number of pixels on a side of the image
+        cell (float): Pixel size (arcsec)
+        weighting (string): 'natural' or 'briggs'
+        robust (float): Briggs robust parameter (as in tclean)
+        support (int): Width of the gridding kernel (grid cells)
+        chunksize (int): Number of visibilities gridded at a time; bounds the memory used
+    Returns:
+        image (2D array): Dirty image (Jy/beam), indexed [Dec, RA] with RA increasing to the left
+        psf (2D array): Dirty beam, peak normalized to 1, same layout as image
+        extent (list): [left, right, bottom, top] of the image in arcsec offsets, for plt.imshow(origin='lower')
+    """
+    if weighting not in ['natural', 'briggs']:
+        raise ValueError("Sorry, weighting must be 'natural' or 'briggs', not "+weighting)
+    u, v, vis, wgt = load_vis(filename)
+
+    du   = 1./(npix*cell/arcsec_per_rad)  # uv cell size (lambda)
+    beta = 2.34*support
+    umax = (npix//2 - support)*du
+    nvis = len(u)
+
+    # Briggs weighting needs the gridded weight density first (nearest cell, both halves of the uv plane)
+    if weighting=='briggs':
+        density = np.zeros(npix*npix)
+        for start in range(0, nvis, chunksize):
+            uc, vc, wc = u[start:start+chunksize], v[start:start+chunksize], wgt[start:start+chunksize]
+            keep = (np.abs(uc) < umax) & (np.abs(vc) < umax)
+            for sign in [1., -1.]:
+                cu = np.round(sign*uc[keep]/du).astype('int64') + npix//2
+                cv = np.round(sign*vc[keep]/du).astype('int64') + npix//2
+                density += np.bincount(cu*npix+cv, weights=wc[keep], minlength=npix*npix)
+        f2 = (5.*10**(-robust))**2/(np.sum(density**2)/np.sum(density))
+
+    grid     = np.zeros(npix*npix, dtype='complex128')
+    psf_grid = np.zeros(npix*npix, dtype='complex128')
+    for start in range(0, nvis, chunksize):
+        uc, vc = u[start:start+chunksize], v[start:start+chunksize]
+        visc, wc = vis[start:start+chunksize], wgt[start:start+chunksize]
+        keep = (np.abs(uc) < umax) & (np.abs(vc) < umax)
+        uc, vc, visc, wc = uc[keep], vc[keep], visc[keep], wc[keep]
+
+        if weighting=='briggs':
+            cu = np.round(uc/du).astype('int64') + npix//2
+            cv = np.round(vc/du).astype('int64') + npix//2
+            wc = wc/(1. + density[cu*npix+cv]*f2)
+
+        # each visibility and its Hermitian conjugate
+        for sign in [1., -1.]:
+            gu = sign*uc/du + npix//2
+            gv = sign*vc/du + npix//2
+            vals = visc if sign > 0 else np.conj(visc)
+            grid     += _grid_chunk(gu, gv, wc*vals, npix, support, beta)
+            psf_grid += _grid_chunk(gu, gv, wc.astype('complex128'), npix, support, beta)
+
+    # one FFT each; the grid is indexed [u, v] so the image comes out indexed [l, m]
+    corr  = _grid_correction(npix, support, beta)
+    corr2 = corr[:,None]*corr[None,:]
+    image = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(grid.reshape(npix, npix)))).real/corr2
+    psf   = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(psf_grid.reshape(npix, npix)))).real/corr2
+    # normalizing by the psf peak (sum of weights times the kernel integral) gives Jy/beam
+    peak  = psf[npix//2, npix//2]
+    image /= peak
+    psf   /= peak
+
+    # [l, m] -> [Dec, RA] with RA (l, east) increasing to the left
+    image = image.T[:, ::-1]
+    psf   = psf.T[:, ::-1]
+    half  = npix//2*cell
+    extent = [half-cell, -half, -half, half-cell]
+    print("#Quick-look image of %s: peak %.3f mJy/beam" % (filename, 1e3*np.max(image)))
+
+    return image, psf, extent
+
+
+def plot_quicklook(image, extent, figname, zoom=None, vmin=None, vmax=None):
+    """
+    Saves a png of a quick-look image.
+
+    Args:
+        image (2D array), extent (list): As returned by quicklook_image
+        figname (string): Name of the png file
+        zoom (float): Half-width of the plotted field (arcsec). Default: the whole image
+        vmin, vmax (float): Color scale limits (Jy/beam)
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(8, 7))
+    ax = fig.add_subplot(111)
+    im = ax.imshow(1e3*image, origin='lower', extent=extent, cmap='inferno',
+                   vmin=None if vmin is None else 1e3*vmin, vmax=None if vmax is None else 1e3*vmax)
+    if zoom is not None:
+        ax.set_xlim(zoom, -zoom)
+        ax.set_ylim(-zoom, zoom)
+    ax.set_xlabel(r'$\Delta$RA (arcsec)', fontsize=16)
+    ax.set_ylabel(r'$\Delta$Dec (arcsec)', fontsize=16)
+    cbar = plt.colorbar(im, ax=ax)
+    cbar.set_label('mJy/beam', fontsize=16)
+    plt.tight_layout()
+    plt.savefig(figname, dpi=150, bbox_inches='tight', pad_inches=0.015)
+    plt.close(fig)
+    print("Figure saved! To: "+figname)
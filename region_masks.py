@@ -0,0 +1,199 @@
+"""
+Rasterization of CASA region strings into pixel masks, so image statistics can
+be computed in numpy instead of by re-parsing the region in every imstat call.
+Written for CASA 6 and the AB Aur program
+Author: J. Speedie
+
+Supported regions (the ones used throughout this workflow), e.g.
+    'circle[[04h55m45.8549s, +30.33.03.733], 3.0arcsec]'
+    "annulus[[04h55m45.8549s, +30.33.03.733],['6.00arcsec', '10.0arcsec']]"
+    'annulus[[500pix, 500pix],["1arcsec", "2arcsec"]]'
+Centers can be sexagesimal J2000 (04h55m45.8549s / 04:55:45.8549, +30.33.03.733 /
++30d33m03.733s), in degrees/radians, or in pixels; radii in arcsec, arcmin, deg,
+rad or pix. An empty region ('') is the whole image.
+
+Regions are compiled into flat pixel index arrays for a given image shape and
+coordinate system, and cached in memory and (optionally) on disk, keyed by
+(region string, csys hash). Set region_masks.default_cache_dir to a directory
+to have the compiled regions survive between sessions.
+"""
+import os
+import re
+import hashlib
+import numpy as np
+
+arcsec_per_rad = 180./np.pi*3600.
+
+_region_re = re.compile(r'^(circle|annulus)\[\[([^,\]]+),([^,\]]+)\],(.+)\]$')
+
+
+def _strip(s):
+    return s.strip().strip('\'"').strip()
+
+
+def _parse_ra(ra):
+    """ Right ascension (string) to radians. """
+    ra = _strip(ra)
+    if ra.endswith('pix'):
+        return ('pix', float(ra[:-3]))
+    match = re.match(r'^([+-]?\d+)[h:](\d+)[m:]([\d.]+)s?$', ra)
+    if match:
+        h, m, s = [float(x) for x in match.groups()]
+        return ('rad', np.radians(15.*(h + m/60. + s/3600.)))
+    return ('rad', _parse_angle(ra))
+
+
+def _parse_dec(dec):
+    """ Declination (string) to radians. """
+    dec = _strip(dec)
+    if dec.endswith('pix'):
+        return ('pix', float(dec[:-3]))
+    match = re.match(r'^([+-]?)(\d+)[d:.](\d+)[m:.](\d+(?:\.\d*)?)s?$', dec)
+    if match:
+        sign = -1. if match.group(1)=='-' else 1.
+        d, m, s = [float(x) for x in match.groups()[1:]]
+        return ('rad', sign*np.radians(d + m/60. + s/3600.))
+    return ('rad', _parse_angle(dec))
+
+
+def _parse_angle(angle):
+    """ Angle with units (string) to radians. """
+    angle = _strip(angle)
+    for unit, factor in [('arcsec', 1./arcsec_per_rad), ('arcmin', 60./arcsec_per_rad),
+                         ('deg', np.pi/180.), ('rad', 1.)]:
+        if angle.endswith(unit):
+            return float(angle[:-len(unit)])*factor
+    raise ValueError("Can't understand the angle "+angle)
+
+
+def _parse_radius(radius):
+    radius = _strip(radius)
+    if radius.endswith('pix'):
+        return ('pix', float(radius[:-3]))
+    return ('rad', _parse_angle(radius))
+
+
+def parse_region(region):
+    """
+    Parses a CASA circle or annulus region string.
+
+    Args:
+        region (string): The region, e.g. 'circle[[04h55m45.8549s, +30.33.03.733], 3.0arcsec]'
+    Returns:
+        shape (string): 'circle' or 'annulus'
+        center (tuple): ((unit, ra), (unit, dec)), unit is 'rad' or 'pix'
+        radii (list): [(unit, radius)] for a circle, [(unit, inner), (unit, outer)] for an annulus
+    """
+    match = _region_re.match(region.replace(' ', ''))
+    if match is None:
+        raise ValueError("Sorry, can only rasterize circle and annulus regions, not "+region)
+    shape, ra, dec, radii = match.groups()
+    center = (_parse_ra(ra), _parse_dec(dec))
+    radii = [_parse_radius(r) for r in radii.strip('[]').split(',')]
+    if len(radii)!=(1 if shape=='circle' else 2):
+        raise ValueError("Wrong number of radii in region "+region)
+    return shape, center, radii
+
+
+def _direction_axes(csys):
+    """ Reference value (rad), reference pixel and increment (rad) of the direction axes of a coordsys record. """
+    direction = [csys[key] for key in sorted(csys) if key.startswith('direction')][0]
+    crval = np.array(direction['crval'], dtype='float64')
+    crpix = np.array(direction['crpix'], dtype='float64')
+    cdelt = np.array(direction['cdelt'], dtype='float64')
+    return crval, crpix, cdelt
+
+
+def _world_to_pixel(ra, dec, crval, crpix, cdelt):
+    """ SIN projection of (ra, dec) in radians onto the pixel grid. """
+    dra = ra - crval[0]
+    l = np.cos(dec)*np.sin(dra)
+    m = np.sin(dec)*np.cos(crval[1]) - np.cos(dec)*np.sin(crval[1])*np.cos(dra)
+    return crpix[0] + l/cdelt[0], crpix[1] + m/cdelt[1]
+
+
+def csys_hash(shape, csys):
+    """ md5 hash of an image plane's shape and direction coordinates (what a compiled region depends on). """
+    crval, crpix, cdelt = _direction_axes(csys)
+    key = np.concatenate([np.asarray(shape[:2], dtype='float64'), crval, crpix, cdelt])
+    return hashlib.md5(key.tobytes()).hexdigest()
+
+
+def _rasterize(region, shape, csys):
+    """ Boolean mask [x, y] of the pixels (centers) inside a region. """
+    if region=='':
+        return np.ones(shape, dtype=bool)
+
+    crval, crpix, cdelt = _direction_axes(csys)
+    regtype, center, radii = parse_region(region)
+    if center[0][0]=='pix':
+        x0, y0 = center[0][1], center[1][1]
+    else:
+        x0, y0 = _world_to_pixel(center[0][1], center[1][1], crval, crpix, cdelt)
+    # radii in units of (x) pixels; distances account for non-square pixels
+    r_pix = [r if unit=='pix' else r/np.abs(cdelt[0]) for unit, r in radii]
+    x = np.arange(shape[0])[:,None] - x0
+    y = (np.arange(shape[1])[None,:] - y0)*np.abs(cdelt[1]/cdelt[0])
+    r2 = x**2 + y**2
+    if regtype=='circle':
+        return (r2 <= r_pix[0]**2)
+    return (r2 >= r_pix[0]**2) & (r2 <= r_pix[1]**2)
+
+
+# Directory of the on-disk cache of compiled regions; None to only cache in memory
+default_cache_dir = None
+
+# Compiled regions: {(region, csys hash): flat pixel indices}
+_region_cache = {}
+
+def compile_region(region, shape, csys, cache_dir=None):
+    """
+    Compiles a region into the flat indices (into the [x, y] plane, C order) of
+    the pixels inside it. Cached in memory and on disk by (region string, csys hash).
+
+    Args:
+        region (string): CASA circle or annulus region, or '' for the whole image
+        shape (tuple): (nx, ny) of the image plane
+        csys (dictionary): The image coordinate system, as from ia.coordsys().torecord()
+        cache_dir (string): Directory of the on-disk cache. Default: default_cache_dir
+    Returns:
+        indices (array): 1D array of flat pixel indices, e.g. data.ravel()[indices]
+    """
+    shape = tuple(shape[:2])
+    key = (region, csys_hash(shape, csys))
+    if key in _region_cache:
+        return _region_cache[key]
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    if cache_dir is not None:
+        cachefile = os.path.join(cache_dir, hashlib.md5(repr(key).encode()).hexdigest()+'.region.npy')
+        if os.path.exists(cachefile):
+            _region_cache[key] = np.load(cachefile)
+            return _region_cache[key]
+
+    indices = np.flatnonzero(_rasterize(region, shape, csys))
+    if shape[0]*shape[1] < 2**31:
+        indices = indices.astype('int32')
+    _region_cache[key] = indices
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cachefile, indices)
+
+    return indices
+
+
+def rasterize_region(region, shape, csys, cache_dir=None):
+    """
+    Boolean mask of the pixels (centers) inside a region, from the compiled region.
+
+    Args:
+        region, shape, csys, cache_dir: As in compile_region
+    Returns:
+        mask (array): Boolean array of the given shape, indexed [x, y] like ia.getchunk()
+    """
+    shape = tuple(shape[:2])
+    mask = np.zeros(shape[0]*shape[1], dtype=bool)
+    mask[compile_region(region, shape, csys, cache_dir=cache_dir)] = True
+    return mask.reshape(shape)
@@ -7,6 +7,8 @@ Version 0 November 21 2022
 Also contains adaptations of functions from DSHARP LP's reduction_utils.py
 """
 import os
+import hashlib
+import multiprocessing
 import numpy as np
 
 import matplotlib
@@ -14,6 +16,11 @@ matplotlib.use('Agg')
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,AutoMinorLocator)
+from vis_store import STORE_KEYS, export_vis_store, load_vis
+from image_metrics import measure_image
+from virtual_ms import is_virtual, members_of, read_columns
+from alignment_registry import ms_checksum, _is_table_data_file
+from automask import automask_tclean_args
 plt.rc('font', family='sans-serif', style='normal', weight='normal')
 mpl.rcParams['font.sans-serif'] = ['Arial']
 mpl.rcParams['text.latex.preamble'] = [r'\usepackage{amsmath}']
@@ -57,7 +64,8 @@ def update_selfcal_dict(save_dir='./', EB='EB', image_metrics=[]):
 def tclean_wrapper(vis, imagename, smallscalebias=0.6, mask='', contspws='',
                     threshold='0.2mJy', imsize=None, cellsize=None, interactive=False,
                     robust=0.5, gain=0.05, niter=50000, uvtaper=[], cycleniter=300,
-                    savemodel='none'):
+                    savemodel='none', datacolumn='corrected', automask=None, previous_image=None,
+                    noise_mask=''):
     """
     *** Adapted from reduction_utils.py, by the DSHARP Large Program
     Wrapper for tclean with keywords set to values we desire for self calibration.
@@ -66,12 +74,26 @@ def tclean_wrapper(vis, imagename, smallscalebias=0.6, mask='', contspws='',
         exportfits
 
     Args:
+        vis (string or list): Measurement set(s) to image; a virtual MS (.vms) is imaged from its members
+        automask (dictionary): If given, clean non-interactively (interactive and threshold are ignored)
+            with a mask and threshold derived as in automask.py, e.g. mask_dict['continuum automask']
+        previous_image (string): For automask: imagename of the previous image of these data, if any
+        noise_mask (string): For automask: annulus to measure image rms, in the CASA region format
         See the CASA 6.2.1.7 documentation for tclean to get the definitions of all other parameters
     """
+    if is_virtual(vis):
+        vis = members_of(vis)
 
-    for ext in ['.image', '.mask', '.model', '.pb', '.psf', '.residual', '.sumwt']:
+    for ext in ['.image', '.mask', '.model', '.pb', '.psf', '.residual', '.sumwt', '.automask']:
         os.system('rm -rf '+ imagename + ext)
 
+    masking = {'usemask': 'user', 'mask': mask, 'threshold': threshold, 'nsigma': 0.}
+    if automask is not None:
+        interactive = False
+        masking = automask_tclean_args(imagename, automask, mask=mask, previous_image=previous_image,
+                                       noise_mask=noise_mask)
+        print("Cleaning "+imagename+" non-interactively: ", masking)
+
     tclean(vis              = vis, # msfile to image
            imagename        = imagename, # file names preceding .image, .residual, etc.
            specmode         = 'mfs', # to make a continuum image
@@ -81,10 +103,9 @@ def tclean_wrapper(vis, imagename, smallscalebias=0.6, mask='', contspws='',
            robust           = robust,
            imsize           = imsize,
            cell             = cellsize,
-           mask             = mask,
            spw              = contspws,
+           datacolumn       = datacolumn, # 'corrected' (tclean's default) falls back on 'data' if there is no CORRECTED column
            niter            = niter, # we want to end on the threshold
-           threshold        = threshold,
            interactive      = interactive,
            cycleniter       = cycleniter,
            cyclefactor      = 1,
@@ -92,7 +113,8 @@ def tclean_wrapper(vis, imagename, smallscalebias=0.6, mask='', contspws='',
            gain             = gain,
            nterms           = 1, # Number of Taylor coefficients in the spectral model; nterms=1 : Assume flat spectrum source
            uvtaper          = uvtaper,
-           savemodel        = savemodel) # VERY IMPORTANT ARG FOR SELF-CALIBRATION! MUST BE SET TO 'modelcolumn'
+           savemodel        = savemodel, # VERY IMPORTANT ARG FOR SELF-CALIBRATION! MUST BE SET TO 'modelcolumn'
+           **masking) # mask, usemask, threshold, nsigma (and the auto-multithresh parameters)
 
     os.system('rm -rf '+ imagename+'.fits')
     exportfits(imagename+'.image', imagename+'.fits')
@@ -117,8 +139,8 @@ def estimate_image_metrics(imagename, disk_mask, noise_mask):
     Return and print estimates for: beam dimensions, flux inside disk mask, peak intensity,
         rms noise, and peak SNR. Helpful for determining whether to continue with further rounds
         of self-calibration.
-    CASA tasks used:
-        imhead, imstat
+    All metrics come from a single read of the image (see image_metrics.py),
+    rather than from imhead and two imstat calls.
 
     Args:
         imagename: Image name ending in '.image' (string)
@@ -130,83 +152,325 @@ def estimate_image_metrics(imagename, disk_mask, noise_mask):
                               beampa (deg), disk_flux (mJy), peak_intensity (mJy/beam),
                               rms (microJy/beam), SNR
     """
-    headerlist  = imhead(imagename, mode = 'list')
-    beammajor   = headerlist['beammajor']['value']
-    beamminor   = headerlist['beamminor']['value']
-    beampa      = headerlist['beampa']['value']
+    metrics     = measure_image(imagename, disk_mask=disk_mask, noise_mask=noise_mask) # one read of the image
+    beammajor   = metrics['beammajor']
+    beamminor   = metrics['beamminor']
+    beampa      = metrics['beampa']
     print("# %s" % imagename)
     print("# Beam %.3f arcsec x %.3f arcsec (%.2f deg)" %(beammajor, beamminor, beampa))
 
-    disk_stats  = imstat(imagename = imagename, region = disk_mask)
-    disk_flux   = disk_stats['flux'][0]
+    disk_flux   = metrics['disk_flux']
     print("# Flux inside disk mask: %.2f mJy" %(disk_flux*1000))
 
-    peak_intensity = disk_stats['max'][0]
+    peak_intensity = metrics['peak_intensity']
     print("# Peak intensity of source: %.2f mJy/beam" %(peak_intensity*1000))
 
-    rms = imstat(imagename = imagename, region = noise_mask)['rms'][0]
+    rms = metrics['rms']
     print("# rms: %.2f microJy/beam" %(rms*1e6))
 
-    SNR = peak_intensity/rms
+    SNR = metrics['SNR']
     print("# Peak SNR: %.2f" %(SNR))
 
     image_metrics = [beammajor, beamminor, beampa, disk_flux*1e3, peak_intensity*1e3, rms*1e6, SNR]
 
     return image_metrics
 
+# Memoized caltable columns, keyed by caltable path: {caltable: (fingerprint, columns)}
+_caltable_cache = {}
+
+def read_caltable(caltable=None):
+    """
+    Reads the columns of a caltable that the gain solution plots need, with the table
+    tool (not plotms, so it's safe in the workers of render_gaincal_solutions). The result
+    is memoized per caltable, and re-read only if the caltable changed on disk.
+
+    Args:
+        caltable (string): The caltable you wish to read.
+    Returns:
+        columns (dictionary): 'TIME', 'ANTENNA1', 'SPECTRAL_WINDOW_ID', 'OBSERVATION_ID',
+            'FIELD_ID', 'SCAN_NUMBER' ([nrow] arrays), 'CPARAM', 'SNR', 'FLAG' ([npol, nchan, nrow]
+            arrays), and the 'ANTENNA_NAME' and 'FIELD_NAME' of the antenna and field ids
+    """
+    import casatools
+    if caltable is None:
+        raise ValueError('You need to specify a caltable')
+
+    key         = os.path.abspath(caltable)
+    fingerprint = _ms_fingerprint(caltable)
+    if (key in _caltable_cache) and (_caltable_cache[key][0]==fingerprint):
+        return _caltable_cache[key][1]
+
+    caltb   = casatools.table()
+    columns = {}
+    caltb.open(caltable)
+    for column in ['TIME', 'ANTENNA1', 'SPECTRAL_WINDOW_ID', 'OBSERVATION_ID', 'FIELD_ID', 'SCAN_NUMBER', 'CPARAM', 'SNR', 'FLAG']:
+        columns[column] = caltb.getcol(column)
+    caltb.close()
+    for subtable in ['ANTENNA', 'FIELD']:
+        caltb.open(caltable+'/'+subtable)
+        columns[subtable+'_NAME'] = caltb.getcol('NAME')
+        caltb.close()
+
+    _caltable_cache[key] = (fingerprint, columns)
+    return columns
+
+
+def _select_ids(selection, names=None):
+    """ The ids of a comma-separated selection of ids (or, given the names of the ids, of names). """
+    ids = []
+    for item in selection.split(','):
+        item = item.strip()
+        if item.isdigit():
+            ids.append(int(item))
+        elif (names is not None) and (item in list(names)):
+            ids.append(list(names).index(item))
+        else:
+            raise ValueError('Cannot select '+item+' in the caltable')
+    return ids
+
+
 def retrieve_from_caltable(caltable=None, xaxis='time', yaxis='phase', spw='',
                             observation='0', field='', timerange='', antenna='',
                             uvrange='', intent='', scan='', correlation=''):
     """
-    Retrieves 2 columns from a caltable (those specified by xaxis and yaxis)
-    using plotms(plotfile='something.txt') and subsequently sourcing the values
-    from the something.txt file. It's a hack but it works. (CASA's 'calanalysis'
-    is an alternative method, but the dictionaries are hard to interpret.)
+    Retrieves 2 columns from a caltable (those specified by xaxis and yaxis), one
+    value per unflagged solution (polarization, channel and row), as plotms would
+    plot them. The caltable is read with the table tool (see read_caltable), so this
+    no longer goes through plotms(plotfile='something.txt'), and several figures can
+    be made at once (see render_gaincal_solutions).
 
     Args:
         caltable (string): The caltable from you wish to retrieve the data.
-        xaxis (string): The first column you wish to retrieve.
-        yaxis (string): The second column you wish to retrieve.
-        All other arguments are like CASA's plotms.
+        xaxis (string): The first column you wish to retrieve: 'time' or 'antenna1'
+        yaxis (string): The second column you wish to retrieve: 'phase' (degrees), 'amp' or 'SNR'
+        spw, observation, field, antenna, scan (string): Selections, as comma-separated
+            ids (or names, for field and antenna), like CASA's plotms.
+        timerange, uvrange, intent, correlation: Not supported (must be '').
     Returns:
         xaxis (array): 1D array of the caltable column specified by xaxis
             input arg. Possibilities are only: 'time' or 'ant1'
         yaxis (array): 1D array of the caltable column specified by yaxis
             input arg.
-        xaxis_str (array): 1D array of the antenna1 column of the caltable.
+        xaxis_str (array): 1D array of the antenna1 (names) column of the caltable.
             Ignore if xaxis='time'
     """
     if caltable is None:
         raise ValueError('You need to specify a caltable')
+    if (xaxis!='time') & (xaxis!='antenna1'):
+        raise ValueError("Sorry, you can't retrieve "+xaxis+" with 'retrieve_from_caltable'.")
+    if (yaxis!='phase') & (yaxis!='amp') & (yaxis!='SNR'):
+        raise ValueError("Sorry, you can't retrieve "+yaxis+" with 'retrieve_from_caltable'.")
+    if (timerange!='') or (uvrange!='') or (intent!='') or (correlation!=''):
+        raise ValueError("Sorry, 'retrieve_from_caltable' can't select on timerange, uvrange, intent or correlation.")
+    columns = read_caltable(caltable)
+
+    rows = np.ones(len(columns['TIME']), dtype=bool)
+    for selection, column, names in [(spw, 'SPECTRAL_WINDOW_ID', None), (observation, 'OBSERVATION_ID', None),
+                                     (field, 'FIELD_ID', columns['FIELD_NAME']), (antenna, 'ANTENNA1', columns['ANTENNA_NAME']),
+                                     (scan, 'SCAN_NUMBER', None)]:
+        if selection!='':
+            rows &= np.isin(columns[column], _select_ids(selection, names))
+
+    if yaxis=='phase':
+        values = np.degrees(np.angle(columns['CPARAM'][:,:,rows]))
+    elif yaxis=='amp':
+        values = np.abs(columns['CPARAM'][:,:,rows])
+    else:
+        values = columns['SNR'][:,:,rows]
+    good    = ~columns['FLAG'][:,:,rows] # [npol, nchan, nrow]
+    irow    = np.broadcast_to(np.flatnonzero(rows), good.shape)[good]
+    yaxis   = values[good]
 
-    plotms(vis=caltable, xaxis=xaxis, yaxis=yaxis, spw=spw, observation=observation,
-            field=field, timerange=timerange, antenna=antenna, uvrange=uvrange,
-            intent=intent, scan=scan, correlation=correlation,
-            plotfile='temporary_file_for_retrieve_from_caltable.txt',
-            showgui=False, overwrite=True)
-
+    ant1      = columns['ANTENNA1'][irow]
+    xaxis_str = columns['ANTENNA_NAME'][ant1]
     if xaxis=='time':
-        caltable_txt = np.loadtxt('temporary_file_for_retrieve_from_caltable.txt',
-                                comments='#', usecols=(1,9))
-        xaxis = caltable_txt[:,1]
-        yaxis = caltable_txt[:,0]
+        xaxis = columns['TIME'][irow]
+    else:
+        xaxis = ant1
 
-    elif xaxis=='antenna1':
-        xaxis = np.loadtxt('temporary_file_for_retrieve_from_caltable.txt',
-                                comments='#', usecols=(5))
-        yaxis = np.loadtxt('temporary_file_for_retrieve_from_caltable.txt',
-                                comments='#', usecols=(1))
-    xaxis_str = np.loadtxt('temporary_file_for_retrieve_from_caltable.txt',
-                            comments='#', usecols=(7), dtype=type(''))
+    return xaxis, yaxis, xaxis_str
 
-    os.system('rm temporary_file_for_retrieve_from_caltable.txt')
 
-    return xaxis, yaxis, xaxis_str
+def _grouped_sums(inverse, ngroups, values, circular=False, shift=0.):
+    """
+    The sums from which the moments of values within groups follow (see _moments),
+    given the group index of each value (inverse, from np.unique(..., return_inverse=True)).
+    One np.bincount per sum, so the cost is linear in the number of values.
+    If circular, the sums of the cosines and sines of the angles (in degrees); otherwise
+    the sums of values-shift and of its square (shift, e.g. the overall mean, keeps the
+    variance accurate).
+    """
+    counts = np.bincount(inverse, minlength=ngroups)
+    if circular:
+        rad = np.radians(values)
+        return counts, np.bincount(inverse, weights=np.cos(rad), minlength=ngroups), np.bincount(inverse, weights=np.sin(rad), minlength=ngroups)
+    return counts, np.bincount(inverse, weights=values-shift, minlength=ngroups), np.bincount(inverse, weights=(values-shift)**2, minlength=ngroups)
+
+
+def _moments(counts, sum1, sum2, circular=False, shift=0.):
+    """
+    Mean and standard deviation in each group, from the sums of _grouped_sums.
+    If circular, the circular mean and circular standard deviation (so phases near
+    +/-180 don't average to 0).
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if circular:
+            C    = sum1/counts
+            S    = sum2/counts
+            mean = np.degrees(np.arctan2(S, C))
+            R    = np.clip(np.hypot(C, S), 1e-300, 1.)
+            std  = np.degrees(np.sqrt(-2.*np.log(R)))
+        else:
+            mean = sum1/counts
+            std  = np.sqrt(np.clip(sum2/counts - mean**2, 0., None))
+            mean = mean + shift
+    return mean, std
+
+
+def grouped_reduce(keys, values, circular=False):
+    """
+    Averages values that share the same key, e.g. gain solutions of all antennas
+    at each solution time. Given several key sets (e.g. [time, antenna, spw]), the
+    values are grouped once, by all the keys together, and the reduction over each
+    key set is summed up from those groups, so one pass gives all of them.
+
+    Args:
+        keys (array or list): 1D array of group labels (times, antenna names, spws, ...),
+            or a list of such arrays, which must then be numeric (times, antenna ids, spw ids)
+        values (array): 1D array of values, same length as keys
+        circular (bool): If True, values are phases in degrees and are averaged on the circle
+    Returns:
+        groups (array): The unique keys, sorted
+        mean (array): Mean of the values in each group
+        std (array): Standard deviation of the values in each group
+        counts (array): Number of values in each group
+        (one such tuple per key set, in a list, if keys is a list)
+    """
+    values = np.asarray(values, dtype='float64')
+    shift  = 0. if (circular or len(values)==0) else np.mean(values)
+    if not isinstance(keys, (list, tuple)):
+        groups, inverse = np.unique(keys, return_inverse=True)
+        counts, sum1, sum2 = _grouped_sums(inverse.ravel(), len(groups), values, circular=circular, shift=shift)
+        return (groups,) + _moments(counts, sum1, sum2, circular=circular, shift=shift) + (counts,)
+
+    combined = np.stack([np.asarray(key, dtype='float64') for key in keys], axis=1)
+    fine, inverse = np.unique(combined, axis=0, return_inverse=True) # the only pass over all the values
+    fine_sums = _grouped_sums(inverse.ravel(), len(fine), values, circular=circular, shift=shift)
+    reductions = []
+    for k in range(len(keys)):
+        groups, fine_to_group = np.unique(fine[:,k], return_inverse=True) # over the groups, not the values
+        counts, sum1, sum2 = [np.bincount(fine_to_group.ravel(), weights=fine_sum, minlength=len(groups)) for fine_sum in fine_sums]
+        counts = counts.astype('int64')
+        reductions.append((groups,) + _moments(counts, sum1, sum2, circular=circular, shift=shift) + (counts,))
+    return reductions
+
+
+def summarize_gaincal_solutions(time, values, antennas=None, spws=None, quantity='phase'):
+    """
+    Per-timestamp, per-antenna and per-spw aggregates of gain solutions, e.g. as
+    returned by retrieve_from_caltable, from one grouped_reduce pass. Phases are
+    averaged on the circle.
+
+    Args:
+        time (array): Solution times
+        values (array): The solutions (phase in degrees, amp or SNR)
+        antennas (array): Optional antenna (ids) of each solution
+        spws (array): Optional spw of each solution
+        quantity (string): 'phase', 'amp' or 'SNR'
+    Returns:
+        summary (dictionary): Keyed by 'time', 'antenna' and 'spw' (the latter two only
+            if given), each a tuple (groups, mean, std, counts) as in grouped_reduce
+    """
+    names = [name for name, keys in [('time', time), ('antenna', antennas), ('spw', spws)] if keys is not None]
+    keys  = [keys for keys in [time, antennas, spws] if keys is not None]
+    return dict(zip(names, grouped_reduce(keys, values, circular=(quantity=='phase'))))
+
+
+def _ms_fingerprint(vis):
+    """ Cheap marker of the on-disk state of a measurement set (or caltable):
+    the latest modification time among its top-level table data files (not table.lock,
+    which merely opening the table rewrites).
+    For a virtual MS, the latest among the manifest and all its members. """
+    if is_virtual(vis):
+        return max([os.path.getmtime(vis)] + [_ms_fingerprint(msfile) for msfile in members_of(vis)])
+    return max([os.path.getmtime(os.path.join(vis, f)) for f in os.listdir(vis) if _is_table_data_file(f)])
+
+
+# Memoized scan boundaries and spws, keyed by measurement set path:
+# {vis: (fingerprint, {obs: (times, num_scans, scans)}, {obs: spws})}
+_scan_times_cache = {}
+
+def get_all_scan_start_and_end_times(vis=None):
+    """
+    Retrieves the start and end times of the scans of every execution block in
+    a measurement set, in a single pass over the main table. The result is
+    memoized per measurement set, and re-read only if the MS changed on disk.
+    The same pass gives the spws of every execution block (see get_observation_spws).
+
+    The rows are grouped by (OBSERVATION_ID, SCAN_NUMBER) with one stable sort,
+    so the first and last row of each group are exactly the first and last
+    rows of that scan in the original table order.
+
+    Args:
+        vis (string): The measurement set (or virtual MS, see virtual_ms.py) whose scans you wish to get.
+    Returns:
+        all_scan_times (dictionary): Keyed by observation index (int). Each entry
+            is a tuple of (scan_start_and_end_times, num_scans, scans), as returned
+            by get_scan_start_and_end_times().
+    """
+    if vis is None:
+        raise ValueError('You need to specify a measurement set')
+
+    key         = os.path.abspath(vis)
+    fingerprint = _ms_fingerprint(vis)
+    if (key in _scan_times_cache) and (_scan_times_cache[key][0]==fingerprint):
+        return _scan_times_cache[key][1]
+
+    scan_col_all, obs_col_all, time_col_all, ddid_col_all = read_columns(vis, ['SCAN_NUMBER', 'OBSERVATION_ID', 'TIME', 'DATA_DESC_ID'])
+
+    # One stable sort on a combined (observation, scan) key keeps the original row order within each scan
+    group_key   = obs_col_all.astype(np.int64)*(int(scan_col_all.max())+1) + scan_col_all
+    order       = np.argsort(group_key, kind='stable')
+    group_key   = group_key[order]
+    time_sorted = time_col_all[order]
+
+    starts      = np.flatnonzero(np.r_[True, group_key[1:]!=group_key[:-1]])
+    ends        = np.r_[starts[1:], len(group_key)] - 1
+    group_obs   = obs_col_all[order][starts]
+    group_scans = scan_col_all[order][starts]
+    group_times = np.stack([time_sorted[starts], time_sorted[ends]], axis=1)
+
+    all_scan_times = {}
+    for obs in np.unique(group_obs):
+        in_obs = (group_obs==obs)
+        all_scan_times[int(obs)] = (group_times[in_obs], int(np.sum(in_obs)), group_scans[in_obs])
+
+    obs_spws = np.unique(np.stack([obs_col_all, ddid_col_all]), axis=1) # sorted by observation, then spw
+    all_spws = {int(obs): obs_spws[1][obs_spws[0]==obs] for obs in np.unique(obs_spws[0])}
+
+    _scan_times_cache[key] = (fingerprint, all_scan_times, all_spws)
+    return all_scan_times
+
+
+def get_observation_spws(vis=None, observation='0'):
+    """
+    The spectral windows (data description ids) of an execution block, from the
+    memoized pass of get_all_scan_start_and_end_times().
+
+    Args:
+        vis (string): The measurement set (or virtual MS).
+        observation (string): Index of the execution block, like CASA's 'observation' parameter.
+    Returns:
+        spws (array): The spws of the execution block, sorted
+    """
+    get_all_scan_start_and_end_times(vis=vis)
+    return _scan_times_cache[os.path.abspath(vis)][2].get(int(observation), np.array([], dtype=int)).copy()
 
 
 def get_scan_start_and_end_times(vis=None, observation='0'):
     """
     Retrieves the start and end times of the scans in an execution block.
+    (A thin wrapper around get_all_scan_start_and_end_times(), which is memoized.)
 
     Args:
         vis (string): The measurement set whose scans you wish to get.
@@ -220,34 +484,21 @@ def get_scan_start_and_end_times(vis=None, observation='0'):
         num_scans (int): The number of scans, for convenience.
         scans (array): A list of the scans, with original index, for convenience.
     """
-    if vis is None:
-        raise ValueError('You need to specify a measurement set')
+    all_scan_times = get_all_scan_start_and_end_times(vis=vis)
+    if int(observation) not in all_scan_times:
+        return np.zeros((0, 2)), 0, np.array([], dtype=int)
 
-    tb.open(vis)
-    scan_col_all    = tb.getcol('SCAN_NUMBER')
-    obs_col_all     = tb.getcol('OBSERVATION_ID')
-    time_col_all    = tb.getcol('TIME')
-    tb.close()
+    scan_start_and_end_times, num_scans, scans = all_scan_times[int(observation)]
 
-    scan_col        = scan_col_all[np.where(obs_col_all==int(observation))]
-    time_col        = time_col_all[np.where(obs_col_all==int(observation))]
-
-    scans           = np.unique(scan_col)
-    num_scans       = len(scans)
-
-    scan_start_and_end_times = np.zeros((num_scans, 2))
-    for i,scan in enumerate(scans):
-        scan_start_and_end_times[i, 0] = time_col[np.where(scan_col==scan)][0]
-        scan_start_and_end_times[i, 1] = time_col[np.where(scan_col==scan)][-1]
-
-    return scan_start_and_end_times, num_scans, scans
+    return scan_start_and_end_times.copy(), num_scans, scans.copy()
 
 
 def plot_gaincal_solutions(caltable=None, parentvis=None, quantity='phase',
                            plot_average_soln=False, solint='120', minsnr=2.5,
                            spw='', observation='0', combine='', field='',
                            timerange='', antenna='', uvrange='', intent='',
-                           scan='', correlation='', calmode='p'):
+                           scan='', correlation='', calmode='p',
+                           dpi=500, draft=False):
     """
     Plots a quantity of the calibration table vs. time and saves the figure.
 
@@ -265,10 +516,15 @@ def plot_gaincal_solutions(caltable=None, parentvis=None, quantity='phase',
             CASA's 'observation' parameter). *NOTE* This must NOT be ''. It must
             be a single observation at a time, purely because otherwise the xaxis
             of the plot will be too stretched to understand.
+        dpi (int): Resolution of the saved figure.
+        draft (bool): If True, a cheap quick-look figure: dpi=100, opaque background,
+            and the scatter layers are rasterized.
         All other arguments are like CASA's plotms and gaincal.
     Returns:
-        Figure (png): Saves the figure to a png file, named from the input args.
+        filename (string): Name of the png file the figure was saved to.
     """
+    if draft:
+        dpi = 100
     if ((quantity!='phase') & (quantity!='amp') & (quantity!='SNR')):
         raise ValueError("Sorry, you can't plot "+quantity+" with 'plot_gaincal_solutions'.")
     if caltable is None:
@@ -285,11 +541,7 @@ def plot_gaincal_solutions(caltable=None, parentvis=None, quantity='phase',
 
     # To be able to plot the solutions with different colours for each spectral window:
     if spw=='':
-        tb.open(parentvis)
-        spw_col = tb.getcol('DATA_DESC_ID')
-        obs_col = tb.getcol('OBSERVATION_ID')
-        tb.close()
-        spws = np.unique(spw_col[np.where(obs_col==int(observation))])
+        spws = get_observation_spws(vis=parentvis, observation=observation)
         print("Spectral windows in EB "+observation+" are:", spws)
     else:
         spws = np.array([int(spw)]) # for plotting purposes; even if there's just 1 spw, we still loop over a list
@@ -328,19 +580,16 @@ def plot_gaincal_solutions(caltable=None, parentvis=None, quantity='phase',
 
         if plot_average_soln:
             time_avg = '_time-averaged'
-            time_points = np.unique(time)
-            quantity_vals_avg = np.zeros_like(time_points)
-            for t, time_point in enumerate(time_points):
-                quantity_vals_avg[t] = np.mean(quantity_vals[np.where(time==time_point)])
+            time_points, quantity_vals_avg, _, _ = summarize_gaincal_solutions(time, quantity_vals, quantity=quantity)['time']
             ax.plot(time_points/60, quantity_vals_avg, markersize=40, lw=1.5, color=colors[spws_reduced[i]], zorder=1000000)
-            ax.scatter(time_points/60, quantity_vals_avg, s=5, color=colors[spws_reduced[i]], zorder=1000000)
+            ax.scatter(time_points/60, quantity_vals_avg, s=5, color=colors[spws_reduced[i]], zorder=1000000, rasterized=draft)
         else:
             time_avg = ''
             if solint!='inf':
                 solint_str = solint.replace('s', '')
                 solint_float = float(solint_str)
-                ax.errorbar(time/60, quantity_vals, xerr=(solint_float/2)/60, linestyle='', lw=0.4, color=colors[spws_reduced[i]])
-            ax.scatter(time/60, quantity_vals, s=5, color=colors[spws_reduced[i]], zorder=1000000)
+                ax.errorbar(time/60, quantity_vals, xerr=(solint_float/2)/60, linestyle='', lw=0.4, color=colors[spws_reduced[i]], rasterized=draft)
+            ax.scatter(time/60, quantity_vals, s=5, color=colors[spws_reduced[i]], zorder=1000000, rasterized=draft)
         ax.text(0.03, 0.925-(i*0.035), 'spw '+str(spw_i)+' ('+str(spws_reduced[i])+')', color=colors[spws_reduced[i]], transform=ax.transAxes, fontsize=15, horizontalalignment='left', verticalalignment='top')
 
     if quantity=='SNR':
@@ -375,16 +624,19 @@ def plot_gaincal_solutions(caltable=None, parentvis=None, quantity='phase',
         filename = caltable+'_'+quantity+'-vs-time_EB'+EB+'_allspws'+time_avg+'.png'
     else:
         filename = caltable+'_'+quantity+'-vs-time_EB'+EB+'_spw'+spw+time_avg+'.png'
-    plt.savefig(filename, dpi=500, transparent=True, bbox_inches='tight',pad_inches=0.015)
-    plt.clf()
+    plt.savefig(filename, dpi=dpi, transparent=(not draft), bbox_inches='tight',pad_inches=0.015)
+    plt.close(fig)
     print("Figure saved! To: "+filename)
 
+    return filename
+
 
 def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='phase',
                            plot_average_soln=False, solint=120, minsnr=2.5,
                            spw='', observation='0', combine='', field='',
                            timerange='', antenna='', uvrange='', intent='',
-                           scan='', correlation='', calmode='p'):
+                           scan='', correlation='', calmode='p',
+                           dpi=500, draft=False):
     """
     Plots a quantity of the calibration table vs. time and saves the figure.
 
@@ -402,10 +654,15 @@ def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='
             CASA's 'observation' parameter). *NOTE* This must NOT be ''. It must
             be a single observation at a time, purely because otherwise the xaxis
             of the plot will be too stretched to understand.
+        dpi (int): Resolution of the saved figure.
+        draft (bool): If True, a cheap quick-look figure: dpi=100, opaque background,
+            and the scatter layers are rasterized.
         All other arguments are like CASA's plotms and gaincal.
     Returns:
-        Figure (png): Saves the figure to a png file, named from the input args.
+        filename (string): Name of the png file the figure was saved to.
     """
+    if draft:
+        dpi = 100
     if ((quantity!='phase') & (quantity!='amp') & (quantity!='SNR')):
         raise ValueError("Sorry, you can't plot "+quantity+" with 'plot_gaincal_solutions'.")
     if caltable is None:
@@ -422,11 +679,7 @@ def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='
 
     # To be able to plot the solutions with different colours for each spectral window:
     if spw=='':
-        tb.open(parentvis)
-        spw_col = tb.getcol('DATA_DESC_ID')
-        obs_col = tb.getcol('OBSERVATION_ID')
-        tb.close()
-        spws = np.unique(spw_col[np.where(obs_col==int(observation))])
+        spws = get_observation_spws(vis=parentvis, observation=observation)
         print("Spectral windows in EB "+observation+" are:", spws)
     else:
         spws = np.array([int(spw)]) # for plotting purposes; even if there's just 1 spw, we still loop over a list
@@ -460,7 +713,7 @@ def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='
     #     ax.axvspan(scan_start_and_end_times[s, 0]/60, scan_start_and_end_times[s, 1]/60, alpha=0.3, color='skyblue')
 
     for i,spw_i in enumerate(spws):
-        antennas, quantity_vals, ant_names = retrieve_from_caltable(caltable=caltable, xaxis='antenna1', yaxis=quantity, spw=str(spw_i),
+        antennas, quantity_vals, _ = retrieve_from_caltable(caltable=caltable, xaxis='antenna1', yaxis=quantity, spw=str(spw_i),
                                     observation=observation, field=field, timerange=timerange, antenna=antenna,
                                     uvrange=uvrange, intent=intent, scan=scan, correlation=correlation)
 
@@ -480,9 +733,10 @@ def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='
         #     solint_str = solint.replace('s', '')
         #     solint = float(solint_str)
         #     ax.errorbar(antennas, quantity_vals, xerr=(solint/2)/60, linestyle='', lw=0.4, color=colors[spws_reduced[i]])
-        ax.scatter(antennas, quantity_vals, s=5, color=colors[spws_reduced[i]], zorder=1000000)
+        ax.scatter(antennas, quantity_vals, s=5, color=colors[spws_reduced[i]], zorder=1000000, rasterized=draft)
         ax.text(0.03, 0.925-(i*0.035), 'spw '+str(spw_i)+' ('+str(spws_reduced[i])+')', color=colors[spws_reduced[i]], transform=ax.transAxes, fontsize=15, horizontalalignment='left', verticalalignment='top')
 
+    ant_names = read_caltable(caltable)['ANTENNA_NAME'] # indexed by antenna id
 
     if quantity=='SNR':
         ax.set_ylim(0, 100)
@@ -522,73 +776,554 @@ def plot_gaincal_solutions_per_antenna(caltable=None, parentvis=None, quantity='
         filename = caltable+'_'+quantity+'-vs-antenna_EB'+EB+'_allspws'+'.png'
     else:
         filename = caltable+'_'+quantity+'-vs-antenna_EB'+EB+'_spw'+spw+'.png'
-    plt.savefig(filename, dpi=500, transparent=True, bbox_inches='tight',pad_inches=0.015)
-    plt.clf()
+    plt.savefig(filename, dpi=dpi, transparent=(not draft), bbox_inches='tight',pad_inches=0.015)
+    plt.close(fig)
     print("Figure saved! To: "+filename)
 
+    return filename
+
+
+def gaincal_plot_specs(caltable, observations, quantities=['phase', 'amp', 'SNR']):
+    """
+    The usual set of diagnostic figures of a caltable, as specs for render_gaincal_solutions:
+    for each EB and quantity, the solutions vs. antenna, vs. time, and time-averaged vs. time.
+
+    Args:
+        caltable (string): The caltable whose solutions you wish to plot.
+        observations (list): The observations (EBs) to plot, as strings, e.g. data_dict['SB_concat']['observations']
+        quantities (list): Any of 'phase', 'amp', 'SNR'.
+    Returns:
+        specs (list): List of (caltable, observation, quantity, avg) tuples
+    """
+    specs = []
+    for observation in observations:
+        for quantity in quantities:
+            for avg in ['antenna', False, True]:
+                specs.append((caltable, observation, quantity, avg))
+    return specs
+
+
+def _render_gaincal_spec(args):
+    """ Worker for render_gaincal_solutions: makes one figure. """
+    spec, kwargs = args
+    caltable, observation, quantity, avg = spec
+    if avg=='antenna':
+        return plot_gaincal_solutions_per_antenna(caltable=caltable, observation=observation,
+                                                  quantity=quantity, **kwargs)
+    return plot_gaincal_solutions(caltable=caltable, observation=observation, quantity=quantity,
+                                  plot_average_soln=avg, **kwargs)
+
+
+def render_gaincal_solutions(specs, parentvis=None, nproc=None, draft=False, dpi=500,
+                             pdfname=None, **kwargs):
+    """
+    Renders many gain solution figures at once (e.g. all those of a round of
+    self-cal), on a pool of worker processes with the Agg backend.
+
+    Args:
+        specs (list): List of (caltable, observation, quantity, avg) tuples, where avg
+            is False/True (solutions vs. time, or time-averaged vs. time) or 'antenna'
+            (solutions vs. antenna). See gaincal_plot_specs.
+        parentvis (string): The measurement set from which the caltables were generated.
+        nproc (int): Number of worker processes. Default: the number of CPUs, at most 8.
+        draft (bool): If True, cheap quick-look figures (see plot_gaincal_solutions)
+        dpi (int): Resolution of the figures when draft=False
+        pdfname (string): If given, all figures are also combined into this multi-page pdf.
+        All other arguments (solint, minsnr, spw, combine, calmode, ...) are passed
+        to plot_gaincal_solutions / plot_gaincal_solutions_per_antenna.
+    Returns:
+        filenames (list): Names of the png files, in the order of specs
+    """
+    if parentvis is None:
+        raise ValueError('You need to specify a measurement set')
+    if nproc is None:
+        nproc = min(8, multiprocessing.cpu_count())
+    kwargs.update(parentvis=parentvis, draft=draft, dpi=dpi)
+    # read the scan times and spws of parentvis and the caltables once, here, so the forked
+    # workers inherit the memoized results: they only render, without any CASA tool or task
+    get_all_scan_start_and_end_times(vis=parentvis)
+    for caltable in sorted(set(spec[0] for spec in specs)):
+        read_caltable(caltable)
+
+    jobs = [(spec, kwargs) for spec in specs]
+    if nproc > 1:
+        # fork, so the workers inherit the memoized tables read above
+        with multiprocessing.get_context('fork').Pool(nproc) as pool:
+            filenames = pool.map(_render_gaincal_spec, jobs, chunksize=1)
+    else:
+        filenames = [_render_gaincal_spec(job) for job in jobs]
+
+    if pdfname is not None:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(pdfname) as pdf:
+            for filename in filenames:
+                img = plt.imread(filename)
+                fig = plt.figure(figsize=(img.shape[1]/100., img.shape[0]/100.), dpi=100)
+                ax = fig.add_axes([0, 0, 1, 1])
+                ax.imshow(img)
+                ax.axis('off')
+                pdf.savefig(fig)
+                plt.close(fig)
+        print("All figures combined into: "+pdfname)
+
+    return filenames
+
+
+def selfcal_round_files(contp0, round_name):
+    """ Names of the caltable, output MS and directory for the .last files of a self-cal round. """
+    outputvis = contp0.replace('p0.ms', round_name+'.ms')
+    return outputvis.replace('.ms', '.cal'), outputvis, outputvis.replace('.ms', '/')
+
+
+def _selfcal_round_hash(previous_hash, *settings):
+    """ md5 of a round's settings, chained to the hash (and products) of the round before it. """
+    import json
+    md5 = hashlib.md5(previous_hash.encode())
+    md5.update(json.dumps(settings, sort_keys=True).encode())
+    return md5.hexdigest()
 
-def export_MS(msfile):
+
+def _read_selfcal_marker(dir4lasts):
+    import json
+    marker = dir4lasts+'selfcal_round.json'
+    if not os.path.exists(marker):
+        return None
+    with open(marker, 'r') as f:
+        return json.load(f)
+
+
+def caltable_checksum(caltable):
+    """
+    Checksum of the contents of a caltable (a few MB), so that merely reading it (the
+    ladder, later rounds' gaincal/applycal, step4's applycal) doesn't make its round stale.
+    """
+    return ms_checksum(caltable, content=True)
+
+
+def selfcal_round_is_complete(contp0, round_name, round_hash, need_outputvis=True):
+    """
+    Whether a self-cal round was completed with exactly these parameters (and inputs):
+    its completion marker exists, holds the same hash, and its caltable and output MS
+    (if it was split out) are still there, the caltable unchanged since.
+    """
+    caltable, outputvis, dir4lasts = selfcal_round_files(contp0, round_name)
+    marker = _read_selfcal_marker(dir4lasts)
+    if (marker is None) or (marker['hash']!=round_hash):
+        return False
+    if not os.path.isdir(caltable) or (need_outputvis and not os.path.isdir(outputvis)):
+        return False
+    return caltable_checksum(caltable)==marker['caltable_checksum']
+
+
+def run_selfcal_round(inputvis, caltable, outputvis, params, imaging, refant, observations,
+                      EB, disk_mask, noise_mask, pretables=None, split_output=True, previous_image=None):
+    """
+    One round of self-cal: gaincal, plots of the solutions, applycal, split, then
+    (interactive) imaging of the result and its image metrics.
+    CASA tasks used:
+        gaincal, applycal, split, tclean, exportfits
+
+    Split-free rounds (pretables given) work on the same MS every round: gaincal
+    pre-applies the caltables of the previous rounds, applycal applies the whole
+    chain to the CORRECTED column, and that is imaged directly. Only if split_output
+    is a copy split out to outputvis (a checkpoint).
+
+    Args:
+        inputvis (string): MS to self-calibrate (with the model column of the previous round)
+        caltable, outputvis (string): Names of the caltable and self-calibrated MS
+        params (dictionary): Parameters of gaincal and applycal (see dictionary_selfcal.py)
+        imaging (dictionary): Arguments for tclean_wrapper (imsize, cellsize, robust, mask, ...)
+        refant (string): Reference antennas
+        observations (list): Observation IDs of the EBs in inputvis, for the plots
+        EB (string): Name of the MS in selfcal_dict, e.g. 'SB_concat'
+        disk_mask, noise_mask (string): Regions for estimate_image_metrics
+        pretables (dictionary): For a split-free round, the caltables of the previous rounds
+            and their spwmaps and interps: {'gaintable': [...], 'spwmap': [...], 'interp': [...]}
+        split_output (bool): Whether to split the self-calibrated data out to outputvis
+        previous_image (string): imagename of the previous round, to derive the mask from if imaging has an automask
+    Returns:
+        image_metrics (list): As from estimate_image_metrics
+    """
+    dir4lasts = outputvis.replace('.ms', '/')
+    os.system('mkdir '+dir4lasts)
+    split_free = pretables is not None
+    if not split_free:
+        pretables = {'gaintable': [], 'spwmap': [], 'interp': []}
+
+    """ Generate the solutions """
+    os.system('rm -rf ' + caltable)
+    gaincal(vis=inputvis, caltable=caltable, gaintype=params['gaintype'], spw=params['spw'], refant=refant,
+            calmode=params['calmode'], combine=params['combine'], solint=params['solint'], minsnr=params['minsnr'],
+            minblperant=params['minblperant'], solnorm=params['solnorm'],
+            gaintable=pretables['gaintable'], spwmap=pretables['spwmap'], interp=pretables['interp'])
+    render_gaincal_solutions(gaincal_plot_specs(caltable, observations), parentvis=inputvis,
+                             solint=params['solint'], minsnr=params['minsnr'], spw=params['spw'],
+                             combine=params['combine'], calmode=params['calmode'],
+                             pdfname=caltable+'_solutions.pdf')
+
+    """ Apply the solutions (split-free: all of them so far, from the DATA column) """
+    if split_free:
+        applycal(vis=inputvis, spw=params['spw'], gaintable=pretables['gaintable']+[caltable],
+                 interp=pretables['interp']+[params['interp']], applymode=params['applymode'],
+                 calwt=params['calwt'], spwmap=pretables['spwmap']+[params['spwmap']])
+    else:
+        applycal(vis=inputvis, spw=params['spw'], gaintable=[caltable], interp=params['interp'],
+                 applymode=params['applymode'], calwt=params['calwt'], spwmap=params['spwmap'])
+    if split_output:
+        os.system('rm -rf ' + outputvis)
+        split(vis=inputvis, outputvis=outputvis, datacolumn='corrected')
+
+    """ Image the results; check the resulting map """
+    # save the result to the model column, for the next round
+    if split_free:
+        tclean_wrapper(vis=inputvis, imagename=outputvis.replace('.ms', ''), savemodel='modelcolumn',
+                       datacolumn='corrected', previous_image=previous_image, noise_mask=noise_mask, **imaging)
+    else:
+        tclean_wrapper(vis=outputvis, imagename=outputvis.replace('.ms', ''), savemodel='modelcolumn',
+                       previous_image=previous_image, noise_mask=noise_mask, **imaging)
+
+    image_metrics = estimate_image_metrics(imagename=outputvis.replace('.ms', '.fits'),
+                                           disk_mask=disk_mask, noise_mask=noise_mask)
+    selfcal_dict  = update_selfcal_dict(save_dir=dir4lasts, EB=EB, image_metrics=image_metrics)
+    print("selfcal_dict: ", selfcal_dict)
+    os.system('mv *.last '+dir4lasts)
+
+    return image_metrics
+
+
+def run_selfcal_schedule(contp0, EB, schedule, refant, observations, mask, noise_mask,
+                         disk_mask=None, defaults=None, imaging=None, force_from=None,
+                         split_free=False, checkpoints=None, automask=None):
+    """
+    Runs a schedule of self-cal rounds (see dictionary_selfcal.py), resuming from the
+    first stale round. Each completed round leaves a marker, dir4lasts/selfcal_round.json,
+    with a hash of its parameters chained to the hash and caltable of the round before it.
+    A round is skipped if its marker matches; otherwise it and all the rounds after it are rerun.
+
+    With split_free=True, all rounds work on contp0 itself (see run_selfcal_round): the
+    caltables are chained, the CORRECTED column is imaged, and only the rounds in
+    checkpoints are split out to their contpN.ms. Per round, that writes the caltable and
+    the images instead of a copy of the whole MS.
+
+    With an automask (e.g. mask_dict['continuum automask']), the rounds are imaged
+    non-interactively, each with a mask and threshold derived from the image of the
+    round before it (see automask.py), so a whole schedule can run unattended.
+
+    Args:
+        contp0 (string): The MS before self-cal, ending in 'p0.ms'
+        EB (string): Name of the MS in selfcal_dict, e.g. 'SB_concat'
+        schedule (dictionary): {'imaging': {...}, 'rounds': [{'round': 'p1', ...}, ...]},
+            e.g. selfcal_schedule['SB_concat'] from dictionary_selfcal.py
+        refant (string): Reference antennas
+        observations (list): Observation IDs of the EBs, for the plots
+        mask (string): Clean mask
+        noise_mask (string): Region (annulus) in which to measure the rms
+        disk_mask (string): Region in which to measure flux and peak. Default: mask
+        defaults (dictionary): Parameters of rounds that don't set them. Default: selfcal_round_defaults
+        imaging (dictionary): More arguments for tclean_wrapper, on top of those of the schedule
+        force_from (string): Rerun from this round (e.g. 'p3') even if it is up to date
+        split_free (bool): Run the rounds without splitting (see above)
+        checkpoints (list): Split-free only: rounds to split out, e.g. ['p6', 'ap']. Default: the last round
+        automask (dictionary): Clean non-interactively, see tclean_wrapper. Default: interactive
+    Returns:
+        all_metrics (dictionary): Image metrics of every round, keyed by round name
+    """
+    import json, time
+    if defaults is None:
+        from dictionary_selfcal import selfcal_round_defaults as defaults
+    if disk_mask is None:
+        disk_mask = mask
+    imaging_args = {'mask': mask, 'gain': 0.05, 'contspws': '', 'threshold': '0mJy', 'interactive': True}
+    imaging_args.update(schedule['imaging'])
+    if imaging is not None:
+        imaging_args.update(imaging)
+    if automask is not None:
+        imaging_args['automask'] = automask
+
+    if split_free:
+        if checkpoints is None:
+            checkpoints = [schedule['rounds'][-1]['round']]
+        previous_hash = _selfcal_round_hash(os.path.abspath(contp0), refant, imaging_args, 'split_free')
+        pretables     = {'gaintable': [], 'spwmap': [], 'interp': []}
+        statefile     = contp0.replace('.ms', '_selfcal_model.json') # which round's model is in the MODEL column
+    else:
+        checkpoints   = [spec['round'] for spec in schedule['rounds']]
+        previous_hash = _selfcal_round_hash(os.path.abspath(contp0), refant, imaging_args)
+        pretables     = None
+    inputvis      = contp0
+    stale         = False
+    all_metrics   = {}
+    previous_spec = None
+    images        = [contp0.replace('.ms', '')] # of the rounds so far, for the automask
+    for spec in schedule['rounds']:
+        round_name = spec['round']
+        params     = dict(defaults)
+        params.update({key: value for key, value in spec.items() if key!='round'})
+        caltable, outputvis, dir4lasts = selfcal_round_files(contp0, round_name)
+        round_hash = _selfcal_round_hash(previous_hash, params, refant)
+
+        stale = stale or (round_name==force_from) or not selfcal_round_is_complete(contp0, round_name, round_hash,
+                                                                                 need_outputvis=(round_name in checkpoints))
+        if not stale:
+            print("Self-cal round "+round_name+" of "+EB+" is up to date; skipping")
+            all_metrics[round_name] = _read_selfcal_marker(dir4lasts)['image_metrics']
+        else:
+            print("################ SELF-CAL ROUND "+round_name+" OF "+EB+" ################")
+            os.system('rm -f '+dir4lasts+'selfcal_round.json') # so a crash half-way leaves the round stale
+            if split_free:
+                _restore_selfcal_model(statefile, previous_hash, contp0, previous_spec, pretables, imaging_args,
+                                       noise_mask, images[-2] if len(images) > 1 else None)
+            image_metrics = run_selfcal_round(inputvis, caltable, outputvis, params, imaging_args, refant,
+                                              observations, EB, disk_mask, noise_mask, pretables=pretables,
+                                              split_output=(round_name in checkpoints), previous_image=images[-1])
+            all_metrics[round_name] = [float(x) for x in image_metrics]
+            marker = {'hash': round_hash, 'caltable_checksum': caltable_checksum(caltable),
+                      'params': params, 'image_metrics': all_metrics[round_name],
+                      'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+            with open(dir4lasts+'selfcal_round.json', 'w') as f:
+                json.dump(marker, f, indent=4)
+
+        previous_hash = round_hash + _read_selfcal_marker(dir4lasts)['caltable_checksum']
+        previous_spec = params
+        previous_spec['round'] = round_name
+        images.append(outputvis.replace('.ms', ''))
+        if split_free:
+            if stale:
+                with open(statefile, 'w') as f:
+                    json.dump({'model_of': previous_hash}, f)
+            pretables['gaintable'].append(caltable)
+            pretables['spwmap'].append(params['spwmap'])
+            pretables['interp'].append(params['interp'])
+        else:
+            inputvis = outputvis
+
+    return all_metrics
+
+
+def _restore_selfcal_model(statefile, previous_hash, contp0, previous_params, pretables, imaging_args,
+                           noise_mask, previous_image):
+    """
+    Split-free rounds share the MODEL column of contp0. When resuming, it may hold the
+    model of another round than the one before the round about to run (e.g. from a later
+    round of an earlier run): then re-apply the caltables so far and re-make that model.
+    Before the first round (previous_params=None) that's the model of contp0 itself, made
+    from its DATA column; no statefile yet means no round has touched the MODEL column
+    since step3 made it.
+    """
+    import json
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            if json.load(f)['model_of']==previous_hash:
+                return
+    elif previous_params is None:
+        return
+    if previous_params is None:
+        print("The MODEL column of "+contp0+" is not that of "+contp0+" itself; re-making it")
+        tclean_wrapper(vis=contp0, imagename=contp0.replace('.ms', ''), savemodel='modelcolumn', datacolumn='data',
+                       previous_image=None, noise_mask=noise_mask, **imaging_args)
+    else:
+        print("The MODEL column of "+contp0+" is not that of round "+previous_params['round']+"; re-making it")
+        applycal(vis=contp0, spw=previous_params['spw'], gaintable=pretables['gaintable'], interp=pretables['interp'],
+                 applymode=previous_params['applymode'], calwt=previous_params['calwt'], spwmap=pretables['spwmap'])
+        tclean_wrapper(vis=contp0, imagename=selfcal_round_files(contp0, previous_params['round'])[1].replace('.ms', ''),
+                       savemodel='modelcolumn', datacolumn='corrected', previous_image=previous_image,
+                       noise_mask=noise_mask, **imaging_args)
+    with open(statefile, 'w') as f:
+        json.dump({'model_of': previous_hash}, f)
+
+
+def caltable_flagged_fraction(caltable):
+    """
+    Fraction of the solutions in a caltable that are flagged, e.g. by gaincal for
+    having SNR < minsnr (the "N of M solutions flagged" messages, summed up).
+    """
+    flag, = read_columns(caltable, ['FLAG'])
+    return float(np.sum(flag))/flag.size
+
+
+def _solint_seconds(solint):
+    return float(solint.strip().rstrip('s'))
+
+
+def halve_solint(solint, vis=None):
+    """
+    Half of a solint, as a string in seconds. solint='inf' stands for a scan, so
+    its half is half the median scan length in vis.
+    """
+    if solint=='inf':
+        if vis is None:
+            raise ValueError("You need to specify a measurement set to halve solint='inf'")
+        scan_lengths = np.concatenate([times[:,1]-times[:,0] for times, _, _ in get_all_scan_start_and_end_times(vis).values()])
+        return '%gs' % np.round(np.median(scan_lengths)/2.)
+    return '%gs' % np.round(_solint_seconds(solint)/2.)
+
+
+def run_solint_ladder(contp0, EB, ladder, refant, observations, mask, noise_mask,
+                      baseline_metrics=None, disk_mask=None, split_free=False, automask=None):
+    """
+    Adaptive version of a schedule of phase-only self-cal rounds: starting from
+    ladder['first_round'], every next round halves solint, for as long as the peak
+    SNR keeps improving by more than ladder['min_snr_gain'] (fractional) and the
+    fraction of flagged solutions stays below ladder['max_flagged']. The first round
+    that fails either test is discarded, and the ladder stops.
+    Rounds are run by run_selfcal_schedule, so a rerun resumes where it stopped.
+    All rounds use the parameters of the first round (combine, spwmap, ...), bar solint.
+
+    Args:
+        contp0, EB, refant, observations, mask, noise_mask, disk_mask, split_free, automask: As in run_selfcal_schedule
+            (split-free, none of the rounds is split out)
+        ladder (dictionary): {'imaging': {...}, 'first_round': {...}, 'min_snr_gain': 0.01,
+            'max_flagged': 0.1, 'min_solint': '6.05s', 'max_rounds': 8}, see dictionary_selfcal.py
+        baseline_metrics (list): Image metrics of contp0 (estimate_image_metrics), to judge the first round.
+            Default: the first round only has to pass the flagged fraction test
+    Returns:
+        rounds (list): The accepted rounds, to put in front of e.g. an amplitude round in a schedule
+        history (list): (round, solint, peak SNR, flagged fraction, accepted) for every round run
+    """
+    min_snr_gain = ladder.get('min_snr_gain', 0.01)
+    max_flagged  = ladder.get('max_flagged', 0.1)
+    min_solint   = _solint_seconds(ladder.get('min_solint', '6.05s')) # integration time: the shortest possible solint
+    max_rounds   = ladder.get('max_rounds', 8)
+
+    previous_snr = None if baseline_metrics is None else baseline_metrics[6]
+    rounds, history = [], []
+    spec = dict(ladder['first_round'])
+    while True:
+        spec['round'] = 'p%d' % (len(rounds)+1)
+        metrics  = run_selfcal_schedule(contp0, EB, {'imaging': ladder['imaging'], 'rounds': rounds+[spec]},
+                                        refant, observations, mask, noise_mask, disk_mask=disk_mask,
+                                        split_free=split_free, checkpoints=[], automask=automask)
+        snr      = metrics[spec['round']][6]
+        flagged  = caltable_flagged_fraction(selfcal_round_files(contp0, spec['round'])[0])
+        improved = (previous_snr is None) or (snr > previous_snr*(1.+min_snr_gain))
+        accepted = bool(improved and (flagged <= max_flagged))
+        history.append((spec['round'], spec['solint'], snr, flagged, accepted))
+        print("Round %s (solint=%s): peak SNR %.1f, %.1f%% of solutions flagged -> %s"
+              % (spec['round'], spec['solint'], snr, 100.*flagged, 'keep' if accepted else 'discard, and stop'))
+        if not accepted:
+            break
+        rounds.append(dict(spec))
+        previous_snr = snr
+
+        spec['solint'] = halve_solint(spec['solint'], vis=contp0) # same scans in every round; and split-free rounds write no MS
+        if (_solint_seconds(spec['solint']) < min_solint) or (len(rounds) >= max_rounds):
+            print("Reached the shortest solint (or the most rounds) allowed; stopping")
+            break
+
+    print("Solint ladder of "+EB+" kept rounds: ", [(r['round'], r['solint']) for r in rounds])
+    return rounds, history
+
+
+def export_MS(msfile, chunksize=500000, legacy_npz=False):
     """
     *** Adapted from reduction_utils.py, by the DSHARP Large Program (Jane Huang)
-    Spectrally averages visibilities to a single channel per SPW and exports to .npz file
+    Spectrally averages visibilities to a single channel per SPW and exports them to
+    a memory-mappable visibility store, MS_filename.vis/ (see vis_store.py). The MS
+    is streamed in chunks of rows, so this no longer needs the whole MS in memory.
 
-    msfile: Name of CASA measurement set, ending in '.ms' (string)
+    Args:
+        msfile (string): Name of CASA measurement set, ending in '.ms', or of a virtual MS ('.vms')
+        chunksize (int): Number of rows read from the MS at a time
+        legacy_npz (bool): If True, also write the old MS_filename.vis.npz file
+    Returns:
+        storename (string): Name of the visibility store
     """
     filename = msfile
-    if filename[-3:]!='.ms':
+    if is_virtual(filename):
+        # a virtual MS is exported member by member (see vis_store.py)
+        MS_filename = filename[:-4]
+    elif filename[-3:]!='.ms':
         print("MS name must end in '.ms'")
         return
-    # strip off the '.ms'
-    MS_filename = filename.replace('.ms', '')
-
-    # get information about spectral windows
-    tb.open(MS_filename+'.ms/SPECTRAL_WINDOW')
-    num_chan = tb.getcol('NUM_CHAN').tolist()
-    tb.close()
-
-    # spectral averaging (1 channel per SPW)
-    os.system('rm -rf %s' % MS_filename+'_spavg.ms')
-    split(vis=MS_filename+'.ms', width=num_chan, datacolumn='data',
-    outputvis=MS_filename+'_spavg.ms')
-
-    # get the data tables
-    tb.open(MS_filename+'_spavg.ms')
-    data   = np.squeeze(tb.getcol("DATA"))
-    flag   = np.squeeze(tb.getcol("FLAG"))
-    uvw    = tb.getcol("UVW")
-    weight = tb.getcol("WEIGHT")
-    spwid  = tb.getcol("DATA_DESC_ID")
-    tb.close()
-
-    # get frequency information
-    tb.open(MS_filename+'_spavg.ms/SPECTRAL_WINDOW')
-    freqlist = np.squeeze(tb.getcol("CHAN_FREQ"))
-    tb.close()
-
-    # get rid of any flagged columns
-    good   = np.squeeze(np.any(flag, axis=0)==False)
-    data   = data[:,good]
-    weight = weight[:,good]
-    uvw    = uvw[:,good]
-    spwid = spwid[good]
-
-    # compute spatial frequencies in lambda units
-    get_freq = lambda ispw: freqlist[ispw]
-    freqs = get_freq(spwid) #get spectral frequency corresponding to each datapoint
-    u = uvw[0,:] * freqs / 2.9979e8
-    v = uvw[1,:] * freqs / 2.9979e8
-
-    #average the polarizations
-    Re  = np.sum(data.real*weight, axis=0) / np.sum(weight, axis=0)
-    Im  = np.sum(data.imag*weight, axis=0) / np.sum(weight, axis=0)
-    Vis = Re + 1j*Im
-    Wgt = np.sum(weight, axis=0)
-
-    #output to npz file and delete intermediate measurement set
-    os.system('rm -rf %s' % MS_filename+'_spavg.ms')
-    os.system('rm -rf '+MS_filename+'.vis.npz')
-    np.savez(MS_filename+'.vis', u=u, v=v, Vis=Vis, Wgt=Wgt)
-    print("#Measurement set exported to %s" % (MS_filename+'.vis.npz',))
+    else:
+        # strip off the '.ms'
+        MS_filename = filename.replace('.ms', '')
+
+    storename = export_vis_store(msfile, storename=MS_filename+'.vis', chunksize=chunksize)
+
+    if legacy_npz:
+        u, v, Vis, Wgt = load_vis(storename)
+        os.system('rm -rf '+MS_filename+'.vis.npz')
+        np.savez(MS_filename+'.vis', u=u, v=v, Vis=Vis, Wgt=Wgt)
+        print("#Measurement set exported to %s" % (MS_filename+'.vis.npz',))
+
+    return storename
+
+
+def _bin_edges(avbins):
+    """
+    Lower and upper edges of the uv distance bins centered on avbins (lambda).
+    Uniformly spaced bins keep the half-width of the first bin, exactly as
+    deproject_vis always did; non-uniform bins are split at the midpoints
+    between neighbouring bin centers.
+    """
+    spacing = np.diff(avbins)
+    if np.allclose(spacing, spacing[0]):
+        bwid = 0.5*(avbins[1]-avbins[0])
+        return avbins-bwid, avbins+bwid
+    midpoints = 0.5*(avbins[1:]+avbins[:-1])
+    bin_lo = np.r_[2*avbins[0]-midpoints[0], midpoints]
+    bin_hi = np.r_[midpoints, 2*avbins[-1]-midpoints[-1]]
+    return bin_lo, bin_hi
+
+
+def _bin_weighted(rho, realp, imagp, wgt, bin_lo, bin_hi, errtype='mean',
+                  min_points=5):
+    """
+    Single-pass engine behind the annular averaging of deproject_vis.
+    Every visibility is assigned to all bins with bin_lo <= rho < bin_hi (with
+    increasing edges these form a contiguous run, so normally just one bin),
+    and the per-bin weighted sums, counts and scatter are accumulated with
+    np.bincount instead of looping over the bins.
+
+    Returns:
+        bvis (complex array): Weighted average of the real and imaginary parts in each bin.
+        berr (complex array): Errors; 1/sqrt(sum of weights) if errtype='mean',
+            or the standard deviations of the real and imaginary parts if errtype='scat'.
+        Bins with fewer than min_points visibilities are set to zero in both.
+    """
+    nbins = len(bin_lo)
+
+    # - find the bin(s) of each visibility
+    first_bin = np.searchsorted(bin_hi, rho, side='right') # first bin with rho < bin_hi
+    points    = np.arange(len(rho))
+    in_bin, of_point = [], []
+    while len(points) > 0:
+        keep = (first_bin < nbins)
+        points, first_bin = points[keep], first_bin[keep]
+        keep = (bin_lo[first_bin] <= rho[points])
+        points, first_bin = points[keep], first_bin[keep]
+        in_bin.append(first_bin)
+        of_point.append(points)
+        first_bin = first_bin+1 # overlapping bins (if any)
+    in_bin   = np.concatenate(in_bin)
+    of_point = np.concatenate(of_point)
+
+    # - accumulate the weighted sums and counts of every bin at once
+    w       = wgt[of_point]
+    re      = realp[of_point]
+    im      = imagp[of_point]
+    counts  = np.bincount(in_bin, minlength=nbins)
+    sum_w   = np.bincount(in_bin, weights=w, minlength=nbins)
+    filled  = (counts >= min_points)
+
+    bvis = np.zeros(nbins, dtype='complex')
+    berr = np.zeros(nbins, dtype='complex')
+    bvis.real[filled] = np.bincount(in_bin, weights=w*re, minlength=nbins)[filled]/sum_w[filled]
+    bvis.imag[filled] = np.bincount(in_bin, weights=w*im, minlength=nbins)[filled]/sum_w[filled]
+
+    if (errtype == 'scat'):
+        # (unweighted) standard deviation, from the scatter about each bin's mean
+        n       = np.maximum(counts, 1)
+        mean_re = np.bincount(in_bin, weights=re, minlength=nbins)/n
+        mean_im = np.bincount(in_bin, weights=im, minlength=nbins)/n
+        berr.real[filled] = np.sqrt(np.bincount(in_bin, weights=(re-mean_re[in_bin])**2, minlength=nbins)/n)[filled]
+        berr.imag[filled] = np.sqrt(np.bincount(in_bin, weights=(im-mean_im[in_bin])**2, minlength=nbins)/n)[filled]
+    else:
+        berr.real[filled] = 1./np.sqrt(sum_w[filled])
+        berr.imag[filled] = 1./np.sqrt(sum_w[filled])
+
+    return bvis, berr
 
 
 def deproject_vis(data, bins=np.array([0.]), incl=0., PA=0., offx=0., offy=0.,
@@ -600,11 +1335,12 @@ def deproject_vis(data, bins=np.array([0.]), incl=0., PA=0., offx=0., offy=0.,
     Parameters
     ==========
     data: Length-4 tuple of u,v, visibilities, and weight arrays
-    bins: 1-D array of uv distance bins (kilolambda)
+    bins: 1-D array of uv distance bin centers (kilolambda); need not be uniformly spaced
     incl: Inclination of disk (degrees)
     PA: Position angle of disk (degrees)
     offx: Horizontal offset of disk center from phase center (arcseconds)
     offy: Vertical offset of disk center from phase center (arcseconds)
+    errtype: 'mean' for the error on the weighted mean, or 'scat' for the scatter in each bin
 
     Returns
     =======
@@ -633,25 +1369,9 @@ def deproject_vis(data, bins=np.array([0.]), incl=0., PA=0., offx=0., offy=0.,
     # - if requested, return a binned (averaged) representation
     if (bins.size > 1.):
         avbins = 1e3*bins	# scale to lambda units (input in klambda)
-        bwid = 0.5*(avbins[1]-avbins[0])
-        bvis = np.zeros_like(avbins, dtype='complex')
-        berr = np.zeros_like(avbins, dtype='complex')
-        for ib in np.arange(len(avbins)):
-            inb = np.where((rhop >= avbins[ib]-bwid) & (rhop < avbins[ib]+bwid))
-            if (len(inb[0]) >= 5):
-                bRe, eRemu = np.average(realp[inb], weights=wgt[inb],
-                                        returned=True)
-                eRese = np.std(realp[inb])
-                bIm, eImmu = np.average(imagp[inb], weights=wgt[inb],
-                                        returned=True)
-                eImse = np.std(imagp[inb])
-                bvis[ib] = bRe+1j*bIm
-                if (errtype == 'scat'):
-                    berr[ib] = eRese+1j*eImse
-                else: berr[ib] = 1./np.sqrt(eRemu)+1j/np.sqrt(eImmu)
-            else:
-                bvis[ib] = 0+1j*0
-                berr[ib] = 0+1j*0
+        bin_lo, bin_hi = _bin_edges(avbins)
+        bvis, berr = _bin_weighted(rhop, realp, imagp, wgt, bin_lo, bin_hi,
+                                   errtype=errtype)
         parser = np.where(berr.real != 0)
         output = avbins[parser], bvis[parser], berr[parser]
         return output
@@ -661,14 +1381,109 @@ def deproject_vis(data, bins=np.array([0.]), incl=0., PA=0., offx=0., offy=0.,
 
     return output
 
+def _vis_checksum(filename):
+    """
+    Checksum of exported visibilities (a visibility store, or a .vis.npz file), from
+    the path, size and modification time of its files: re-exporting changes it, and
+    it costs nothing (unlike hashing GBs of visibilities on every call).
+    """
+    if os.path.isdir(filename):
+        parts = [os.path.join(filename, key+'.npy') for key in STORE_KEYS]
+    else:
+        parts = [filename]
+    md5 = hashlib.md5(os.path.abspath(filename).encode())
+    for f in parts:
+        md5.update(('%s %d %.6f\n' % (os.path.basename(f), os.path.getsize(f), os.path.getmtime(f))).encode())
+    return md5.hexdigest()
+
+
+# Memoized deprojected profiles: {(checksum, incl, PA, offx, offy, bins md5, errtype): (rho, vis, sig)}
+_profile_cache = {}
+
+def _profile_key(checksum, bins, incl, PA, offx, offy, errtype):
+    """ Key of a deprojected profile in _profile_cache. """
+    return (checksum, float(incl), float(PA), float(offx), float(offy),
+            hashlib.md5(np.asarray(bins, dtype='float64').tobytes()).hexdigest(), errtype)
+
+def get_deprojected_profile(filename, bins, incl=0., PA=0., offx=0., offy=0.,
+                            errtype='mean', cache_dir=None):
+    """
+    Deprojected, azimuthally averaged profile of exported visibilities, as returned
+    by deproject_vis. Profiles are cached on (file checksum, incl, PA, offx, offy, bins),
+    so a reference EB compared against many others is only read and binned once.
+
+    Args:
+        filename (string): Name of the visibility store (or .vis.npz file)
+        bins (array): uv distance bin centers (kilolambda), as in deproject_vis
+        incl, PA, offx, offy, errtype: As in deproject_vis
+        cache_dir (string): If given, profiles are also saved to / read from
+            .profile.npz files in this directory, so they survive the session
+            (and are shared between the worker processes of export_and_bin_all).
+    Returns:
+        uv distance bins (1D array), visibilities (1D array), errors on averaged visibilities (1D array)
+    """
+    bins = np.asarray(bins, dtype='float64')
+    key = _profile_key(_vis_checksum(filename), bins, incl, PA, offx, offy, errtype)
+    if key in _profile_cache:
+        return _profile_cache[key]
+
+    if cache_dir is not None:
+        cachefile = os.path.join(cache_dir, hashlib.md5(repr(key).encode()).hexdigest()+'.profile.npz')
+        if os.path.exists(cachefile):
+            inpf = np.load(cachefile)
+            _profile_cache[key] = (inpf['rho'], inpf['vis'], inpf['sig'])
+            return _profile_cache[key]
+
+    u, v, vis, wgt = load_vis(filename)
+    profile = deproject_vis([u, v, vis, wgt], bins=bins, incl=incl, PA=PA,
+                            offx=offx, offy=offy, errtype=errtype)
+    _profile_cache[key] = profile
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cachefile, rho=profile[0], vis=profile[1], sig=profile[2])
+
+    return profile
+
+
+def _profile_on_grid(profile, bins):
+    """
+    Spreads a deprojected profile (which only keeps the non-empty bins) back onto
+    the full grid of bin centers it was computed on. Empty bins are NaN.
+    Returns the visibilities (complex) and their errors (real), both of length len(bins).
+    """
+    rho, vis, sig = profile
+    avbins = 1e3*np.asarray(bins, dtype='float64')
+    idx    = np.searchsorted(avbins, rho)
+    vis_grid = np.full(len(avbins), np.nan+0j)
+    sig_grid = np.full(len(avbins), np.nan)
+    vis_grid[idx] = vis
+    sig_grid[idx] = sig.real
+    return vis_grid, sig_grid
+
+
+# Memoized uv distance ranges of exported visibilities: {checksum: (min, max)}
+_uvdist_range_cache = {}
+
+def _uvdist_range(filename):
+    """ Shortest and longest (projected) baseline of exported visibilities, in lambda. """
+    key = _vis_checksum(filename)
+    if key not in _uvdist_range_cache:
+        u, v, vis, wgt = load_vis(filename)
+        uvdist = np.sqrt(u**2+v**2)
+        _uvdist_range_cache[key] = (np.min(uvdist), np.max(uvdist))
+    return _uvdist_range_cache[key]
+
+
 def plot_deprojected(filelist, fignametemplate='./out', incl=0, PA=0,
-                     offx=0, offy=0, fluxscale=None, uvbins=None, show_err=True):
+                     offx=0, offy=0, fluxscale=None, uvbins=None, show_err=True,
+                     cache_dir=None):
     """
     *** Adapted from reduction_utils.py, by the DSHARP Large Program (Jane Huang)
     Plots real and imaginary deprojected visibilities from a list of .npz files
 
     Args:
-        filelist: List of names of .npz files storing visibility data
+        filelist: List of names of visibility stores (or .npz files) storing visibility data
         fignametemplate (string): Figure will be save as 'fignametemplate_plot_deprojected.png'
         incl: Inclination of disk (degrees)
         PA: Position angle of disk (degrees)
@@ -677,6 +1492,7 @@ def plot_deprojected(filelist, fignametemplate='./out', incl=0, PA=0,
         fluxscale: List of scaling factors to multiply the visibility values by before plotting. Default value is set to all ones.
         uvbins: Array of bins at which to plot the visibility values, in lambda. By default, the range plotted will be from 10 to 1000 kilolambda
         show_err: If True, plot error bars.
+        cache_dir: Optional directory for the on-disk cache of binned profiles (see get_deprojected_profile)
     Returns:
         Figure (png): Saves the figure to a png file, named fignametemplate_plot_deprojected.png
     """
@@ -702,16 +1518,11 @@ def plot_deprojected(filelist, fignametemplate='./out', incl=0, PA=0,
     for i, filename in enumerate(filelist):
 
         # read in the data
-        inpf = np.load(filename)
-        u    = inpf['u']
-        v    = inpf['v']
-        vis  = fluxscale[i]*inpf['Vis']
-        wgt  = inpf['Wgt']
-
-        # deproject the visibilities and do the annular averaging
-        vp   = deproject_vis([u, v, vis, wgt], bins=uvbins, incl=incl, PA=PA,
-                         offx=offx, offy=offy)
+        # deproject the visibilities and do the annular averaging (cached), then apply the flux scaling
+        vp   = get_deprojected_profile(filename, bins=uvbins, incl=incl, PA=PA,
+                                       offx=offx, offy=offy, cache_dir=cache_dir)
         vp_rho, vp_vis, vp_sig = vp
+        vp_vis = fluxscale[i]*vp_vis
 
         # calculate min, max of deprojected, averaged reals (for visualization)
         minvis[i] = np.min(vp_vis.real)
@@ -753,7 +1564,7 @@ def plot_deprojected(filelist, fignametemplate='./out', incl=0, PA=0,
 
 
 def estimate_flux_scale(reference, comparison, incl=0, PA=0, uvbins=None, offx=0,
-                        offy=0, make_plot=True, fignametemplate='./out'):
+                        offy=0, make_plot=True, fignametemplate='./out', cache_dir=None):
     """
     *** Adapted from reduction_utils.py, by the DSHARP Large Program (Jane Huang)
     Calculates the weighted average of the flux ratio between two observations of a source
@@ -764,8 +1575,8 @@ def estimate_flux_scale(reference, comparison, incl=0, PA=0, uvbins=None, offx=0
     Useful for diagnostics after phase alignment and during self calibration.
 
     Args:
-        reference: Name of .npz file holding the reference dataset (with the "correct" flux")
-        comparison: Name of .npz file holding the comparison dataset (with the flux ratio being checked)
+        reference: Name of visibility store (or .npz file) holding the reference dataset (with the "correct" flux")
+        comparison: Name of visibility store (or .npz file) holding the comparison dataset (with the flux ratio being checked)
         incl: Inclination of disk (degrees)
         PA: Position angle of disk (degrees)
         offx: Horizontal offset of disk center from phase center (arcseconds)
@@ -775,51 +1586,45 @@ def estimate_flux_scale(reference, comparison, incl=0, PA=0, uvbins=None, offx=0
                 The longest baseline compared is either the shorter of the longest baselines in the individual datasets, or 800 kilolambda, whichever comes first.
         make_plot (bool): Whether or not to make the figure.
         fignametemplate (string): Figure will be save as 'fignametemplate_estimate_flux_scale.png'
+        cache_dir (string): Optional directory for the on-disk cache of binned profiles (see get_deprojected_profile)
     Returns:
         ratio_avg (float): The ratio of the fluxes between the comparison and reference (comp/ref)
         np.sqrt(ratio_avg) (float): The scaling factor for gencal for your comparison measurement set
         Figure (png): Saves the figure to a png file, named fignametemplate_plot_deprojected.png
     """
 
-    inpf = np.load(reference)
-    u_ref    = inpf['u']
-    v_ref    = inpf['v']
-    vis_ref  = inpf['Vis']
-    wgt_ref  = inpf['Wgt']
-
-    inpf = np.load(comparison)
-    u_comp    = inpf['u']
-    v_comp    = inpf['v']
-    vis_comp  = inpf['Vis']
-    wgt_comp  = inpf['Wgt']
-
-    uvdist_ref = np.sqrt(u_ref**2+v_ref**2)
-    uvdist_comp = np.sqrt(u_comp**2+v_comp**2)
+    mindist_ref, maxdist_ref   = _uvdist_range(reference)
+    mindist_comp, maxdist_comp = _uvdist_range(comparison)
 
-    mindist = np.max(np.array([np.min(uvdist_ref), np.min(uvdist_comp)]))
-    maxdist = np.min(np.array([np.max(uvdist_ref), np.max(uvdist_ref), 8e5])) #the maximum baseline we want to compare is the longest shared baseline or 800 kilolambda, whichever comes first (we don't want to go out to a baseline that's too long because phase decorrelation becomes a bigger issue at longer baselines.
+    mindist = np.max(np.array([mindist_ref, mindist_comp]))
+    maxdist = np.min(np.array([maxdist_ref, maxdist_comp, 8e5])) #the maximum baseline we want to compare is the longest shared baseline or 800 kilolambda, whichever comes first (we don't want to go out to a baseline that's too long because phase decorrelation becomes a bigger issue at longer baselines.
 
     if uvbins is None:
-        uvbins = mindist/1.e3+10.*np.arange(np.floor((maxdist-mindist)/1.e4))
+        # the grid depends on the reference only, so its binned profile is cached across comparisons;
+        # the shared baseline range [mindist, maxdist] is selected below
+        uvbins = mindist_ref/1.e3+10.*np.arange(np.floor((min(maxdist_ref, 8e5)-mindist_ref)/1.e4))
 
-    # deproject the visibilities and do the annular averaging
-    vp   = deproject_vis([u_ref, v_ref, vis_ref, wgt_ref], bins=uvbins, incl=incl, PA=PA,
-                         offx=offx, offy=offy)
-    ref_rho, ref_vis, ref_sig = vp
+    # deproject the visibilities and do the annular averaging (cached, so with the default uvbins the reference is only binned once)
+    vp_ref = get_deprojected_profile(reference, bins=uvbins, incl=incl, PA=PA,
+                                     offx=offx, offy=offy, cache_dir=cache_dir)
 
     # deproject the visibilities and do the annular averaging
-    vp   = deproject_vis([u_comp, v_comp, vis_comp, wgt_comp], bins=uvbins, incl=incl, PA=PA,
-                         offx=offx, offy=offy)
-    comp_rho, comp_vis, comp_sig = vp
+    vp   = get_deprojected_profile(comparison, bins=uvbins, incl=incl, PA=PA,
+                                   offx=offx, offy=offy, cache_dir=cache_dir)
 
     # maxlen = np.min(np.array([len(comp_rho), len(ref_rho)])) # not sure what this is for; never gets used
 
-    rho_intersection = np.intersect1d(ref_rho, comp_rho) #we only want to compare overlapping baseline intervals
+    # both profiles are on the same grid of bins; we only want to compare overlapping baseline intervals
+    ref_vis_grid, ref_sig_grid   = _profile_on_grid(vp_ref, uvbins)
+    comp_vis_grid, comp_sig_grid = _profile_on_grid(vp, uvbins)
+    rho_grid = 1e3*np.asarray(uvbins, dtype='float64')
+    overlap  = np.isfinite(ref_sig_grid) & np.isfinite(comp_sig_grid) & (rho_grid >= mindist) & (rho_grid <= maxdist)
+    rho_intersection = rho_grid[overlap]
 
-    comp_sig_intersection = comp_sig[np.where(np.in1d(comp_rho, rho_intersection))].real #they're the same for the real and imaginary components
-    comp_vis_intersection = comp_vis[np.where(np.in1d(comp_rho, rho_intersection))]
-    ref_sig_intersection = ref_sig[np.where(np.in1d(ref_rho, rho_intersection))].real
-    ref_vis_intersection = ref_vis[np.where(np.in1d(ref_rho, rho_intersection))]
+    comp_sig_intersection = comp_sig_grid[overlap] #they're the same for the real and imaginary components
+    comp_vis_intersection = comp_vis_grid[overlap]
+    ref_sig_intersection = ref_sig_grid[overlap]
+    ref_vis_intersection = ref_vis_grid[overlap]
 
     ratio = np.abs(comp_vis_intersection)/np.abs(ref_vis_intersection)
     err = ratio*np.sqrt((comp_sig_intersection/np.abs(comp_vis_intersection))**2+(ref_sig_intersection/np.abs(ref_vis_intersection))**2)
@@ -862,6 +1667,145 @@ def estimate_flux_scale(reference, comparison, incl=0, PA=0, uvbins=None, offx=0
     return ratio_avg, np.sqrt(ratio_avg)
 
 
+def estimate_flux_scale_matrix(filelist, reference=0, incl=0, PA=0, uvbins=None,
+                               offx=0, offy=0, make_plot=True, fignametemplate='./out',
+                               cache_dir=None):
+    """
+    All-pairs version of estimate_flux_scale: bins every dataset once on a common grid
+    of uv distance bins, then computes the weighted average amplitude ratio (and its
+    error) between every pair of datasets in one go. E.g. checking the alignment of
+    all 8 EBs after step2 or after a round of self-cal is one call.
+
+    Args:
+        filelist (list): Names of visibility stores (or .npz files), e.g. one per EB
+        reference (int or string): Index in filelist (or name) of the dataset with the "correct" flux
+        incl, PA, offx, offy: Disk geometry, as in estimate_flux_scale
+        uvbins: Array of bins (kilolambda). By default, from the longest of the minimum baselines
+                to the shortest of the maximum baselines of all datasets (or 800 kilolambda), in steps of 10 kilolambda.
+        make_plot (bool): Whether or not to make the figure of the ratio matrix
+        fignametemplate (string): Figure will be saved as 'fignametemplate_estimate_flux_scale_matrix.png'
+        cache_dir (string): Optional directory for the on-disk cache of binned profiles (see get_deprojected_profile)
+    Returns:
+        ratio_avg (2D array): ratio_avg[i,j] is the flux ratio of dataset j to dataset i (comp/ref)
+        ratio_err (2D array): Errors on the weighted mean ratios
+        scale_factors (1D array): The scaling factors for gencal of each dataset, relative to the reference
+    """
+    if not isinstance(reference, int):
+        reference = filelist.index(reference)
+
+    if uvbins is None:
+        ranges  = np.array([_uvdist_range(filename) for filename in filelist])
+        mindist = np.max(ranges[:,0])
+        maxdist = np.min(np.append(ranges[:,1], 8e5))
+        uvbins  = mindist/1.e3+10.*np.arange(np.floor((maxdist-mindist)/1.e4))
+
+    # bin each dataset once, onto the common grid: arrays of shape (N, nbins), NaN where a bin is empty
+    vis_grid = []
+    sig_grid = []
+    for filename in filelist:
+        vp = get_deprojected_profile(filename, bins=uvbins, incl=incl, PA=PA,
+                                     offx=offx, offy=offy, cache_dir=cache_dir)
+        vis_i, sig_i = _profile_on_grid(vp, uvbins)
+        vis_grid.append(vis_i)
+        sig_grid.append(sig_i)
+    amp     = np.abs(np.array(vis_grid))
+    fracerr = np.array(sig_grid)/amp
+
+    # ratio[i,j,b] = comp/ref with comp=j, ref=i, and its error; NaN wherever either bin is empty
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = amp[None,:,:]/amp[:,None,:]
+        err   = ratio*np.sqrt(fracerr[None,:,:]**2 + fracerr[:,None,:]**2)
+        w     = 1/err**2
+    w[~np.isfinite(w)] = 0.
+    ratio[w==0] = 0.
+
+    sumw = np.sum(w, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_avg = np.sum(w*ratio, axis=2)/sumw
+        ratio_err = 1/np.sqrt(sumw)
+    scale_factors = np.sqrt(ratio_avg[reference])
+
+    for j, filename in enumerate(filelist):
+        if j==reference:
+            continue
+        print("#The ratio of the fluxes of %s to %s is %.5f +/- %.3e; the scaling factor for gencal is %.3f"
+              % (filename, filelist[reference], ratio_avg[reference,j], ratio_err[reference,j], scale_factors[j]))
+
+    if make_plot==True:
+        names = [os.path.split(filename)[1] for filename in filelist]
+        fig = plt.figure(figsize=(10, 9))
+        ax = fig.add_subplot(111)
+        im = ax.imshow(ratio_avg, cmap='RdBu_r', vmin=0.8, vmax=1.2, origin='upper')
+        for i in range(len(filelist)):
+            for j in range(len(filelist)):
+                ax.text(j, i, '%.3f' % ratio_avg[i,j], ha='center', va='center', fontsize=9)
+        ax.set_xticks(np.arange(len(filelist)))
+        ax.set_yticks(np.arange(len(filelist)))
+        ax.set_xticklabels(names, rotation=90, fontsize=9)
+        ax.set_yticklabels(names, fontsize=9)
+        ax.set_xlabel('comp', fontsize=16)
+        ax.set_ylabel('ref', fontsize=16)
+        cbar = plt.colorbar(im, ax=ax)
+        cbar.set_label('Ratio = comp/ref', fontsize=16)
+        plt.tight_layout()
+        plt.savefig(fignametemplate+'_estimate_flux_scale_matrix.png', dpi=300, transparent=True, bbox_inches='tight',pad_inches=0.015)
+        plt.clf()
+        print("Figure saved! To: ", fignametemplate+'_estimate_flux_scale_matrix.png')
+
+    return ratio_avg, ratio_err, scale_factors
+
+
+def _bin_store(args):
+    """ Worker for export_and_bin_all: bins the visibilities of one store (numpy only, no CASA tools). """
+    storename, uvbins, incl, PA, offx, offy, cache_dir = args
+    profile = get_deprojected_profile(storename, bins=uvbins, incl=incl, PA=PA,
+                                      offx=offx, offy=offy, cache_dir=cache_dir)
+    return storename, _vis_checksum(storename), profile
+
+
+def export_and_bin_all(msfiles, uvbins=None, incl=0, PA=0, offx=0, offy=0,
+                       cache_dir=None, nproc=None):
+    """
+    Exports several measurement sets (e.g. all 8 EBs) to visibility stores, one after
+    the other in this session (the table tool isn't safe to use in forked processes),
+    and bins their deprojected profiles concurrently in a pool of worker processes. The
+    profiles are put in the profile cache of this session (and in cache_dir, if
+    given), so following calls to plot_deprojected / estimate_flux_scale with the
+    same geometry and bins don't redo any of the work.
+
+    Args:
+        msfiles (list): Names of CASA measurement sets, ending in '.ms'
+        uvbins: Array of bin centers (kilolambda), as in plot_deprojected. Default: 10 to 2500 kilolambda in steps of 10
+        incl, PA, offx, offy: Disk geometry, as in deproject_vis
+        cache_dir (string): Optional directory for the on-disk cache of binned profiles
+        nproc (int): Number of worker processes. Default: one per MS, at most the number of CPUs
+    Returns:
+        storenames (list): Names of the visibility stores, in the order of msfiles
+    """
+    if uvbins is None:
+        uvbins = 10.+10.*np.arange(250)
+    uvbins = np.asarray(uvbins, dtype='float64')
+    if nproc is None:
+        nproc = min(len(msfiles), multiprocessing.cpu_count())
+
+    jobs = [(export_MS(msfile), uvbins, incl, PA, offx, offy, cache_dir) for msfile in msfiles]
+    if nproc > 1:
+        # the workers only read the (memory-mapped) stores with numpy
+        with multiprocessing.get_context('fork').Pool(nproc) as pool:
+            results = pool.map(_bin_store, jobs, chunksize=1)
+    else:
+        results = [_bin_store(job) for job in jobs]
+
+    storenames = []
+    for storename, checksum, profile in results:
+        # profiles were binned in the workers; register them here
+        _profile_cache[_profile_key(checksum, uvbins, incl, PA, offx, offy, 'mean')] = profile
+        storenames.append(storename)
+    print("#Exported and binned %d measurement sets" % len(storenames))
+
+    return storenames
+
+
 
 
 
@@ -48,6 +48,11 @@ import os
 execfile('dictionary_data.py') # loads data_dict
 execfile('step1_utils.py') # loads multiple functions
 execfile('selfcal_utils.py') # necessary for an initial round of selfcal at the end
+execfile('dictionary_mask.py') # loads mask_dict
+
+""" Set unattended = True to clean non-interactively (masks and thresholds from automask.py), e.g. on a batch node """
+unattended = False
+automask   = mask_dict['continuum automask'] if unattended else None
 
 '''
 Note on where we begin:
@@ -135,24 +140,38 @@ print('Executing step1_prepare_continuum.py')
 
 
 print('\nPerforming spectral averaging of the continuum...') # takes about 38 mins per EB
-for EB in data_dict['EBs']:
-    inputvis            = data_dict['NRAO_path']+data_dict[EB]['.ms.split.cal.source']
-    outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms']
-    print('inputvis = ', inputvis)
-    print('outputvis = ', outputvis)
-
-    flagchannels_string = get_flagchannels(ms_file          = inputvis,
-                                           ms_dict          = data_dict[EB],
-                                           velocity_range   = data_dict[EB]['velocity_ranges'])
-    print('\nFor '+EB+', flagchannels_string = ', flagchannels_string)
-
-    avg_cont(msfile         = inputvis,
-            outputvis       = outputvis,
-            flagchannels    = flagchannels_string,
-            contspws        = data_dict[EB]['cont_spws'],
-            width_array     = data_dict[EB]['width_array'],
-            datacolumn      = 'data',
-            field           = 'AB_Aur')
+""" The EBs are independent, so each is averaged in its own CASA process (see casa_jobs.py),
+a few at a time; their logs are in ./workflow/step1/jobs/. max_jobs=1 does them one by one. """
+from casa_jobs import casa_job, run_casa_jobs, check_casa_jobs
+avg_cont_job = """
+diagnostics         = 'spectra' # plots from one read of the MS; 'none' skips them, 'plotms' is the old, slow way
+inputvis            = data_dict['NRAO_path']+data_dict[EB]['.ms.split.cal.source']
+outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms']
+print('inputvis = ', inputvis)
+print('outputvis = ', outputvis)
+
+flagchannels_string = get_flagchannels(ms_file          = inputvis,
+                                       ms_dict          = data_dict[EB],
+                                       velocity_range   = data_dict[EB]['velocity_ranges'])
+print('\\nFor '+EB+', flagchannels_string = ', flagchannels_string)
+
+avg_cont(msfile         = inputvis,
+        outputvis       = outputvis,
+        flagchannels    = flagchannels_string,
+        contspws        = data_dict[EB]['cont_spws'],
+        width_array     = data_dict[EB]['width_array'],
+        datacolumn      = 'data',
+        field           = 'AB_Aur',
+        diagnostics     = diagnostics)
+"""
+jobs = [casa_job(name    = EB+'_avg_cont',
+                 code    = "EB = '%s'\n" % EB + avg_cont_job,
+                 setup   = "execfile('dictionary_data.py')\nexecfile('step1_utils.py')",
+                 mem_gb  = 8., # split is light on memory; plotms less so
+                 outputs = [data_dict['NRAO_path']+data_dict[EB]['_initcont.ms']]) for EB in data_dict['EBs']]
+results = run_casa_jobs(jobs, logdir='./workflow/step1/jobs/', max_jobs=4, max_io_jobs=3, retries=1)
+print('Spectral averaging: ', {name: results[name]['success'] for name in results})
+check_casa_jobs(results, stage='Spectral averaging')
 
 log_file.close()
 
@@ -187,6 +206,8 @@ SB_scales   = [0, 5, 10, 20, 40] # max scale ~ LAS ~ outer ring edge ~ 1.5 arcse
 LB_scales   = [0, 5, 30, 80, 150] # max scale ~ LAS ~ outer ring edge ~ 1.5 arcsec; min scale = delta function
 
 """ Image each execution block individually, as well as per-spw images """ # gain=0.1, which is a bit high for images that matter
+""" The 6 images per EB are independent: collect them all as jobs, and clean them in parallel """
+imaging_jobs = []
 for EB in data_dict['SB_EBs']:
     image_each_obs(ms_dict      = data_dict[EB],
                    inputvis     = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms'],
@@ -196,7 +217,8 @@ for EB in data_dict['SB_EBs']:
                    cellsize     = SB_cellsize,
                    contspws     = data_dict[EB]['cont_spws'],
                    # threshold    = '0.0mJy', # this is taken care of inside image_each_obs
-                   interactive  = False)
+                   interactive  = False,
+                   jobs         = imaging_jobs)
 for EB in data_dict['LB_EBs']:
     image_each_obs(ms_dict      = data_dict[EB],
                    inputvis     = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms'],
@@ -206,7 +228,10 @@ for EB in data_dict['LB_EBs']:
                    cellsize     = LB_cellsize,
                    contspws     = data_dict[EB]['cont_spws'],
                    # threshold    = '0.0mJy', # this is taken care of inside image_each_obs
-                   interactive  = False)
+                   interactive  = False,
+                   jobs         = imaging_jobs)
+imaging_results = run_imaging_jobs(imaging_jobs, logdir='./workflow/step1/imaging_jobs/', max_jobs=8)
+check_casa_jobs(imaging_results, stage='QA imaging')
 
 
 """
@@ -275,7 +300,8 @@ for EB in data_dict['SB_EBs']:
                   contspws      = '', # we want the model to include all spws
                   threshold     = '0mJy',
                   interactive   = True,
-                  savemodel     = 'modelcolumn')
+                  savemodel     = 'modelcolumn',
+                  automask      = automask) # no previous image: auto-multithresh
 # SB_EB1: number (interactive) iterations performed: 2
 # SB_EB2: number (interactive) iterations performed: 2
 for EB in data_dict['LB_EBs']:
@@ -290,7 +316,8 @@ for EB in data_dict['LB_EBs']:
                   contspws      = '', # we want the model to include all spws
                   threshold     = '0mJy',
                   interactive   = True,
-                  savemodel     = 'modelcolumn')
+                  savemodel     = 'modelcolumn',
+                  automask      = automask) # no previous image: auto-multithresh
 # LB_EB1: number (interactive) iterations performed: 2
 # LB_EB2: number (interactive) iterations performed: 1
 # LB_EB3: number (interactive) iterations performed: 1
@@ -401,6 +428,7 @@ for EB in data_dict['EBs']:
 # Interactively shallowly clean, and save the result to the _initcont_model.ms model column
 for EB in data_dict['SB_EBs']:
     initcont          = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms']
+    initcont_model    = initcont.replace('.ms', '_model.ms')
     initcont_selfcal  = initcont.replace('.ms', '_selfcal.ms')
     tclean_wrapper(vis          = initcont_selfcal,
                   imagename     = initcont_selfcal.replace('.ms', ''), # will become .image, .residual, etc
@@ -411,11 +439,15 @@ for EB in data_dict['SB_EBs']:
                   contspws      = '', # we want the model to include all spws
                   threshold     = '0mJy',
                   interactive   = True,
-                  savemodel     = 'modelcolumn')
+                  savemodel     = 'modelcolumn',
+                  automask      = automask,
+                  previous_image= initcont_model.replace('.ms', ''), # the mask follows the model image
+                  noise_mask    = noise_annulus)
 # SB_EB1: number (interactive) iterations performed: 3
 # SB_EB2: number (interactive) iterations performed: 3
 for EB in data_dict['LB_EBs']:
     initcont          = data_dict['NRAO_path']+data_dict[EB]['_initcont.ms']
+    initcont_model    = initcont.replace('.ms', '_model.ms')
     initcont_selfcal  = initcont.replace('.ms', '_selfcal.ms')
     tclean_wrapper(vis          = initcont_selfcal,
                   imagename     = initcont_selfcal.replace('.ms', ''), # will become .image, .residual, etc
@@ -426,7 +458,10 @@ for EB in data_dict['LB_EBs']:
                   contspws      = '', # we want the model to include all spws
                   threshold     = '0mJy',
                   interactive   = True,
-                  savemodel     = 'modelcolumn')
+                  savemodel     = 'modelcolumn',
+                  automask      = automask,
+                  previous_image= initcont_model.replace('.ms', ''), # the mask follows the model image
+                  noise_mask    = noise_annulus)
 # LB_EB1: number (interactive) iterations performed: 3
 # LB_EB2: number (interactive) iterations performed: 1
 # LB_EB3: number (interactive) iterations performed: 2
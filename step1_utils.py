@@ -7,17 +7,94 @@ Adapter: J. Speedie
 import os
 import numpy as np
 import sys
+from virtual_ms import VirtualMS, is_virtual, read_columns, read_subtable_column, resolve
+from ms_spectra import accumulate_spectra, unflagged_channels, save_spectra, plot_avg_cont_spectra
+
+# Per-MS metadata for LSRKvel_to_chan, keyed by the absolute path of the MS; see ms_metadata()
+_ms_metadata_cache = {}
+
+def _ms_metadata_fingerprint(msfile):
+    """ Modification times of the subtables the metadata come from (cheap; no data read). """
+    return tuple(os.path.getmtime(os.path.join(msfile, table, 'table.dat')) if table else os.path.getmtime(os.path.join(msfile, 'table.dat'))
+                 for table in ['', 'SPECTRAL_WINDOW', 'FIELD', 'OBSERVATION'])
+
+
+def ms_metadata(msfile):
+    """
+    The metadata of a measurement set that LSRKvel_to_chan needs, read once per MS and
+    kept (until the MS changes): field names, observation start times, and per spw its
+    channel frequencies and observation id. The LSRK frequencies of an spw are added by
+    LSRKvel_to_chan the first time they are needed, per field.
+    CASA tasks used:
+        tb.open, tb.getcol, tb.close
+        msmd.open, msmd.nobservations, msmd.scansforspw, msmd.close
+
+    Args:
+        msfile (string): Name of measurement set (a real one, see virtual_ms.resolve)
+    Returns:
+        metadata (dictionary): 'fieldnames', 'obstimes' (s), 'chanfreqs' (per spw, Hz),
+            'obsid' (per spw), 'lsrkfreqs' (per (spw, field id), Hz)
+    """
+    key = os.path.abspath(msfile)
+    fingerprint = _ms_metadata_fingerprint(msfile)
+    if (key in _ms_metadata_cache) and (_ms_metadata_cache[key]['fingerprint']==fingerprint):
+        return _ms_metadata_cache[key]
+
+    tb.open(msfile+'/SPECTRAL_WINDOW')
+    chanfreqs = [tb.getcell('CHAN_FREQ', i) for i in range(tb.nrows())] # spws can have different numbers of channels
+    tb.close()
+    tb.open(msfile+'/FIELD')
+    fieldnames = list(tb.getcol('NAME'))
+    tb.close()
+    tb.open(msfile+'/OBSERVATION')
+    obstimes = tb.getcol('TIME_RANGE')[0]
+    tb.close()
+
+    # which observation each spw belongs to, from the msmetadata index instead of the DATA_DESC_ID and OBSERVATION_ID columns
+    msmd.open(msfile)
+    obsids = {}
+    for obsid in range(msmd.nobservations()):
+        for spw in range(len(chanfreqs)):
+            if (spw not in obsids) and len(msmd.scansforspw(spw, obsid=obsid)) > 0:
+                obsids[spw] = obsid
+    msmd.close()
+
+    _ms_metadata_cache[key] = {'fingerprint': fingerprint, 'fieldnames': fieldnames, 'obstimes': obstimes,
+                               'chanfreqs': chanfreqs, 'obsid': obsids, 'lsrkfreqs': {}}
+    return _ms_metadata_cache[key]
+
+
+def nearest_channel(chanvalues, values):
+    """
+    Index of the channel whose value (frequency, velocity) is nearest to each of values,
+    by a binary search of the sorted channel values.
+
+    Args:
+        chanvalues (array): Value of each channel, in increasing or decreasing order (or none)
+        values (float or array): Values to look up
+    Returns:
+        Channel index (int) or array of channel indices
+    """
+    order  = np.argsort(chanvalues, kind='stable')
+    sorted_values = chanvalues[order]
+    values = np.asarray(values, dtype='float64')
+    i = np.clip(np.searchsorted(sorted_values, values), 1, len(sorted_values)-1)
+    i = i - ((values - sorted_values[i-1]) <= (sorted_values[i] - values)) # the lower neighbour, if it's as near
+    return order[i]
+
 
 def LSRKvel_to_chan(msfile, field, spw, restfreq, LSRKvelocity):
     """
     Identifies the channel(s) corresponding to input LSRK velocities.
     Useful for choosing which channels to split out or flag if a line is expected to be present
+    The metadata of each MS are read once (see ms_metadata), so only the first call per spw costs anything.
     CASA tasks used:
         tb.open, tb.getcol, tb.close
+        msmd.open, msmd.close
         ms.open, ms.close, ms.cvelfreqs
 
     Args:
-        msfile (string): Name of measurement set
+        msfile (string): Name of measurement set (or virtual MS, see virtual_ms.py)
         spw (int): Spectral window number
         field (string): Field name
         restfreq (float): Rest frequency of the spectral line to be flagged, in Hz
@@ -28,41 +105,28 @@ def LSRKvel_to_chan(msfile, field, spw, restfreq, LSRKvelocity):
     """
     cc = 299792458. # speed of light in m/s
 
-    tb.open(msfile)
-    spw_col = tb.getcol('DATA_DESC_ID')
-    obs_col = tb.getcol('OBSERVATION_ID')
-    tb.close()
-
-    obsid = np.unique(obs_col[np.where(spw_col==spw)])
-
-    tb.open(msfile+'/SPECTRAL_WINDOW')
-    chanfreqs = tb.getcol('CHAN_FREQ', startrow = spw, nrow = 1)
-    tb.close()
-
-    tb.open(msfile+'/FIELD')
-    fieldnames = tb.getcol('NAME')
-    fieldid = np.where(fieldnames==field)[0][0]
-    tb.close()
-
-    tb.open(msfile+'/OBSERVATION')
-    obstime = np.squeeze(tb.getcol('TIME_RANGE', startrow = obsid, nrow = 1))[0]
-    tb.close()
-
-    nchan = len(chanfreqs)
-
-    ms.open(msfile)
-    # Take the spectral grid of a given spectral window, tranform and regrid it as prescribed by the given grid parameters (same as in cvel and clean) and return the transformed values as a list.
-    lsrkfreqs = ms.cvelfreqs(spwids=[spw], fieldids=[fieldid], mode='channel', nchan=nchan, obstime=str(obstime)+'s', start=0, width=1, outframe='LSRK')
+    # ms.cvelfreqs needs a real MS: go to the member holding the spw (and its spw id there)
+    msfile, spw = resolve(msfile, spw=spw)
+    metadata = ms_metadata(msfile)
+
+    fieldid = metadata['fieldnames'].index(field)
+    if (spw, fieldid) not in metadata['lsrkfreqs']:
+        nchan   = len(metadata['chanfreqs'][spw])
+        obstime = metadata['obstimes'][metadata['obsid'][spw]]
+        ms.open(msfile)
+        # Take the spectral grid of a given spectral window, tranform and regrid it as prescribed by the given grid parameters (same as in cvel and clean) and return the transformed values as a list.
+        metadata['lsrkfreqs'][(spw, fieldid)] = np.array(ms.cvelfreqs(spwids=[spw], fieldids=[fieldid], mode='channel', nchan=nchan,
+                                                                      obstime=str(obstime)+'s', start=0, width=1, outframe='LSRK'))
+        ms.close()
+    lsrkfreqs = metadata['lsrkfreqs'][(spw, fieldid)]
     chanvelocities = (restfreq-lsrkfreqs)/restfreq*cc/1.e3 #converted to LSRK velocities in km/s
-    ms.close()
 
     if type(LSRKvelocity)==np.ndarray:
         outchans = np.zeros_like(LSRKvelocity)
-        for i in range(len(LSRKvelocity)):
-            outchans[i] = np.argmin(np.abs(chanvelocities - LSRKvelocity[i]))
+        outchans[:] = nearest_channel(chanvelocities, LSRKvelocity)
         return outchans
     else:
-        return np.argmin(np.abs(chanvelocities - LSRKvelocity))
+        return nearest_channel(chanvelocities, LSRKvelocity)
 
 
 
@@ -93,13 +157,14 @@ def get_flagchannels(ms_file, ms_dict, velocity_range = np.array([-20,20])):
 
 
 def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data',
-            contspws=None, width_array=None, field='AB_Aur'):
+            contspws=None, width_array=None, field='AB_Aur', diagnostics='spectra'):
     '''
     Produces spectrally averaged (pseudo-) continuum measurement sets.
     CASA tasks used:
         flagmanager
         flagdata
         split
+        plotms (only with diagnostics='plotms')
 
     Args:
         msfile (string): Name of measurement set
@@ -108,7 +173,14 @@ def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data'
         datacolumn (string): Column to pull from for continuum averaging (usually will be 'data', but may sometimes be 'corrected' if there was flux rescaling applied)
         contspws (string): Argument to be passed to CASA for the spw parameter in split. If not set, all SPWs will be selected by default.
         width_array (array): Argument to be passed to CASA for the width parameter in split. If not set, all SPWs will be selected by default.
+        diagnostics (string): How to make the amp vs. channel/freq and weight plots, before and after flagging the lines:
+            'spectra' (default): from one chunked read of the MS, and of its FLAG column once the lines are flagged
+                (see ms_spectra.py); the spectra are saved to outputvis+'_spectra.npz'
+            'plotms': with plotms, as before, which reads the whole MS for every plot
+            'none': no plots, so only split reads the MS
     '''
+    if diagnostics not in ['spectra', 'plotms', 'none']:
+        raise ValueError("diagnostics must be 'spectra', 'plotms' or 'none'")
     # Troubleshoot "Waiting for read-lock on file" https://casaguides.nrao.edu/index.php/Waiting_for_read-lock_on_file
     # clearstat
     # clearstat
@@ -117,7 +189,10 @@ def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data'
     # clearstat
 
     # Before doing anything, plot the original amp vs. chan/freq, so can compare with post-flagging
-    for i, _ in enumerate(width_array):
+    if diagnostics=='spectra':
+        # after flagging, the spectra are the same minus the flagged line channels (plotted below, once flagged)
+        spectra = accumulate_spectra(msfile, datacolumn=datacolumn, field=field, spws=list(range(len(width_array))))
+    for i in (range(len(width_array)) if diagnostics=='plotms' else []):
         plotms(vis=msfile, yaxis='amp', xaxis='channel', avgchannel='1', plotrange=[0,0,0,1.8], avgtime='1e8', avgscan=True, spw=str(i), plotfile=outputvis+'_before_lines_flagged_channel_spw'+str(i)+'.png', showgui=False, overwrite=True)
         plotms(vis=msfile, yaxis='amp', xaxis='freq', avgchannel='1', plotrange=[0,0,0,1.8], avgtime='1e8', avgscan=True, spw=str(i), plotfile=outputvis+'_before_lines_flagged_freq_spw'+str(i)+'.png', showgui=False, overwrite=True)
 
@@ -136,7 +211,13 @@ def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data'
     flagdata(vis=msfile, mode='manual', spw=flagchannels, flagbackup=False, field=field)
 
     # Check that the flags were applied correctly by using plotms to inspect the flagged ms
-    for i, _ in enumerate(width_array):
+    # (or, with diagnostics='spectra', by reading back its FLAG column)
+    if diagnostics=='spectra':
+        for spw, unflagged in unflagged_channels(msfile, field=field, spws=list(spectra)).items():
+            spectra[spw]['unflagged'] = unflagged
+        save_spectra(spectra, outputvis+'_spectra.npz')
+        plot_avg_cont_spectra(spectra, outputvis)
+    for i in (range(len(width_array)) if diagnostics=='plotms' else []):
         plotms(vis=msfile, yaxis='amp', xaxis='channel', avgchannel='1', plotrange=[0,0,0,1.8], avgtime='1e8', avgscan=True, spw=str(i), plotfile=outputvis+'_check_lines_flagged_correctly_channel_spw'+str(i)+'.png', showgui=False, overwrite=True)
         plotms(vis=msfile, yaxis='amp', xaxis='freq', avgchannel='1', plotrange=[0,0,0,1.8], avgtime='1e8', avgscan=True, spw=str(i), plotfile=outputvis+'_check_lines_flagged_correctly_freq_spw'+str(i)+'.png', showgui=False, overwrite=True)
 
@@ -155,7 +236,8 @@ def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data'
     # "Now you should check the weights of the new continuum measurement set. The ratio of the weights value
     # between Time Domain Mode (TDM) and Frequency Domain Mode (FDM) windows should be approximately equal to
     # the ratio of the channel widths." (NRAO Imaging Guide)
-    plotms(vis=msfile,yaxis='wtsp',xaxis='freq',avgchannel='1',avgtime='1e8',avgscan=True, plotfile=outputvis+'_check_weights.png', showgui=False)
+    if diagnostics=='plotms':
+        plotms(vis=msfile,yaxis='wtsp',xaxis='freq',avgchannel='1',avgtime='1e8',avgscan=True, plotfile=outputvis+'_check_weights.png', showgui=False)
 
     # Finally, we need to use the flagmanager tasks to restore the ms file to its original unflagged state, so that
     # later we can do continuum subtraction and line imaging:
@@ -165,7 +247,7 @@ def avg_cont(msfile, outputvis='avg_cont.ms', flagchannels='', datacolumn='data'
 
 def image_each_obs(ms_dict, inputvis, scales, smallscalebias=0.6, mask='', contspws='',
                     threshold='0.5mJy', imsize=None, cellsize=None, interactive=False,
-                    robust=0.5, gain=0.1, niter=50000, cycleniter=300):
+                    robust=0.5, gain=0.1, niter=50000, cycleniter=300, jobs=None):
     """
     Wrapper for tclean that will loop through all the observations in a measurement set and image them individually,
         as well as make images for each spectral window alone
@@ -175,73 +257,112 @@ def image_each_obs(ms_dict, inputvis, scales, smallscalebias=0.6, mask='', conts
 
     Args:
         ms_dict (dictionary): Dictionary of information about measurement set
-        inputvis (string): Measurement set to image
+        inputvis (string): Measurement set to image. For a virtual MS (see virtual_ms.py), each
+            observation is imaged from the member holding it, and named after that member.
+        jobs (list): If given, the (independent) tclean calls are not run here but appended to jobs,
+            to be run all at once in parallel by run_imaging_jobs. interactive must then be False.
         See the CASA 6.2.1.7 documentation for tclean to get the definitions of all other parameters
     """
-    tb.open(inputvis+'/OBSERVATION')
-    num_observations = (tb.getcol('TIME_RANGE')).shape[1] #picked an arbitrary column to count the number of observations
-    tb.close()
-
-    tb.open(inputvis)
-    spws = np.unique(tb.getcol('DATA_DESC_ID')) # get the spws [0, 1, 2, 3, 4] and not [0,0,0,0...4,4,4,4]
-    tb.close()
-
+    if (jobs is not None) and interactive:
+        raise ValueError('Imaging jobs can only be run non-interactively')
+    num_observations = read_subtable_column(inputvis, 'OBSERVATION', 'TIME_RANGE').shape[1] #picked an arbitrary column to count the number of observations
+    ddid_col, obs_col = read_columns(inputvis, ['DATA_DESC_ID', 'OBSERVATION_ID'])
+    vms = VirtualMS(inputvis) if is_virtual(inputvis) else None
+
+    tclean_args = dict(specmode         = 'mfs', # to make a continuum image
+                       deconvolver      = 'multiscale',
+                       scales           = scales,
+                       weighting        = 'briggs',
+                       robust           = robust,
+                       imsize           = imsize,
+                       cell             = cellsize,
+                       mask             = mask,
+                       niter            = niter, #we want to end on the threshold
+                       interactive      = interactive,
+                       cycleniter       = cycleniter,
+                       cyclefactor      = 1,
+                       smallscalebias   = smallscalebias, #set to CASA's default of 0.6 unless manually changed
+                       gain             = gain,
+                       nterms           = 1) # Number of Taylor coefficients in the spectral model; nterms=1 : Assume flat spectrum source
+
+    images = [] # imagename, and the tclean arguments that differ between images
     for i in range(num_observations):
         observation = '%d' % i
         print('We do not account for multiple EBs within this EB; check observation = 0, does it? observation = ', observation)
-        imagename = inputvis.replace('.ms', '')
+        if vms is not None:
+            inputvis, observation = vms.locate(observation=i)
+            observation = '%d' % observation
+            spws = np.array([vms.locate(spw=spw)[1] for spw in np.unique(ddid_col[obs_col==i])]) # spw ids in the member
+        else:
+            spws = np.unique(ddid_col) # get the spws [0, 1, 2, 3, 4] and not [0,0,0,0...4,4,4,4]
+        images.append((inputvis.replace('.ms', ''),
+                       {'vis'         : inputvis, # ms to image
+                        'observation' : observation, # to be imaging each observation individually
+                        'spw'         : contspws,
+                        'threshold'   : '%.2fmJy'%(ms_dict['pipeline_cont_cleanthresh'])}))
+        for j in spws:
+            spw = '%d' % j # need it to be a string
+            images.append((inputvis.replace('.ms', '')+'_spw'+spw,
+                           {'vis'         : inputvis,
+                            'observation' : observation,
+                            'spw'         : spw, # one spectral window at a time
+                            'threshold'   : '%.2fmJy'%(ms_dict['pipeline_cont_cleanthresh_perspw'][0][j])}))
+
+    for imagename, args in images:
         for ext in ['.image', '.mask', '.model', '.pb', '.psf', '.residual', '.sumwt']:
             os.system('rm -rf '+ imagename + ext)
-        tclean(vis              = inputvis, # ms to image
-               imagename        = imagename, # file names preceding .image, .residual, etc.
-               observation      = observation, # to be imaging each observation individually
-               specmode         = 'mfs', # to make a continuum image
-               deconvolver      = 'multiscale',
-               scales           = scales,
-               weighting        = 'briggs',
-               robust           = robust,
-               imsize           = imsize,
-               cell             = cellsize,
-               mask             = mask,
-               spw              = contspws,
-               niter            = niter, #we want to end on the threshold
-               threshold        = '%.2fmJy'%(ms_dict['pipeline_cont_cleanthresh']),
-               interactive      = interactive,
-               cycleniter       = cycleniter,
-               cyclefactor      = 1,
-               smallscalebias   = smallscalebias, #set to CASA's default of 0.6 unless manually changed
-               gain             = gain,
-               nterms           = 1) # Number of Taylor coefficients in the spectral model; nterms=1 : Assume flat spectrum source
+        args = dict(tclean_args, imagename=imagename, **args) # file names preceding .image, .residual, etc.
+        if jobs is not None:
+            jobs.append(_imaging_job(imagename, args))
+            continue
+        print('Now imaging '+imagename+' (observation '+args['observation']+', spw '+args['spw']+')')
+        tclean(**args)
         os.system('rm -rf '+ imagename+'.image.fits')
         exportfits(imagename+'.image', imagename+'.image.fits')
         print('Done! Saved fits file: ', imagename+'.image.fits')
 
-        for i in spws:
-            spw = '%d' % i # need it to be a string
-            print('Now imaging spectral window '+spw+' by itself')
-            imagename = inputvis.replace('.ms', '')+'_spw'+spw
-            for ext in ['.image', '.mask', '.model', '.pb', '.psf', '.residual', '.sumwt']:
-                os.system('rm -rf '+ imagename + ext)
-            tclean(vis              = inputvis, # msfile to image
-                   imagename        = imagename, # file names preceding .image, .residual, etc.
-                   observation      = observation, # to be imaging each observation individually
-                   specmode         = 'mfs', # to make a continuum image
-                   deconvolver      = 'multiscale',
-                   scales           = scales,
-                   weighting        = 'briggs',
-                   robust           = robust,
-                   imsize           = imsize,
-                   cell             = cellsize,
-                   mask             = mask,
-                   spw              = spw, # one spectral window at a time
-                   niter            = niter, #we want to end on the threshold
-                   threshold        = '%.2fmJy'%(ms_dict['pipeline_cont_cleanthresh_perspw'][0][i]),
-                   interactive      = interactive,
-                   cycleniter       = cycleniter,
-                   cyclefactor      = 1,
-                   smallscalebias   = smallscalebias, #set to CASA's default of 0.6 unless manually changed
-                   gain             = gain,
-                   nterms           = 1) # Number of Taylor coefficients in the spectral model; nterms=1 : Assume flat spectrum source
-            os.system('rm -rf '+ imagename+'.image.fits')
-            exportfits(imagename+'.image', imagename+'.image.fits')
-            print('Done! Saved fits file: ', imagename+'.image.fits')
+
+def _imaging_job(imagename, tclean_args, mem_gb=6.):
+    """ A tclean call as a job for casa_jobs.run_casa_jobs, in its own working directory. """
+    from casa_jobs import casa_job
+    tclean_args = dict(tclean_args, vis=os.path.abspath(tclean_args['vis']), imagename=os.path.abspath(imagename))
+    job = casa_job(name    = os.path.basename(imagename),
+                   code    = 'tclean(**%r)' % tclean_args,
+                   workdir = None, # set by run_imaging_jobs
+                   mem_gb  = mem_gb,
+                   io      = False, # cleaning is CPU-bound
+                   outputs = [imagename+'.image'])
+    job['imagename'] = imagename
+    return job
+
+
+def run_imaging_jobs(jobs, logdir, max_jobs=None):
+    """
+    Runs the tclean jobs collected by image_each_obs(..., jobs=jobs) in parallel, each in
+    its own CASA process and working directory (logdir/<image name>/). Each image is exported
+    to FITS as soon as its job finishes. Prints the wall time and peak memory of every job.
+
+    Args:
+        jobs (list): Jobs from image_each_obs
+        logdir (string): Directory for the working directories, scripts and logs of the jobs
+        max_jobs (int): Most jobs at once. Default: the number of CPUs (memory permitting)
+    Returns:
+        results (dictionary): As from casa_jobs.run_casa_jobs
+    """
+    from casa_jobs import run_casa_jobs
+
+    def export(job, result):
+        imagename = job['imagename']
+        os.system('rm -rf '+ imagename+'.image.fits')
+        exportfits(imagename+'.image', imagename+'.image.fits')
+        print('Done! Saved fits file: ', imagename+'.image.fits')
+
+    for job in jobs:
+        job['workdir'] = os.path.join(logdir, job['name'])
+    results = run_casa_jobs(jobs, logdir=logdir, max_jobs=max_jobs, retries=1, on_finish=export)
+
+    print('%-40s %8s %10s %8s' % ('image', 'success', 'wall (min)', 'GB'))
+    for job in jobs:
+        result = results[job['name']]
+        print('%-40s %8s %10.1f %8.1f' % (job['name'], result['success'], result['walltime']/60., result['maxrss_gb']))
+    return results
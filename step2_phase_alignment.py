@@ -18,6 +18,10 @@ import alignment
 import sys, os
 import casatasks
 import dictionary_data as ddata # contains data_dict
+from vis_store import export_vis_store
+from uv_alignment import find_offset_uv
+from alignment_registry import is_stale, record_offset, get_offsets
+from virtual_ms import write_virtual_ms
 
 """
 ######################################################
@@ -47,15 +51,38 @@ alignment_npix = {'LB':2000,'SB':500}
 alignment_cell_size = {'LB':0.01,'SB':0.04}
 # alignment_npix = {'LB':1024,'SB':102} # exoALMA
 # alignment_cell_size = {'LB':0.01,'SB':0.1} # exoALMA
-alignment_plot_file_template = 'alignment_uv_grid.png' # this will become a suffix
+
+"""The offsets are kept in a registry (see alignment_registry.py), which step4_detour.py reads too.
+They are only re-derived for EBs whose continuum MS changed since they were recorded
+(or if the reference EB changed)."""
+registry = ddata.data_dict['alignment_offsets']
+reference_LB_EB = [EB for EB in ddata.data_dict['LB_EBs'] if ddata.data_dict[EB]['_initcont_selfcal.ms']==reference_for_LB_alignment][0]
+reference_changed = is_stale(registry, reference_LB_EB, reference_for_LB_alignment)
+recomputed_LB_EBs = []
+reference_for_LB_alignment_store = None
+for EB, offset_ms in zip(ddata.data_dict['LB_EBs'], offset_LB_EBs):
+    if not (reference_changed or is_stale(registry, EB, offset_ms)):
+        print('Alignment offset of '+EB+' is up to date in '+registry)
+        continue
+    if EB==reference_LB_EB:
+        #the fitter fails when computing the offset of an EB to itself
+        offset, offset_err = [0,0], [0,0]
+    else:
+        offset = alignment.find_offset(reference_ms     = reference_for_LB_alignment,
+                                       offset_ms        = offset_ms,
+                                       npix             = alignment_npix['LB'],
+                                       cell_size        = alignment_cell_size['LB'],
+                                       spwid            = continuum_spw_id)
+        if reference_for_LB_alignment_store is None:
+            reference_for_LB_alignment_store = export_vis_store(reference_for_LB_alignment)
+        _, offset_err = find_offset_uv(reference  = reference_for_LB_alignment_store,
+                                       offset     = export_vis_store(offset_ms))
+    record_offset(registry, EB, offset_ms, offset, reference_for_LB_alignment, uncertainty=offset_err)
+    recomputed_LB_EBs.append(EB)
+
 alignment.align_measurement_sets(reference_ms       = reference_for_LB_alignment,
                                  align_ms           = offset_LB_EBs,
-                                 npix               = alignment_npix['LB'],
-                                 cell_size          = alignment_cell_size['LB'],
-                                 spwid              = continuum_spw_id,
-                                 plot_uv_grid       = True,
-                                 plot_file_template = alignment_plot_file_template)
-
+                                 align_offsets      = get_offsets(registry, ddata.data_dict['LB_EBs']))
 
 # This is without per-EB self-cal:
 #New coordinates for /arc/projects/abaur/workflow/step1/ABAur_LB_EB1_initcont.ms
@@ -95,17 +122,16 @@ for EB in ddata.data_dict['LB_EBs']:
     initcont_selfcal          = ddata.data_dict[EB]['_initcont_selfcal.ms']
     initcont_selfcal_shift    = initcont_selfcal.replace('.ms', '_shift.ms')
     os.system('mv '+initcont_selfcal_shift+' ./workflow/step2')
-os.system('mv ./workflow/step1/*'+alignment_plot_file_template+'  ./workflow/step2')
 
 
-alignment_offsets   = {}
-#insert offsets from the alignment output
-alignment_offsets['LB_EB1'] = [0,0]
-alignment_offsets['LB_EB2'] = [-0.019783,0.0046808]
-alignment_offsets['LB_EB3'] = [-0.012707,0.001336]
-alignment_offsets['LB_EB4'] = [0.023685,-0.021869]
-alignment_offsets['LB_EB5'] = [-0.020729,-0.01054]
-alignment_offsets['LB_EB6'] = [-0.0045512,-0.0276]
+alignment_offsets   = dict(zip(ddata.data_dict['LB_EBs'], get_offsets(registry, ddata.data_dict['LB_EBs'])))
+# with per-EB self-cal, these were:
+# alignment_offsets['LB_EB1'] = [0,0]
+# alignment_offsets['LB_EB2'] = [-0.019783,0.0046808]
+# alignment_offsets['LB_EB3'] = [-0.012707,0.001336]
+# alignment_offsets['LB_EB4'] = [0.023685,-0.021869]
+# alignment_offsets['LB_EB5'] = [-0.020729,-0.01054]
+# alignment_offsets['LB_EB6'] = [-0.0045512,-0.0276]
 
 shifted_LB_EBs = [ddata.data_dict[EB]['_initcont_selfcal_shift.ms'] for EB in ddata.data_dict['LB_EBs']]
 print('List of long baseline execution blocks that have been aligned: ', shifted_LB_EBs)
@@ -124,6 +150,15 @@ for i,shifted_ms in enumerate(shifted_LB_EBs):
                                    spwid            = continuum_spw_id)
     print(f'#offset for {shifted_ms}: ',offset)
 
+"""Same check, but much cheaper: fit the phase gradient between the exported visibilities
+in overlapping uv cells (see uv_alignment.py). Cheap enough to re-run after every change."""
+if reference_for_LB_alignment_store is None:
+    reference_for_LB_alignment_store = export_vis_store(reference_for_LB_alignment)
+for shifted_ms in shifted_LB_EBs[1:]:
+    offset, offset_err = find_offset_uv(reference  = reference_for_LB_alignment_store,
+                                        offset     = export_vis_store(shifted_ms))
+    print(f'#uv offset for {shifted_ms}: ', offset, '+/-', offset_err)
+
 # This is without per-EB self-cal:
 #offset for /arc/projects/abaur/workflow/step2_noselfcal/ABAur_LB_EB1_initcont_shift.ms:  [-4.51798589e-10 -3.36817461e-09]
 #offset for /arc/projects/abaur/workflow/step2_noselfcal/ABAur_LB_EB2_initcont_shift.ms:  [-1.42397170e-06 -3.31838587e-05]
@@ -141,14 +176,11 @@ for i,shifted_ms in enumerate(shifted_LB_EBs):
 
 
 """Merge shifted LB EBs for aligning SB EBs"""
-# print('Concatenating shifted LB EBs for aligning SB EBs...')
+"""This used to be a physical concat (a full copy of the LB data) that was only ever read.
+Now it's a virtual concatenation (see virtual_ms.py): a manifest of the shifted LB EBs."""
 path, _ = os.path.split(shifted_LB_EBs[0])
-LB_concat_shifted = path + '/ABAur_LB_concat_shifted.ms'
-os.system(f'rm -rf {LB_concat_shifted}')
-casatasks.concat(vis            = shifted_LB_EBs,
-                 concatvis      = LB_concat_shifted,
-                 dirtol         = '0.1arcsec',
-                 copypointing   = False)
+LB_concat_shifted = path + '/ABAur_LB_concat_shifted.vms'
+write_virtual_ms(shifted_LB_EBs, LB_concat_shifted)
 
 
 """
@@ -159,17 +191,38 @@ casatasks.concat(vis            = shifted_LB_EBs,
 
 """Align SB EBs to concat shifted LB EBs"""
 reference_for_SB_alignment = LB_concat_shifted
+"""alignment.find_offset and align_measurement_sets need a real MS to read: give them the shifted
+reference LB EB (as step4_detour.py does for the lines), which has the phase center of the
+concatenation, rather than writing a copy of all the LB EBs. The uv phase gradient fit reads the
+whole virtual concatenation, so every SB EB gets both offsets printed side by side, as a check
+that the reference LB EB stands in for the concatenation."""
+reference_for_SB_alignment_ms = ddata.data_dict[reference_LB_EB]['_initcont_selfcal_shift.ms']
 
 offset_SB_EBs = [ddata.data_dict[EB]['_initcont_selfcal.ms'] for EB in ddata.data_dict['SB_EBs']]
 print('List of short baseline execution blocks to be aligned: ', offset_SB_EBs)
 
-alignment.align_measurement_sets(reference_ms       = reference_for_SB_alignment,
+"""The SB offsets depend on the LB alignment too, so re-derive them if any LB offset changed"""
+reference_for_SB_alignment_store = None
+for EB, offset_ms in zip(ddata.data_dict['SB_EBs'], offset_SB_EBs):
+    if (len(recomputed_LB_EBs)==0) and not is_stale(registry, EB, offset_ms):
+        print('Alignment offset of '+EB+' is up to date in '+registry)
+        continue
+    offset = alignment.find_offset(reference_ms     = reference_for_SB_alignment_ms,
+                                   offset_ms        = offset_ms,
+                                   npix             = alignment_npix['SB'],
+                                   cell_size        = alignment_cell_size['SB'],
+                                   spwid            = continuum_spw_id)
+    if reference_for_SB_alignment_store is None:
+        reference_for_SB_alignment_store = export_vis_store(reference_for_SB_alignment)
+    offset_uv, offset_err = find_offset_uv(reference  = reference_for_SB_alignment_store,
+                                           offset     = export_vis_store(offset_ms))
+    print(f'#offset for {offset_ms} to {reference_for_SB_alignment_ms}: ', offset,
+          f'; uv offset to {reference_for_SB_alignment}: ', offset_uv, '+/-', offset_err)
+    record_offset(registry, EB, offset_ms, offset, reference_for_SB_alignment_ms, uncertainty=offset_err)
+
+alignment.align_measurement_sets(reference_ms       = reference_for_SB_alignment_ms,
                                  align_ms           = offset_SB_EBs,
-                                 npix               = alignment_npix['SB'],
-                                 cell_size          = alignment_cell_size['SB'],
-                                 spwid              = continuum_spw_id,
-                                 plot_uv_grid       = True,
-                                 plot_file_template = alignment_plot_file_template)
+                                 align_offsets      = get_offsets(registry, ddata.data_dict['SB_EBs']))
 
 # This is without per-EB self-cal:
 #New coordinates for /arc/projects/abaur/workflow/step1/ABAur_SB_EB1_initcont.ms
@@ -194,12 +247,12 @@ for EB in ddata.data_dict['SB_EBs']:
     initcont_selfcal          = ddata.data_dict[EB]['_initcont_selfcal.ms']
     initcont_selfcal_shift    = initcont_selfcal.replace('.ms', '_shift.ms')
     os.system('mv '+initcont_selfcal_shift+' ./workflow/step2')
-os.system('mv ./workflow/step1/*'+alignment_plot_file_template+'  ./workflow/step2')
 
 
-#insert offsets from the alignment output
-alignment_offsets['SB_EB1'] = [-0.013133,0.03949]
-alignment_offsets['SB_EB2'] = [0.11922,-0.19222]
+alignment_offsets.update(zip(ddata.data_dict['SB_EBs'], get_offsets(registry, ddata.data_dict['SB_EBs'])))
+# with per-EB self-cal, these were:
+# alignment_offsets['SB_EB1'] = [-0.013133,0.03949]
+# alignment_offsets['SB_EB2'] = [0.11922,-0.19222]
 
 shifted_SB_EBs = [ddata.data_dict[EB]['_initcont_selfcal_shift.ms'] for EB in ddata.data_dict['SB_EBs']]
 print('List of short baseline execution blocks that have been aligned: ', shifted_LB_EBs)
@@ -207,13 +260,20 @@ print('List of short baseline execution blocks that have been aligned: ', shifte
 """Again: to check if alignment worked, calculate shift again and verify that shifts are small (i.e.
 a fraction of the cell size):"""
 for shifted_ms in shifted_SB_EBs:
-    offset = alignment.find_offset(reference_ms     = reference_for_SB_alignment,
+    offset = alignment.find_offset(reference_ms     = reference_for_SB_alignment_ms,
                                    offset_ms        = shifted_ms,
                                    npix             = alignment_npix['SB'],
                                    cell_size        = alignment_cell_size['SB'],
                                    spwid            = continuum_spw_id)
     print(f'#offset for {shifted_ms}: ',offset)
 
+if reference_for_SB_alignment_store is None:
+    reference_for_SB_alignment_store = export_vis_store(reference_for_SB_alignment)
+for shifted_ms in shifted_SB_EBs:
+    offset, offset_err = find_offset_uv(reference  = reference_for_SB_alignment_store,
+                                        offset     = export_vis_store(shifted_ms))
+    print(f'#uv offset for {shifted_ms}: ', offset, '+/-', offset_err)
+
 # This is without per-EB self-cal:
 #offset for /arc/projects/abaur/workflow/step2_noselfcal/ABAur_SB_EB1_initcont_shift.ms:  [0.00044042 0.00118166]
 #offset for /arc/projects/abaur/workflow/step2_noselfcal/ABAur_SB_EB2_initcont_shift.ms:  [ 0.00026603 -0.00286368]
@@ -240,6 +300,7 @@ for EB in ddata.data_dict['EBs']:
     casatasks.listobs(vis=vis, listfile=vis+'.listobs.txt')
 
 """Merge shifted SB EBs for continuing into step 3: self calibration"""
+"""(This one has to be a real MS: step 3 runs gaincal and applycal on it.)"""
 print('Concatenating shifted SB EBs...')
 path, _ = os.path.split(shifted_SB_EBs[0])
 SB_concat_shifted = path + '/ABAur_SB_concat_shifted_contp0.ms'
@@ -249,7 +310,7 @@ casatasks.concat(vis            = shifted_SB_EBs,
                  dirtol         = '0.1arcsec',
                  copypointing   = False)
 
-"""Move concatenated shifted LB and SB EBs to step 3 folder"""
+"""Move concatenated shifted LB (virtual) and SB EBs to step 3 folder"""
 os.system('mv '+SB_concat_shifted+' '+ddata.data_dict['NRAO_path']+'workflow/step3')
 os.system('mv '+LB_concat_shifted+' '+ddata.data_dict['NRAO_path']+'workflow/step3')
 
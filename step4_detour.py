@@ -18,6 +18,7 @@ import alignment
 import sys, os
 import casatasks
 import dictionary_data as ddata # contains data_dict
+from alignment_registry import get_offsets
 
 """
 ######################################################
@@ -36,15 +37,11 @@ offset_LB_EBs       = [ddata.data_dict[EB]['_initlines.ms'] for EB in ddata.data
 print('List of long baseline execution blocks to be aligned: ', offset_LB_EBs)
 
 """Update the phase centers for all offset_EBs using the offset values determined
-for the continuum, from script step2_phase_alignment.py."""
-alignment_offsets   = []
-#insert offsets from the alignment output
-alignment_offsets.append([0,0])
-alignment_offsets.append([-0.019783,0.0046808])
-alignment_offsets.append([-0.012707,0.001336])
-alignment_offsets.append([0.023685,-0.021869])
-alignment_offsets.append([-0.020729,-0.01054])
-alignment_offsets.append([-0.0045512,-0.0276])
+for the continuum, from script step2_phase_alignment.py (read from its offsets registry;
+this fails if the continuum MS of any EB changed since its offset was recorded)."""
+alignment_offsets   = get_offsets(ddata.data_dict['alignment_offsets'], ddata.data_dict['LB_EBs'])
+# with per-EB self-cal, these were:
+# [[0,0], [-0.019783,0.0046808], [-0.012707,0.001336], [0.023685,-0.021869], [-0.020729,-0.01054], [-0.0045512,-0.0276]]
 
 print('Aligning the long baseline execution blocks with the following offsets: ', alignment_offsets)
 alignment.align_measurement_sets(reference_ms       = reference_for_LB_alignment,
@@ -73,11 +70,10 @@ offset_SB_EBs = [ddata.data_dict[EB]['_initlines.ms'] for EB in ddata.data_dict[
 print('List of short baseline execution blocks to be aligned: ', offset_SB_EBs)
 
 """Update the phase centers for all offset_EBs using the offset values determined
-for the continuum, from script step2_phase_alignment.py."""
-alignment_offsets   = []
-#insert offsets from the alignment output
-alignment_offsets.append([-0.013133,0.03949])
-alignment_offsets.append([0.11922,-0.19222])
+for the continuum, from script step2_phase_alignment.py (read from its offsets registry)."""
+alignment_offsets   = get_offsets(ddata.data_dict['alignment_offsets'], ddata.data_dict['SB_EBs'])
+# with per-EB self-cal, these were:
+# [[-0.013133,0.03949], [0.11922,-0.19222]]
 
 print('Aligning the long baseline execution blocks with the following offsets: ', alignment_offsets)
 alignment.align_measurement_sets(reference_ms       = reference_for_SB_alignment,
@@ -52,6 +52,22 @@ import sys
 sys.path.append(data_dict['NRAO_path']+'analysis_scripts') # path to analysis_scripts/
 import analysisUtils as au
 
+""" The per-EB stages below (applycal+split, uvcontsub) are independent between EBs, so each
+EB runs in its own CASA process (see casa_jobs.py), with its own log in ./workflow/step4/jobs/.
+The number at once is capped by memory and by how many MS-heavy jobs lustre keeps up with. """
+from casa_jobs import casa_job, run_casa_jobs, check_casa_jobs
+step4_setup       = """execfile('dictionary_disk.py')
+execfile('dictionary_data.py')
+execfile('step1_utils.py')
+import sys
+sys.path.append(data_dict['NRAO_path']+'analysis_scripts')
+import analysisUtils as au
+from uv_contsub import fast_uvcontsub, compare_visibilities
+from ms_spectra import plot_amp_vs_uvdist, plot_amp_vs_channel, load_spectra
+uv_binwidth = 10. # m; the bins of the amp vs. uv-distance plots"""
+step4_max_jobs    = 4
+step4_max_io_jobs = 3
+
 '''
 Note on where we begin:
 We downloaded the entire data set from the ALMA Archive and restored the
@@ -263,33 +279,42 @@ To apply all BB caltables to LB6, gaintable=[BB_contp1.cal,    BB_contp2.cal,
 ####################################################
 """
 # this takes ~1hr per EB (so 2hr total)
-for EB in data_dict['SB_EBs']:
-    inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_shift.ms']
-    os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms'))
-    outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms'] # half selfcal
-    dir4lasts           = outputvis.replace('.ms', '/')
-    os.system('mkdir '+dir4lasts)
-
-    vis         = inputvis
-    gaintable   = data_dict['SB_selfcaltables']
-    spw         = ''
-    spwmap      = data_dict[EB]['SB_selfcaltables_spwmap']
-    applymode   = 'calflag'
-    interp      = ['linearPD' for gaintab in gaintable]
-    calwt       = True
-
-    applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
-
-    os.system('rm -rf ' + outputvis)
-    split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False)
-    listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
-
-    for spwi in data_dict[EB]['line_spws']:
-        plotms(vis=inputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=inputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-        plotms(vis=outputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=outputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-
-    os.system('mv *.last '+dir4lasts)
-    os.system('rm -rf ' + inputvis)
+SB_apply_SB_job = """
+inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_shift.ms']
+os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms'))
+outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms'] # half selfcal
+dir4lasts           = outputvis.replace('.ms', '/')
+os.system('mkdir '+dir4lasts)
+
+vis         = inputvis
+gaintable   = [os.path.join(launch_dir, caltable) for caltable in data_dict['SB_selfcaltables']] # the job runs in dir4lasts
+spw         = ''
+spwmap      = data_dict[EB]['SB_selfcaltables_spwmap']
+applymode   = 'calflag'
+interp      = ['linearPD' for gaintab in gaintable]
+calwt       = True
+
+applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
+
+os.system('rm -rf ' + outputvis)
+split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False)
+listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
+
+for plotvis in [inputvis, outputvis]: # one read per MS for all its line spws, instead of a plotms call per spw
+    spectra = accumulate_spectra(plotvis, datacolumn='data', spws=list(data_dict[EB]['line_spws']), uv_binwidth=uv_binwidth)
+    save_spectra(spectra, plotvis+'_spectra.npz')
+    plot_amp_vs_uvdist(spectra, plotvis)
+
+os.system('rm -rf ' + inputvis)
+"""
+jobs    = [casa_job(name    = EB+'_apply_SB',
+                    code    = "EB = '%s'\n" % EB + SB_apply_SB_job,
+                    setup   = step4_setup,
+                    workdir = data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms'].replace('.ms', '/'), # where its .last files go
+                    mem_gb  = 8.,
+                    outputs = [data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms']]) for EB in data_dict['SB_EBs']]
+results = run_casa_jobs(jobs, logdir='./workflow/step4/jobs/', max_jobs=step4_max_jobs, max_io_jobs=step4_max_io_jobs)
+check_casa_jobs(results, stage='applycal of the SB caltables to the SB EBs')
 
 
 """
@@ -299,33 +324,42 @@ for EB in data_dict['SB_EBs']:
 """
 
 # this takes ~40min per EB (so 1hr20min total)
-for EB in data_dict['SB_EBs']:
-    inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms'] # start with the "half selfcal" (SBcaltable-selfcal'ed SB data)
-    os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms'))
-    outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'] # full selfcal
-    dir4lasts           = outputvis.replace('.ms', '/')
-    os.system('mkdir '+dir4lasts)
-
-    vis         = inputvis
-    gaintable   = data_dict['BB_selfcaltables']
-    spw         = ''
-    spwmap      = data_dict[EB]['BB_selfcaltables_spwmap']
-    applymode   = 'calonly' # 0% of data flagged
-    interp      = ['linearPD' for gaintab in gaintable]
-    calwt       = True
-
-    applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
-
-    os.system('rm -rf ' + outputvis)
-    split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False, timebin='30s') # time average now to save space
-    listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
-
-    for spwi in data_dict[EB]['line_spws']:
-        plotms(vis=inputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=inputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-        plotms(vis=outputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=outputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-
-    os.system('mv *.last '+dir4lasts)
-    os.system('rm -rf ' + inputvis)
+SB_apply_BB_job = """
+inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_SBselfcal.ms'] # start with the "half selfcal" (SBcaltable-selfcal'ed SB data)
+os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms'))
+outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'] # full selfcal
+dir4lasts           = outputvis.replace('.ms', '/')
+os.system('mkdir '+dir4lasts)
+
+vis         = inputvis
+gaintable   = [os.path.join(launch_dir, caltable) for caltable in data_dict['BB_selfcaltables']] # the job runs in dir4lasts
+spw         = ''
+spwmap      = data_dict[EB]['BB_selfcaltables_spwmap']
+applymode   = 'calonly' # 0% of data flagged
+interp      = ['linearPD' for gaintab in gaintable]
+calwt       = True
+
+applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
+
+os.system('rm -rf ' + outputvis)
+split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False, timebin='30s') # time average now to save space
+listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
+
+for plotvis in [inputvis, outputvis]: # one read per MS for all its line spws, instead of a plotms call per spw
+    spectra = accumulate_spectra(plotvis, datacolumn='data', spws=list(data_dict[EB]['line_spws']), uv_binwidth=uv_binwidth)
+    save_spectra(spectra, plotvis+'_spectra.npz')
+    plot_amp_vs_uvdist(spectra, plotvis)
+
+os.system('rm -rf ' + inputvis)
+"""
+jobs    = [casa_job(name    = EB+'_apply_BB',
+                    code    = "EB = '%s'\n" % EB + SB_apply_BB_job,
+                    setup   = step4_setup,
+                    workdir = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'].replace('.ms', '/'), # where its .last files go
+                    mem_gb  = 8.,
+                    outputs = [data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']]) for EB in data_dict['SB_EBs']]
+results = run_casa_jobs(jobs, logdir='./workflow/step4/jobs/', max_jobs=step4_max_jobs, max_io_jobs=step4_max_io_jobs)
+check_casa_jobs(results, stage='applycal of the BB caltables to the SB EBs')
 
 
 
@@ -336,34 +370,43 @@ for EB in data_dict['SB_EBs']:
 ####################################################
 """
 # 1hr 10min per EB
-for EB in data_dict['LB_EBs']:
-    print('/n--> Working on ', EB)
-    inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_shift.ms']
-    # os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms')) # too much space
-    outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']
-    dir4lasts           = outputvis.replace('.ms', '/')
-    os.system('mkdir '+dir4lasts)
-
-    vis         = inputvis
-    gaintable   = data_dict['BB_selfcaltables']
-    spw         = ''
-    spwmap      = data_dict[EB]['BB_selfcaltables_spwmap']
-    applymode   = 'calonly' # 0% of data will be flagged
-    interp      = ['linearPD' for gaintab in gaintable]
-    calwt       = True
-
-    applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
-
-    os.system('rm -rf ' + outputvis)
-    split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False, timebin='30s') # time average now to save space
-    listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
-
-    for spwi in data_dict[EB]['line_spws']:
-        plotms(vis=inputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=inputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-        plotms(vis=outputvis, yaxis='amp', xaxis='UVdist', avgtime='1e8', spw=str(spwi), plotfile=outputvis+'_amp-vs-UVdist_spw'+str(spwi)+'.png', showgui=False, ydatacolumn='data', overwrite=True)
-
-    os.system('mv *.last '+dir4lasts)
-    os.system('rm -rf ' + inputvis)
+LB_apply_BB_job = """
+print('/n--> Working on ', EB)
+inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_shift.ms']
+# os.system('cp -r '+inputvis+' '+inputvis.replace('.ms', '.keepsafe.ms')) # too much space
+outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']
+dir4lasts           = outputvis.replace('.ms', '/')
+os.system('mkdir '+dir4lasts)
+
+vis         = inputvis
+gaintable   = [os.path.join(launch_dir, caltable) for caltable in data_dict['BB_selfcaltables']] # the job runs in dir4lasts
+spw         = ''
+spwmap      = data_dict[EB]['BB_selfcaltables_spwmap']
+applymode   = 'calonly' # 0% of data will be flagged
+interp      = ['linearPD' for gaintab in gaintable]
+calwt       = True
+
+applycal(vis=vis, spw=spw, gaintable=gaintable, interp=interp, applymode=applymode, calwt=calwt, spwmap=spwmap)
+
+os.system('rm -rf ' + outputvis)
+split(vis=vis, outputvis=outputvis, datacolumn='corrected', keepflags=False, timebin='30s') # time average now to save space
+listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
+
+for plotvis in [inputvis, outputvis]: # one read per MS for all its line spws, instead of a plotms call per spw
+    spectra = accumulate_spectra(plotvis, datacolumn='data', spws=list(data_dict[EB]['line_spws']), uv_binwidth=uv_binwidth)
+    save_spectra(spectra, plotvis+'_spectra.npz')
+    plot_amp_vs_uvdist(spectra, plotvis)
+
+os.system('rm -rf ' + inputvis)
+"""
+jobs    = [casa_job(name    = EB+'_apply_BB',
+                    code    = "EB = '%s'\n" % EB + LB_apply_BB_job,
+                    setup   = step4_setup,
+                    workdir = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'].replace('.ms', '/'), # where its .last files go
+                    mem_gb  = 8.,
+                    outputs = [data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']]) for EB in data_dict['LB_EBs']]
+results = run_casa_jobs(jobs, logdir='./workflow/step4/jobs/', max_jobs=step4_max_jobs, max_io_jobs=step4_max_io_jobs)
+check_casa_jobs(results, stage='applycal of the BB caltables to the LB EBs')
 
 
 """
@@ -372,78 +415,71 @@ for EB in data_dict['LB_EBs']:
 ####################################################
 """
 
-for EB in data_dict['EBs']: # this takes 1hr10min per LB EB
-    inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']
-    outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms.contsub']
-    spw                 = '1, 2, 3, 4' # only line spws; they will be renumbered 0,1,2,3
-    combine             = '' # break at scan, field, and spw
-    fitorder            = 1 # order of polynomial fit; default is 0; DSHARP uses 1 so we copy them
-    solint              = 'int' # Timescale for per-baseline fit. default (recommended): ‘int’, i.e. no time averaging, do a fit for each integration and let the noisy fits average out in the image.continuum
-    excludechans        = False # the channels in fitspw will be used to fit the continuum
-    want_cont           = False # we don't need another ms to hold the continuum estimate
-
-    flagchannels_string = get_flagchannels(ms_file          = inputvis,
-                                           ms_dict          = data_dict[EB],
-                                           velocity_range   = data_dict[EB]['velocity_ranges'])
-    fitspw = au.invertChannelRanges(flagchannels_string, vis=inputvis)
-    # Flagchannels input string for SB_EB1: '1:517~589,       2:504~600,       3:961~1251,        4:556~1059'
-    #                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~960;1252~1919, 4:0~555;1060~1919
-    # Flagchannels input string for SB_EB2: '1:517~589,       2:504~600,       3:962~1251,        4:554~1058'
-    #                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~961;1252~1919, 4:0~553;1059~1919
-    # Flagchannels input string for LB_EB1: '1:516~589,       2:504~600,       3:960~1249,        4:553~1057'
-    #                               fitspw:  1:0~515;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
-    # Flagchannels input string for LB_EB2: '1:517~589,       2:504~600,       3:960~1249,        4:553~1057'
-    #                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
-    # Flagchannels input string for LB_EB3: '1:517~589,       2:505~601,       3:960~1249,        4:553~1057'
-    #                               fitspw:  1:0~516;590~959, 2:0~504;602~959, 3:0~959;1250~1919, 4:0~552;1058~1919
-    # Flagchannels input string for LB_EB4: '1:516~589,       2:504~600,       3:960~1249,        4:553~1057'
-    #                               fitspw:  1:0~515;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
-    # Flagchannels input string for LB_EB5: '1:516~588,       2:504~600,       3:960~1250,        4:553~1057'
-    #                               fitspw:  1:0~515;589~959, 2:0~503;601~959, 3:0~959;1251~1919, 4:0~552;1058~1919
-    # Flagchannels input string for LB_EB6: '1:517~589,       2:505~601,       3:960~1249,        4:553~1057'
-    #                               fitspw:  1:0~516;590~959, 2:0~504;602~959, 3:0~959;1250~1919, 4:0~552;1058~1919
-
-    os.system('rm -rf ' + outputvis)
+""" uvcontsub takes 1hr10min per LB EB, nearly all of it fitting. fast_uvcontsub (uv_contsub.py) does the
+same fit in numpy, a matrix multiply per chunk of rows, and is limited by reading and writing the MS instead.
+Set contsub_engine to 'uvcontsub' to go back to the CASA task; validate_contsub_EB runs both on that EB
+and compares them (the smallest, SB_EB2, is the quickest check). """
+contsub_engine      = 'numpy' # 'numpy' or 'uvcontsub'
+validate_contsub_EB = None # e.g. 'SB_EB2'
+contsub_job = """
+inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']
+outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms.contsub']
+spw                 = '1, 2, 3, 4' # only line spws; they will be renumbered 0,1,2,3
+combine             = '' # break at scan, field, and spw
+fitorder            = 1 # order of polynomial fit; default is 0; DSHARP uses 1 so we copy them
+solint              = 'int' # Timescale for per-baseline fit. default (recommended): ‘int’, i.e. no time averaging, do a fit for each integration and let the noisy fits average out in the image.continuum
+excludechans        = False # the channels in fitspw will be used to fit the continuum
+want_cont           = False # we don't need another ms to hold the continuum estimate
+
+flagchannels_string = get_flagchannels(ms_file          = inputvis,
+                                       ms_dict          = data_dict[EB],
+                                       velocity_range   = data_dict[EB]['velocity_ranges'])
+fitspw = au.invertChannelRanges(flagchannels_string, vis=inputvis)
+# Flagchannels input string for SB_EB1: '1:517~589,       2:504~600,       3:961~1251,        4:556~1059'
+#                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~960;1252~1919, 4:0~555;1060~1919
+# Flagchannels input string for SB_EB2: '1:517~589,       2:504~600,       3:962~1251,        4:554~1058'
+#                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~961;1252~1919, 4:0~553;1059~1919
+# Flagchannels input string for LB_EB1: '1:516~589,       2:504~600,       3:960~1249,        4:553~1057'
+#                               fitspw:  1:0~515;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
+# Flagchannels input string for LB_EB2: '1:517~589,       2:504~600,       3:960~1249,        4:553~1057'
+#                               fitspw:  1:0~516;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
+# Flagchannels input string for LB_EB3: '1:517~589,       2:505~601,       3:960~1249,        4:553~1057'
+#                               fitspw:  1:0~516;590~959, 2:0~504;602~959, 3:0~959;1250~1919, 4:0~552;1058~1919
+# Flagchannels input string for LB_EB4: '1:516~589,       2:504~600,       3:960~1249,        4:553~1057'
+#                               fitspw:  1:0~515;590~959, 2:0~503;601~959, 3:0~959;1250~1919, 4:0~552;1058~1919
+# Flagchannels input string for LB_EB5: '1:516~588,       2:504~600,       3:960~1250,        4:553~1057'
+#                               fitspw:  1:0~515;589~959, 2:0~503;601~959, 3:0~959;1251~1919, 4:0~552;1058~1919
+# Flagchannels input string for LB_EB6: '1:517~589,       2:505~601,       3:960~1249,        4:553~1057'
+#                               fitspw:  1:0~516;590~959, 2:0~504;602~959, 3:0~959;1250~1919, 4:0~552;1058~1919
+
+os.system('rm -rf ' + outputvis)
+if (contsub_engine=='uvcontsub') or (EB==validate_contsub_EB):
     uvcontsub(vis=inputvis, spw=spw, combine=combine, fitorder=fitorder,
                        solint=solint, excludechans=excludechans, want_cont=want_cont,
                        fitspw=fitspw)
-    listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
-    for spwi in data_dict[EB]['line_spws']:
-        plotms(vis=inputvis, yaxis='amp', xaxis='channel', avgtime='1e8', avgspw=False, avgscan=True, avgbaseline=True, spw=str(spwi), plotfile=inputvis+'_amp-vs-channel_spw'+str(spwi)+'.png', showgui=False, overwrite=True)
-        plotms(vis=outputvis, yaxis='amp', xaxis='channel', avgtime='1e8', avgspw=False, avgscan=True, avgbaseline=True, spw=str(spwi-1), plotfile=outputvis+'_amp-vs-channel_spw'+str(spwi)+'.png', showgui=False, overwrite=True)
-
-
-
-
-"""
-#############################################################
-###################### SPLIT OUT SPWS #######################
-#############################################################
+if contsub_engine=='numpy':
+    if EB==validate_contsub_EB:
+        os.system('rm -rf ' + outputvis+'.uvcontsub')
+        os.system('mv ' + outputvis + ' ' + outputvis+'.uvcontsub')
+    fast_uvcontsub(vis=inputvis, outputvis=outputvis, spw=spw, fitspw=fitspw, fitorder=fitorder) # solint='int', combine='' as above
+    if EB==validate_contsub_EB:
+        compare_visibilities(outputvis, outputvis+'.uvcontsub')
+listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
+line_spws = list(data_dict[EB]['line_spws'])
+plot_amp_vs_channel(load_spectra(inputvis+'_spectra.npz'), inputvis) # saved when inputvis was split out, above
+plot_amp_vs_channel(accumulate_spectra(outputvis, datacolumn='data', spws=[spwi-1 for spwi in line_spws]), outputvis,
+                    spw_labels={spwi-1: spwi for spwi in line_spws}) # the contsub'ed MS has the line spws renumbered from 0
 """
+jobs    = [casa_job(name    = EB+'_contsub',
+                    code    = "EB = '%s'\ncontsub_engine = '%s'\nvalidate_contsub_EB = %r\n" % (EB, contsub_engine, validate_contsub_EB) + contsub_job,
+                    setup   = step4_setup,
+                    workdir = './workflow/step4/jobs/'+EB+'_contsub/',
+                    mem_gb  = 8.,
+                    outputs = [data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms.contsub']]) for EB in data_dict['EBs']]
+results = run_casa_jobs(jobs, logdir='./workflow/step4/jobs/', max_jobs=step4_max_jobs, max_io_jobs=step4_max_io_jobs)
+check_casa_jobs(results, stage='continuum subtraction')
 
-""" Note we originally performed velocity regridding with cvel2 at this time.
-But as we later would like to image on an arbitrary velocity regrid, we will not
-do any regridding. """
-
-""" First do non-continuum-subtracted ms's (contains spws 0,1,2,3,4) """
-for EB in data_dict['EBs']:
-    for i,spwi in enumerate(['1', '2', '3', '4']):
-        inputvis            = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms']
-        outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'].replace('.ms', '_spw'+str(i)+'.ms') # want i instead of spwi to align with contsub indexing
 
-        os.system('rm -rf ' + outputvis)
-        split(vis=inputvis, outputvis=outputvis, spw=spwi, datacolumn='data') # here, spws are indexed 1,2,3,4
-        listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
-
-""" Second do continuum-subtracted ms's (contains spws 0,1,2,3) """
-for EB in data_dict['EBs']:
-    for i,spwi in enumerate(['0', '1', '2', '3']):
-        inputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms.contsub']
-        outputvis           = data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms.contsub'].replace('.ms', '_spw'+spwi+'.ms') # want spwi now
-
-        os.system('rm -rf ' + outputvis)
-        split(vis=inputvis, outputvis=outputvis, spw=spwi, datacolumn='data') # here, spws are indexed 0,1,2,3
-        listobs(vis=outputvis, listfile=outputvis+'.listobs.txt')
 
 
 """
@@ -451,48 +487,60 @@ for EB in data_dict['EBs']:
 ########### COMBINE FINAL MEASUREMENT SETS, ONE FOR EACH LINE, AND SAVE ############
 ####################################################################################
 """
-molecules = ['SO', 'C18O', '13CO', '12CO']
-
-""" First do non-continuum-subtracted ms's """
-for spwi,molecule in enumerate(molecules):
-    ms_list_to_concatenate = []
-    for EB in data_dict['EBs']:
-        ms_list_to_concatenate.append(data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'].replace('.ms', '_spw'+str(spwi)+'.ms'))
 
-    print('For molecule: ', molecule)
-    print('Combining spectral window '+str(spwi)+' across these measurement sets:', ms_list_to_concatenate)
-
-    final_line_ms = 'ABAur_'+molecule+'.bin30s.ms'
-
-    os.system('rm -rf %s*' % final_line_ms)
-    concat(vis          = ms_list_to_concatenate,
-           concatvis    = final_line_ms,
-           dirtol       = '0.1arcsec',
-           copypointing = False)
-    listobs(vis=final_line_ms, listfile=final_line_ms+'.listobs.txt')
-    os.system('tar cvzf backups/' + final_line_ms+'.tgz ' + final_line_ms)
-
-
-""" Second do continuum-subtracted ms's (contains spws 0,1,2,3) """
-for spwi,molecule in enumerate(molecules):
-    ms_list_to_concatenate = []
-    for EB in data_dict['EBs']:
-        ms_list_to_concatenate.append(data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'].replace('.ms', '_spw'+str(spwi)+'.ms')+'.contsub')
-
-    print('For molecule: ', molecule)
-    print('Combining spectral window '+str(spwi)+' across these measurement sets:', ms_list_to_concatenate)
-
-    final_line_ms = 'ABAur_'+molecule+'.bin30s.ms.contsub'
+""" Note we originally performed velocity regridding with cvel2 at this time.
+But as we later would like to image on an arbitrary velocity regrid, we will not
+do any regridding. """
 
-    os.system('rm -rf %s*' % final_line_ms)
-    concat(vis          = ms_list_to_concatenate,
-           concatvis    = final_line_ms,
-           dirtol       = '0.1arcsec',
-           copypointing = False)
-    listobs(vis=final_line_ms, listfile=final_line_ms+'.listobs.txt')
-    os.system('tar cvzf backups/' + final_line_ms+'.tgz ' + final_line_ms)
+""" We used to split every EB into one MS per spw (8 EBs x 4 spws x 2 = 64 MSs), and then
+concat those per molecule, so every line visibility was written twice. Instead, the EBs are
+virtually concatenated into a multi-MS (virtualconcat moves them into it, as its SUBMSS/,
+without copying any data), and each molecule is split straight out of that: the 64
+intermediate MSs are gone, and the line data are written once.
+The spws of a molecule get renumbered by the concatenation, so they are looked up by
+their channel frequencies, read before the EBs are moved.
+Since the EBs are moved, the multi-MS holds the only copy of them: on a rerun, an existing
+multi-MS is reused (and the frequencies read from its SUBMSS/), and it's only replaced when
+all the EBs are there again (e.g. re-made by the stages above). """
+from virtual_ms import spw_frequencies, concat_spw_ids
+from ms_backup import backup_ms
+molecules = ['SO', 'C18O', '13CO', '12CO']
 
-os.system('mv ABAur*.tgz backups/')
+for suffix, line_spws in [('',         [1, 2, 3, 4]),  # non-continuum-subtracted ms's (contain spws 0,1,2,3,4)
+                          ('.contsub', [0, 1, 2, 3])]: # continuum-subtracted ms's (contain spws 0,1,2,3)
+    ms_list_to_concatenate = [data_dict['NRAO_path']+data_dict[EB]['_initlines_selfcal.ms'+suffix] for EB in data_dict['EBs']]
+    lines_mms              = data_dict['NRAO_path']+'ABAur_lines.bin30s.mms'+suffix
+    submss_list            = [os.path.join(lines_mms, 'SUBMSS', os.path.basename(msfile)) for msfile in ms_list_to_concatenate]
+
+    if all(os.path.isdir(msfile) for msfile in ms_list_to_concatenate):
+        molecule_chanfreqs = [[spw_frequencies(msfile, line_spws[i]) for msfile in ms_list_to_concatenate] for i in range(len(molecules))]
+        if os.path.isdir(lines_mms):
+            print('Replacing '+lines_mms+' (all its EBs have been re-made)')
+            os.system('rm -rf ' + lines_mms)
+        print('Virtually concatenating these measurement sets:', ms_list_to_concatenate)
+        virtualconcat(vis          = ms_list_to_concatenate,
+                      concatvis    = lines_mms,
+                      dirtol       = '0.1arcsec',
+                      copypointing = False,
+                      keepcopy     = False) # the EB ms's now live in lines_mms/SUBMSS/
+        listobs(vis=lines_mms, listfile=lines_mms+'.listobs.txt')
+    elif all(os.path.isdir(submss) for submss in submss_list):
+        print('Reusing '+lines_mms+' (the EBs were moved into it by an earlier run)')
+        molecule_chanfreqs = [[spw_frequencies(submss, line_spws[i]) for submss in submss_list] for i in range(len(molecules))]
+    else:
+        raise ValueError('Cannot find all of '+', '.join(ms_list_to_concatenate)+', nor all of them in '+lines_mms+'/SUBMSS/')
+
+    for i,molecule in enumerate(molecules):
+        spw = ','.join([str(s) for s in concat_spw_ids(lines_mms, molecule_chanfreqs[i])])
+        print('For molecule: ', molecule)
+        print('Splitting spectral windows '+spw+' out of '+lines_mms)
+
+        final_line_ms = 'ABAur_'+molecule+'.bin30s.ms'+suffix
+
+        os.system('rm -rf %s*' % final_line_ms)
+        split(vis=lines_mms, outputvis=final_line_ms, spw=spw, datacolumn='data', keepmms=False)
+        listobs(vis=final_line_ms, listfile=final_line_ms+'.listobs.txt')
+        backup_ms(final_line_ms, backupdir='backups/') # restore with ms_backup.restore_ms, see ms_backup.py
 
 
 
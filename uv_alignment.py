@@ -0,0 +1,115 @@
+"""
+Fast estimate of the relative offset between two execution blocks, from the
+phase gradient of their visibility ratio, as an alternative to alignment.find_offset
+(which grids the full uv plane for every call).
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+If the emission in the offset EB is shifted by (dRA, dDec) with respect to the
+reference EB, then in every uv cell the two visibilities differ by a phase
+    phi(u,v) = arg(V_offset * conj(V_reference)) = -2 pi (u dRA + v dDec)
+whatever the structure of the source. Both EBs are averaged onto the same
+(coarse) uv cells, and that plane is fit to the phases of the overlapping cells
+by weighted linear least squares. Phase wraps are handled by fitting the short
+baselines first, then unwrapping the longer ones against that model and refitting.
+
+Reads exported visibilities (see vis_store.py / export_MS).
+"""
+import numpy as np
+from vis_store import load_vis
+
+arcsec_per_rad = 180./np.pi*3600.
+
+
+def _average_in_cells(u, v, vis, wgt, cell, nv):
+    """
+    Weighted average of visibilities in uv cells of size cell (lambda). The uv plane
+    is folded onto u >= 0 with the Hermitian conjugates, so both halves count.
+    nv is the number of cells along v (the same for all datasets, so cell keys match).
+    Returns the cell keys, the u and v of the cell centers, the averaged visibilities and their summed weights.
+    """
+    flip = u < 0
+    u = np.where(flip, -u, u)
+    v = np.where(flip, -v, v)
+    vis = np.where(flip, np.conj(vis), vis)
+
+    iu = np.floor(u/cell).astype('int64')
+    iv = np.floor(v/cell).astype('int64')
+    keys, inverse = np.unique(iu*nv + (iv + nv//2), return_inverse=True)
+    inverse = inverse.ravel()
+
+    sumw  = np.bincount(inverse, weights=wgt)
+    visw  = np.bincount(inverse, weights=wgt*vis.real) + 1j*np.bincount(inverse, weights=wgt*vis.imag)
+    cu    = (keys//nv + 0.5)*cell
+    cv    = (keys%nv - nv//2 + 0.5)*cell
+    return keys, cu, cv, visw/sumw, sumw
+
+
+def find_offset_uv(reference, offset, cell=1.e4, uvmax=None, min_snr=3., niter=4):
+    """
+    Estimates the offset of one execution block relative to a reference execution
+    block, from the phase gradient of their visibilities in overlapping uv cells.
+
+    Args:
+        reference (string): Exported visibilities (store or .vis.npz) of the reference EB
+        offset (string): Exported visibilities (store or .vis.npz) of the EB to be aligned
+        cell (float): Size of the uv cells (lambda). It should be small compared to
+            1/(source size), so that the source structure cancels in each cell.
+        uvmax (float): Longest baseline used (lambda). Default: all overlapping cells
+        min_snr (float): Cells where either averaged visibility has a lower SNR are not used
+        niter (int): Number of unwrap-and-refit iterations, each going out to longer baselines
+    Returns:
+        offset (array): [dRA, dDec] in arcsec; the emission in the offset EB lies at
+            (dRA, dDec) relative to the reference (positive dRA is to the east)
+        error (array): 1 sigma uncertainties on [dRA, dDec] in arcsec, with the weights
+            rescaled by the reduced chi^2 of the fit
+    """
+    u_r, v_r, vis_r, wgt_r = load_vis(reference)
+    u_o, v_o, vis_o, wgt_o = load_vis(offset)
+    nv = 2*(int(max(np.max(np.abs(v_r)), np.max(np.abs(v_o)))/cell) + 2)
+    keys_r, cu, cv, V_r, W_r = _average_in_cells(u_r, v_r, vis_r, wgt_r, cell, nv)
+    keys_o, _, _, V_o, W_o   = _average_in_cells(u_o, v_o, vis_o, wgt_o, cell, nv)
+
+    # the overlapping cells
+    _, i_r, i_o = np.intersect1d(keys_r, keys_o, assume_unique=True, return_indices=True)
+    cu, cv   = cu[i_r], cv[i_r]
+    V_r, W_r = V_r[i_r], W_r[i_r]
+    V_o, W_o = V_o[i_o], W_o[i_o]
+
+    # keep cells with good SNR in both EBs
+    snr_r = np.abs(V_r)*np.sqrt(W_r)
+    snr_o = np.abs(V_o)*np.sqrt(W_o)
+    good  = (snr_r > min_snr) & (snr_o > min_snr)
+    if uvmax is not None:
+        good &= (np.hypot(cu, cv) <= uvmax)
+    cu, cv, V_r, V_o = cu[good], cv[good], V_r[good], V_o[good]
+    if len(cu) < 3:
+        raise ValueError('Not enough overlapping uv cells with SNR > %.1f to fit an offset' % min_snr)
+
+    phase = np.angle(V_o*np.conj(V_r))
+    sigma2 = 1./snr_r[good]**2 + 1./snr_o[good]**2 # variance of the phase difference (rad^2)
+    w = 1./sigma2
+    A = -2.*np.pi*np.stack([cu, cv], axis=1)
+
+    # fit the short baselines first, then unwrap the rest against the current model and refit
+    uvdist = np.hypot(cu, cv)
+    limits = np.quantile(uvdist, np.linspace(0.25, 1., niter))
+    p = np.zeros(2)
+    for limit in limits:
+        use = uvdist <= limit
+        model = A[use] @ p
+        resid = np.angle(np.exp(1j*(phase[use] - model)))
+        y = model + resid
+        Aw = A[use]*w[use,None]
+        cov = np.linalg.inv(A[use].T @ Aw)
+        p = cov @ (Aw.T @ y)
+
+    resid = np.angle(np.exp(1j*(phase - A @ p)))
+    chi2_red = np.sum(w*resid**2)/max(len(phase)-2, 1)
+    error = np.sqrt(np.diag(cov)*max(chi2_red, 1.))
+
+    offset_arcsec = p*arcsec_per_rad
+    error_arcsec  = error*arcsec_per_rad
+    print("#offset from uv phase gradient: [%.3e, %.3e] +/- [%.1e, %.1e] arcsec (%d uv cells)"
+          % (offset_arcsec[0], offset_arcsec[1], error_arcsec[0], error_arcsec[1], len(phase)))
+    return offset_arcsec, error_arcsec
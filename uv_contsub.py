@@ -0,0 +1,200 @@
+"""
+Continuum subtraction in the uv plane, as uvcontsub(fitorder=..., solint='int',
+combine='') does it, but in numpy: streaming chunks of rows of the DATA column and
+subtracting the fit with one matrix multiply per chunk.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+With solint='int' and combine='', uvcontsub fits a polynomial (in channel) to the
+line-free channels of every row and polarization separately, and subtracts it from
+all the channels. The fit is linear in the data, so for a given set of line-free
+channels the continuum is
+    continuum = M @ data[line-free channels],    M = B @ pinv(A)
+where A (B) is the polynomial design matrix over the line-free (all) channels. M is
+computed once per spw, and then the subtraction costs about as much as reading and
+writing the column, instead of the ~1hr10min per LB EB of uvcontsub.
+Rows (and polarizations) with some of their line-free channels flagged are fit with
+their own M, one per flag pattern; those with too few unflagged line-free channels
+to fit are flagged altogether, as uvcontsub does.
+
+The weights don't enter the fit: they're constant across the channels of a row
+(no WEIGHT_SPECTRUM after split), so the weighted fit would be the same.
+
+The rows are read in chunks of about ms_spectra.MAX_CHUNK_ELEMENTS visibilities, and
+the subtraction is done in single precision (M in float32), as DATA is stored.
+"""
+import os
+import numpy as np
+import casatools
+from casatasks import split
+from ms_spectra import parse_flagchannels, iter_rows, chunk_rows
+
+tb = casatools.table()
+
+
+def contsub_matrix(nchan, fitchans, fitorder=1):
+    """
+    The matrix that maps the line-free channels of a spectrum to the continuum fit on all channels.
+
+    Args:
+        nchan (int): Number of channels of the spw
+        fitchans (array): Indices of the line-free channels used in the fit
+        fitorder (int): Order of the polynomial
+    Returns:
+        M (array): [nchan, len(fitchans)]
+    """
+    x = np.linspace(-1., 1., nchan) # channel, rescaled to keep the design matrix well conditioned
+    B = np.vander(x, fitorder+1)
+    return B @ np.linalg.pinv(B[fitchans])
+
+
+def _subtract_continuum(data, flag, fitchans, M, fitorder):
+    """
+    Subtracts the continuum from a chunk of rows, in place.
+
+    Args:
+        data (array): [ncorr, nchan, nrow] complex visibilities
+        flag (array): [ncorr, nchan, nrow] flags; spectra that can't be fit are flagged here
+        fitchans (array): Indices of the line-free channels
+        M (array): contsub_matrix for when none of fitchans are flagged, in float32
+        fitorder (int): Order of the polynomial
+    Returns:
+        nrefit (int): Number of (polarization, row) spectra fit with their own matrix
+    """
+    fitflags     = flag[:,fitchans,:]
+    icorr, irow  = np.nonzero(np.any(fitflags, axis=1)) # spectra with some line-free channels flagged
+    partial      = data[icorr,:,irow] # [n, nchan], a copy
+
+    data -= np.matmul(M, data[:,fitchans,:]) # [nchan, nfit] @ [ncorr, nfit, nrow]
+
+    if len(icorr)==0:
+        return 0
+    # redo those without their flagged channels, one matrix per flag pattern
+    patterns, inverse = np.unique(fitflags[icorr,:,irow], axis=0, return_inverse=True)
+    for p, pattern in enumerate(patterns):
+        select  = (inverse.ravel()==p)
+        usable  = fitchans[~pattern]
+        if len(usable) <= fitorder:
+            flag[icorr[select],:,irow[select]] = True
+            continue
+        spectra = partial[select].T # [nchan, n]
+        data[icorr[select],:,irow[select]] = (spectra - contsub_matrix(data.shape[1], usable, fitorder).astype('float32') @ spectra[usable]).T
+    return len(icorr)
+
+
+def fast_uvcontsub(vis, outputvis, spw, fitspw, fitorder=1, datacolumn='data', chunksize=None):
+    """
+    Continuum-subtracts the line spws of an MS into a new MS, like
+    uvcontsub(vis, spw=spw, fitspw=fitspw, fitorder=fitorder, solint='int', combine='')
+    (which writes vis+'.contsub'). The spws of spw are split out of vis to outputvis
+    (renumbered 0, 1, ..., as uvcontsub does), and the DATA column of outputvis is
+    then replaced by the residual, chunk by chunk.
+    CASA tasks used:
+        split
+
+    Args:
+        vis (string): Name of measurement set
+        outputvis (string): Name of the continuum-subtracted measurement set
+        spw (string): Spws to continuum-subtract, e.g. '1, 2, 3, 4'
+        fitspw (string): Line-free channels of those spws, e.g. au.invertChannelRanges(flagchannels_string, vis=vis)
+        fitorder (int): Order of the polynomial fit
+        datacolumn (string): Column of vis to continuum-subtract, as in split
+        chunksize (int): Number of rows read (and written) at a time. Default: chunks of about
+            ms_spectra.MAX_CHUNK_ELEMENTS visibilities
+    Returns:
+        outputvis (string): Name of the continuum-subtracted measurement set
+    """
+    spws     = [int(s) for s in spw.split(',')]
+    fitchans = parse_flagchannels(fitspw)
+    for s in spws:
+        if s not in fitchans:
+            raise ValueError('You need to specify the line-free channels of spw %d in fitspw' % s)
+
+    os.system('rm -rf ' + outputvis)
+    split(vis=vis, outputvis=outputvis, spw=spw, datacolumn=datacolumn, keepflags=True)
+
+    tb.open(outputvis+'/SPECTRAL_WINDOW')
+    num_chan = tb.getcol('NUM_CHAN')
+    tb.close()
+    tb.open(outputvis+'/DATA_DESCRIPTION')
+    ddid_to_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    tb.open(outputvis, nomodify=False)
+    for new_spw, old_spw in enumerate(spws):
+        nchan    = num_chan[new_spw]
+        fit      = np.concatenate([np.arange(first, last+1) for first, last in fitchans[old_spw]])
+        if fit.max() >= nchan:
+            raise ValueError('fitspw goes beyond the %d channels of spw %d' % (nchan, old_spw))
+        M        = contsub_matrix(nchan, fit, fitorder).astype('float32') # so M @ data stays complex64
+        ddids    = np.where(ddid_to_spw==new_spw)[0]
+        subtable = tb.query('DATA_DESC_ID IN [%s]' % ','.join(['%d' % i for i in ddids]))
+        nrows    = subtable.nrows()
+        nrefit   = 0
+        rows     = chunksize if chunksize is not None else chunk_rows(subtable, ['DATA'])
+        for startrow in range(0, nrows, rows):
+            nrow = min(rows, nrows-startrow)
+            data = subtable.getcol('DATA', startrow, nrow)
+            flag = subtable.getcol('FLAG', startrow, nrow)
+            nflagged = np.sum(flag)
+            nrefit  += _subtract_continuum(data, flag, fit, M, fitorder)
+            subtable.putcol('DATA', data, startrow, nrow)
+            if np.sum(flag)!=nflagged:
+                subtable.putcol('FLAG', flag, startrow, nrow)
+        subtable.close()
+        print("spw %d (now %d): continuum subtracted from %d rows; %d spectra had flagged line-free channels and were fit separately"
+              % (old_spw, new_spw, nrows, nrefit))
+    tb.close()
+    return outputvis
+
+
+def compare_visibilities(vis, refvis, chunksize=None):
+    """
+    Compares the DATA columns of two measurement sets with the same rows, e.g. the output
+    of fast_uvcontsub and of uvcontsub, over the visibilities unflagged in both.
+
+    Args:
+        vis (string): Name of measurement set
+        refvis (string): Name of the reference measurement set
+        chunksize (int): Number of rows read at a time. Default: chunks of about
+            ms_spectra.MAX_CHUNK_ELEMENTS visibilities
+    Returns:
+        stats (dictionary): 'max_abs_diff', 'rms_diff' and 'rms_ref' (Jy), and
+            'nflag_diff', the number of visibilities flagged in only one of them
+    """
+    tb.open(vis)
+    nrows = tb.nrows()
+    ddid  = tb.getcol('DATA_DESC_ID')
+    tb.close()
+    tb.open(refvis)
+    if (tb.nrows()!=nrows) or np.any(tb.getcol('DATA_DESC_ID')!=ddid):
+        tb.close()
+        raise ValueError(vis+' and '+refvis+' do not have the same rows')
+    tb.close()
+
+    reftb = casatools.table()
+    stats = {'max_abs_diff': 0., 'sum_sq_diff': 0., 'sum_sq_ref': 0., 'n': 0, 'nflag_diff': 0}
+    tb.open(vis)
+    reftb.open(refvis)
+    for d in np.unique(ddid): # the shape of DATA can change with the spw
+        subtable    = tb.query('DATA_DESC_ID==%d' % d)
+        refsubtable = reftb.query('DATA_DESC_ID==%d' % d)
+        rows        = chunksize if chunksize is not None else chunk_rows(subtable, ['DATA'])
+        for chunk, refchunk in zip(iter_rows(subtable, ['DATA', 'FLAG'], rows), iter_rows(refsubtable, ['DATA', 'FLAG'], rows)):
+            good = ~(chunk['FLAG'] | refchunk['FLAG'])
+            diff = np.abs(chunk['DATA']-refchunk['DATA'])[good]
+            stats['max_abs_diff'] = max(stats['max_abs_diff'], diff.max() if diff.size else 0.)
+            stats['sum_sq_diff'] += np.sum(diff**2)
+            stats['sum_sq_ref']  += np.sum(np.abs(refchunk['DATA'][good])**2)
+            stats['n']           += diff.size
+            stats['nflag_diff']  += np.sum(chunk['FLAG']!=refchunk['FLAG'])
+        subtable.close()
+        refsubtable.close()
+    reftb.close()
+    tb.close()
+
+    result = {'max_abs_diff': stats['max_abs_diff'], 'rms_diff': np.sqrt(stats['sum_sq_diff']/stats['n']),
+              'rms_ref': np.sqrt(stats['sum_sq_ref']/stats['n']), 'nflag_diff': stats['nflag_diff']}
+    print("%s vs. %s: max |diff| = %.3e Jy, rms diff = %.3e Jy (rms of the reference %.3e Jy), %d flags differ"
+          % (vis, refvis, result['max_abs_diff'], result['rms_diff'], result['rms_ref'], result['nflag_diff']))
+    return result
@@ -0,0 +1,282 @@
+"""
+Virtual concatenation of measurement sets: a read-only view over several
+execution blocks that looks like the output of concat, without copying any data.
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+A virtual MS is a small json manifest, e.g. ABAur_LB_concat_shifted.vms, listing
+its component measurement sets in order:
+    {"members": ["workflow/step2/ABAur_LB_EB1_initcont_selfcal_shift.ms", ...]}
+Reading a column through it reads each member in turn and renumbers the ids the
+way concat would (for EBs that don't share spectral windows, as ours):
+    OBSERVATION_ID      offset by the number of observations in the members before it
+    DATA_DESC_ID        offset by the number of data descriptions in the members before it
+    ANTENNA1, ANTENNA2  mapped onto the union of the antenna names, in order of appearance
+    FIELD_ID            mapped onto the union of the field names, in order of appearance
+So e.g. the spws of observation i are 5*i ... 5*i+4, as in our physical concats.
+
+CASA tasks can't read a virtual MS. tclean and concat take a list of MSs, so pass
+them members_of(vis); anything that calibrates (gaincal, applycal, split) needs a
+real MS, made with materialize() only where it's actually needed.
+"""
+import os
+import json
+import numpy as np
+import casatools
+
+tb = casatools.table()
+
+VMS_EXT = '.vms'
+
+
+def is_virtual(vis):
+    """ Whether vis is a virtual MS (the name of a .vms manifest). """
+    return isinstance(vis, str) and vis.endswith(VMS_EXT)
+
+
+def write_virtual_ms(members, vmsname, overwrite=True):
+    """
+    Writes a virtual MS: a manifest listing the component measurement sets.
+
+    Args:
+        members (list): Names of the component measurement sets, in order (ids are renumbered in this order)
+        vmsname (string): Name of the manifest, ending in '.vms'
+        overwrite (bool): Whether to overwrite an existing manifest
+    Returns:
+        vmsname (string): Name of the manifest
+    """
+    if not vmsname.endswith(VMS_EXT):
+        raise ValueError("Virtual MS name must end in '"+VMS_EXT+"'")
+    if os.path.exists(vmsname) and not overwrite:
+        raise ValueError(vmsname+' already exists; set overwrite=True to replace it')
+    for msfile in members:
+        if not os.path.isdir(msfile):
+            raise ValueError('Cannot find measurement set '+msfile)
+
+    with open(vmsname, 'w') as f:
+        json.dump({'members': list(members)}, f, indent=4)
+    print("Virtual MS written to %s (%d members, no data copied)" % (vmsname, len(members)))
+    return vmsname
+
+
+def members_of(vis):
+    """
+    The real measurement sets behind vis: the members of a virtual MS, the
+    elements of a list (expanding any virtual MS in it), or [vis] for a plain MS.
+    Handy to pass to tasks that take a list of MSs, e.g. tclean(vis=members_of(vis)).
+    """
+    if isinstance(vis, (list, tuple)):
+        return [msfile for v in vis for msfile in members_of(v)]
+    if is_virtual(vis):
+        with open(vis, 'r') as f:
+            return json.load(f)['members']
+    return [vis]
+
+
+def _table_nrows(msfile):
+    tb.open(msfile)
+    nrows = tb.nrows()
+    tb.close()
+    return nrows
+
+
+def _subtable_nrows(msfile, subtable):
+    tb.open(msfile+'/'+subtable)
+    nrows = tb.nrows()
+    tb.close()
+    return nrows
+
+
+def _subtable_col(msfile, subtable, column):
+    tb.open(msfile+'/'+subtable)
+    col = tb.getcol(column)
+    tb.close()
+    return col
+
+
+class VirtualMS:
+    """
+    Read-only, table-like view over the members of a virtual MS (or a list of MSs).
+    Has the bits of the casatools table interface our helpers use: nrows(),
+    getcol(column, startrow, nrow) and close(), plus getsubcol() for subtables.
+    """
+
+    def __init__(self, vis):
+        self.members = members_of(vis)
+        self.member_nrows = np.array([_table_nrows(msfile) for msfile in self.members], dtype='int64')
+        self.row_offsets  = np.r_[0, np.cumsum(self.member_nrows)]
+        nobs  = [_subtable_nrows(msfile, 'OBSERVATION') for msfile in self.members]
+        nddid = [_subtable_nrows(msfile, 'DATA_DESCRIPTION') for msfile in self.members]
+        nspw  = [_subtable_nrows(msfile, 'SPECTRAL_WINDOW') for msfile in self.members]
+        self.obs_offsets  = np.r_[0, np.cumsum(nobs)]
+        self.ddid_offsets = np.r_[0, np.cumsum(nddid)]
+        self.spw_offsets  = np.r_[0, np.cumsum(nspw)]
+
+        # antennas and fields are merged by name, as concat does
+        self.merged_rows, self.id_maps = {}, {}
+        for subtable in ['ANTENNA', 'FIELD']:
+            names, rows, maps = [], [], []
+            for i, msfile in enumerate(self.members):
+                member_names = list(_subtable_col(msfile, subtable, 'NAME'))
+                for j, name in enumerate(member_names):
+                    if name not in names:
+                        names.append(name)
+                        rows.append((i, j))
+                maps.append(np.array([names.index(name) for name in member_names], dtype='int32'))
+            self.merged_rows[subtable] = rows
+            self.id_maps[subtable] = maps
+
+    def nrows(self):
+        return int(self.row_offsets[-1])
+
+    def close(self):
+        pass
+
+    def _renumber(self, column, values, i):
+        if column=='OBSERVATION_ID':
+            return values + self.obs_offsets[i]
+        if column=='DATA_DESC_ID':
+            return values + self.ddid_offsets[i]
+        if column in ['ANTENNA1', 'ANTENNA2']:
+            return self.id_maps['ANTENNA'][i][values]
+        if column=='FIELD_ID':
+            return self.id_maps['FIELD'][i][values]
+        return values
+
+    def getcol(self, column, startrow=0, nrow=-1):
+        """ Column of the main table over rows [startrow, startrow+nrow) of the virtual MS (all rows if nrow=-1). """
+        stoprow = self.nrows() if nrow < 0 else min(startrow+nrow, self.nrows())
+        pieces = []
+        for i, msfile in enumerate(self.members):
+            lo = max(startrow, self.row_offsets[i])
+            hi = min(stoprow, self.row_offsets[i+1])
+            if hi <= lo:
+                continue
+            tb.open(msfile)
+            values = tb.getcol(column, int(lo-self.row_offsets[i]), int(hi-lo))
+            tb.close()
+            pieces.append(self._renumber(column, values, i))
+        return np.concatenate(pieces, axis=-1)
+
+    def getsubcol(self, subtable, column):
+        """
+        Column of a subtable of the virtual MS, e.g. getsubcol('SPECTRAL_WINDOW', 'CHAN_FREQ').
+        Rows of all members are stacked (ANTENNA and FIELD: merged by name). Array columns
+        must have the same shape in all members, e.g. CHAN_FREQ of continuum MSs.
+        """
+        if subtable in self.merged_rows:
+            cols = [_subtable_col(msfile, subtable, column) for msfile in self.members]
+            return np.stack([cols[i][...,j] for i, j in self.merged_rows[subtable]], axis=-1)
+        pieces = []
+        for i, msfile in enumerate(self.members):
+            values = _subtable_col(msfile, subtable, column)
+            if (subtable, column)==('DATA_DESCRIPTION', 'SPECTRAL_WINDOW_ID'):
+                values = values + self.spw_offsets[i]
+            pieces.append(values)
+        return np.concatenate(pieces, axis=-1)
+
+    def locate(self, observation=None, spw=None):
+        """
+        The member holding a (virtual) observation or spw, and its id within that member.
+
+        Args:
+            observation (int): Observation id in the virtual MS
+            spw (int): Spectral window id in the virtual MS
+        Returns:
+            msfile (string), local_id (int)
+        """
+        offsets, key = (self.obs_offsets, observation) if spw is None else (self.spw_offsets, spw)
+        i = np.searchsorted(offsets, int(key), side='right') - 1
+        if (i < 0) or (i >= len(self.members)):
+            raise ValueError('There is no %s %s in this virtual MS' % ('observation' if spw is None else 'spw', key))
+        return self.members[i], int(key) - int(offsets[i])
+
+
+def read_columns(vis, columns):
+    """
+    Reads whole columns of the main table of a measurement set or a virtual MS.
+
+    Args:
+        vis (string): Measurement set, or virtual MS (.vms)
+        columns (list): Column names, e.g. ['OBSERVATION_ID', 'DATA_DESC_ID']
+    Returns:
+        values (list): One array per column
+    """
+    if is_virtual(vis):
+        vms = VirtualMS(vis)
+        return [vms.getcol(column) for column in columns]
+    tb.open(vis)
+    values = [tb.getcol(column) for column in columns]
+    tb.close()
+    return values
+
+
+def read_subtable_column(vis, subtable, column):
+    """ Reads a column of a subtable (e.g. 'OBSERVATION', 'SPECTRAL_WINDOW') of a measurement set or a virtual MS. """
+    if is_virtual(vis):
+        return VirtualMS(vis).getsubcol(subtable, column)
+    return _subtable_col(vis, subtable, column)
+
+
+def resolve(vis, observation=None, spw=None):
+    """
+    Where a CASA task has to read a real MS: the member of a virtual MS holding an
+    observation (or spw), and the id of that observation (spw) in the member.
+    A plain MS is returned as is.
+    """
+    if not is_virtual(vis):
+        return vis, int(spw if observation is None else observation)
+    return VirtualMS(vis).locate(observation=observation, spw=spw)
+
+
+def spw_frequencies(msfile, spw):
+    """ The channel frequencies (Hz) of a spw of a measurement set (spws can differ in their number of channels). """
+    tb.open(msfile+'/SPECTRAL_WINDOW')
+    chanfreqs = tb.getcell('CHAN_FREQ', int(spw))
+    tb.close()
+    return chanfreqs
+
+
+def concat_spw_ids(concatvis, chanfreqs, tolerance=1.):
+    """
+    The spw ids that concat (or virtualconcat) gave to spws of its input measurement
+    sets, found by their channel frequencies. Spws that concat merged (same frequencies)
+    come back as one id.
+
+    Args:
+        concatvis (string): Name of the concatenated measurement set (or multi-MS)
+        chanfreqs (list): Channel frequencies of the input spws, e.g. from spw_frequencies (read before concatenating)
+        tolerance (float): Largest difference in frequency (Hz) that still counts as the same channel
+    Returns:
+        spws (list): Spw ids in concatvis, sorted
+    """
+    tb.open(concatvis+'/SPECTRAL_WINDOW')
+    concat_chanfreqs = [tb.getcell('CHAN_FREQ', i) for i in range(tb.nrows())]
+    tb.close()
+    spws = set()
+    for freqs in chanfreqs:
+        matches = [i for i, f in enumerate(concat_chanfreqs) if (len(f)==len(freqs)) and np.all(np.abs(f-freqs) <= tolerance)]
+        if len(matches)==0:
+            raise ValueError('Cannot find a spw of %d channels from %.6f GHz in %s' % (len(freqs), freqs[0]/1.e9, concatvis))
+        spws.update(matches)
+    return sorted(spws)
+
+
+def materialize(vis, concatvis, dirtol='0.1arcsec', copypointing=False):
+    """
+    Makes a real (physical) concatenation of a virtual MS, for the CASA tasks
+    that write to or calibrate the data (gaincal, applycal, split, ...).
+    CASA tasks used:
+        concat
+
+    Args:
+        vis (string): Virtual MS (.vms), or list of MSs
+        concatvis (string): Name of the concatenated measurement set
+        dirtol, copypointing: As in concat
+    Returns:
+        concatvis (string): Name of the concatenated measurement set
+    """
+    from casatasks import concat
+    os.system('rm -rf '+concatvis)
+    concat(vis=members_of(vis), concatvis=concatvis, dirtol=dirtol, copypointing=copypointing)
+    return concatvis
@@ -0,0 +1,196 @@
+"""
+Streaming export of (continuum) visibilities to a memory-mappable store
+Written for CASA 6 (works in modularcasa and in monolithic CASA) and the AB Aur program
+Author: J. Speedie
+
+A visibility store is a directory, e.g. ABAur_LB_EB1_initcont.vis/, holding one
+raw .npy file per quantity:
+    u.npy, v.npy   spatial frequencies (lambda)
+    Vis.npy        visibilities, weighted average of the polarizations (Jy)
+    Wgt.npy        summed weights of the polarizations
+np.load(..., mmap_mode='r') opens them without reading or copying anything, so
+the store opens instantly no matter how many visibilities it holds.
+
+load_vis() also reads the .vis.npz files written by older versions of export_MS.
+"""
+import os
+import numpy as np
+import casatools
+from casatasks import split
+from virtual_ms import is_virtual, members_of
+
+tb = casatools.table()
+
+STORE_KEYS  = ['u', 'v', 'Vis', 'Wgt']
+cc          = 2.9979e8 # speed of light in m/s, as used by DSHARP's export_MS
+
+
+def export_vis_store(msfile, storename=None, chunksize=500000, datacolumn='data'):
+    """
+    Spectrally averages visibilities to a single channel per SPW and exports them
+    to a visibility store (see top of file). The averaged MS is read in chunks of
+    rows with tb.getcol(startrow, nrow), flagged rows are dropped on the fly, and
+    the results are written straight into memory-mapped .npy files, so peak memory
+    stays bounded by chunksize no matter how big the MS is. The files are allocated
+    for all the rows and cut down to the unflagged ones at the end, so the MS is
+    read in a single pass.
+    CASA tasks used:
+        split (only if some SPW has more than one channel)
+
+    Args:
+        msfile (string): Name of CASA measurement set, ending in '.ms'
+        storename (string): Name of the output store. Default: msfile with '.ms' replaced by '.vis'
+        chunksize (int): Number of rows read from the MS at a time
+        datacolumn (string): Column to export, as in split
+    Returns:
+        storename (string): Name of the visibility store
+
+    A virtual MS (.vms, see virtual_ms.py) is exported member by member, and the
+    member stores are stacked into one, so no concatenated MS is ever written.
+    """
+    if is_virtual(msfile):
+        return _export_virtual_store(msfile, storename=storename, chunksize=chunksize, datacolumn=datacolumn)
+    if msfile[-3:]!='.ms':
+        raise ValueError("MS name must end in '.ms'")
+    MS_filename = msfile[:-3]
+    if storename is None:
+        storename = MS_filename+'.vis'
+
+    # get information about spectral windows
+    tb.open(msfile+'/SPECTRAL_WINDOW')
+    num_chan = tb.getcol('NUM_CHAN').tolist()
+    tb.close()
+
+    # spectral averaging (1 channel per SPW); skipped if that's already the case
+    if np.all(np.array(num_chan)==1) and (datacolumn.upper()=='DATA'):
+        spavg = msfile
+    else:
+        spavg = MS_filename+'_spavg.ms'
+        os.system('rm -rf %s' % spavg)
+        split(vis=msfile, width=num_chan, datacolumn=datacolumn, outputvis=spavg)
+
+    # get frequency information, per data description
+    tb.open(spavg+'/SPECTRAL_WINDOW')
+    freqlist = tb.getcol('CHAN_FREQ')[0]
+    tb.close()
+    tb.open(spavg+'/DATA_DESCRIPTION')
+    ddid_to_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    tb.open(spavg)
+    nrows = tb.nrows()
+    chunks = [(startrow, min(chunksize, nrows-startrow)) for startrow in range(0, nrows, chunksize)]
+
+    # allocated for every row; truncated to the unflagged ones below
+    tmpname = storename+'.tmp'
+    os.system('rm -rf '+tmpname)
+    os.makedirs(tmpname)
+    dtypes = {'u': 'float64', 'v': 'float64', 'Vis': 'complex128', 'Wgt': 'float64'}
+    out    = {key: np.lib.format.open_memmap(tmpname+'/'+key+'.npy', mode='w+', dtype=dtypes[key], shape=(nrows,)) for key in STORE_KEYS}
+
+    # one pass: drop the flagged rows, average the polarizations and compute spatial frequencies, chunk by chunk
+    i = 0
+    for startrow, nrow in chunks:
+        flag   = tb.getcol('FLAG', startrow, nrow)
+        good   = (np.any(flag, axis=(0,1))==False)
+        n      = np.sum(good)
+        if n==0:
+            continue
+        data   = tb.getcol('DATA', startrow, nrow)[:,0,good]
+        weight = tb.getcol('WEIGHT', startrow, nrow)[:,good]
+        uvw    = tb.getcol('UVW', startrow, nrow)[:,good]
+        ddid   = tb.getcol('DATA_DESC_ID', startrow, nrow)[good]
+
+        freqs  = freqlist[ddid_to_spw[ddid]] # spectral frequency corresponding to each datapoint
+        sumwgt = np.sum(weight, axis=0)
+
+        out['u'][i:i+n]   = uvw[0,:] * freqs / cc
+        out['v'][i:i+n]   = uvw[1,:] * freqs / cc
+        out['Vis'][i:i+n] = np.sum(data.real*weight, axis=0)/sumwgt + 1j*np.sum(data.imag*weight, axis=0)/sumwgt
+        out['Wgt'][i:i+n] = sumwgt
+        i += n
+    tb.close()
+    ngood = i
+
+    for key in STORE_KEYS:
+        out[key].flush()
+    del out
+    for key in STORE_KEYS:
+        _truncate_npy(tmpname+'/'+key+'.npy', ngood)
+
+    # delete intermediate measurement set, and swap in the new store
+    if spavg!=msfile:
+        os.system('rm -rf %s' % spavg)
+    os.system('rm -rf '+storename)
+    os.rename(tmpname, storename)
+    print("#Measurement set exported to %s (%d unflagged visibilities)" % (storename, ngood))
+
+    return storename
+
+
+def _truncate_npy(filename, n):
+    """ Cuts a 1D .npy file down to its first n elements, in place (rewriting its header). """
+    import io
+    array  = np.load(filename, mmap_mode='r')
+    dtype, offset = array.dtype, array.offset
+    del array
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (int(n),)})
+    if len(header.getvalue())!=offset:
+        # the header is padded to a fixed size, so this doesn't happen; but if it does, rewrite the file
+        np.save(filename+'.tmp.npy', np.load(filename, mmap_mode='r')[:n])
+        os.replace(filename+'.tmp.npy', filename)
+        return
+    with open(filename, 'r+b') as f:
+        f.write(header.getvalue())
+        f.truncate(offset + n*dtype.itemsize)
+
+
+def _export_virtual_store(vmsfile, storename=None, chunksize=500000, datacolumn='data'):
+    """ export_vis_store() for a virtual MS: one store per member, stacked into storename. """
+    if storename is None:
+        storename = vmsfile[:-4]+'.vis'
+    member_stores = [export_vis_store(msfile, chunksize=chunksize, datacolumn=datacolumn) for msfile in members_of(vmsfile)]
+    columns = [load_vis(store) for store in member_stores]
+    ntotal  = sum([len(u) for u, _, _, _ in columns])
+
+    tmpname = storename+'.tmp'
+    os.system('rm -rf '+tmpname)
+    os.makedirs(tmpname)
+    for k, key in enumerate(STORE_KEYS):
+        out = np.lib.format.open_memmap(tmpname+'/'+key+'.npy', mode='w+', dtype=columns[0][k].dtype, shape=(ntotal,))
+        i = 0
+        for member in columns:
+            out[i:i+len(member[k])] = member[k]
+            i += len(member[k])
+        out.flush()
+        del out
+
+    os.system('rm -rf '+storename)
+    os.rename(tmpname, storename)
+    print("#Virtual MS exported to %s (%d unflagged visibilities from %d members)" % (storename, ntotal, len(member_stores)))
+    return storename
+
+
+def load_vis(filename, mmap=True):
+    """
+    Opens exported visibilities, either a visibility store directory (see top of
+    file) or a .vis.npz file from an older export.
+
+    Args:
+        filename (string): Name of the store, or of the .npz file
+        mmap (bool): If True (default), arrays of a store are memory-mapped read-only
+            rather than read into memory.
+    Returns:
+        u, v, Vis, Wgt (arrays)
+    """
+    # old scripts ask for MS_filename.vis.npz; fall back on the store if that's all there is
+    if filename.endswith('.vis.npz') and not os.path.exists(filename) and os.path.isdir(filename[:-4]):
+        filename = filename[:-4]
+
+    if os.path.isdir(filename):
+        mmap_mode = 'r' if mmap else None
+        return tuple(np.load(os.path.join(filename, key+'.npy'), mmap_mode=mmap_mode) for key in STORE_KEYS)
+
+    inpf = np.load(filename)
+    return tuple(inpf[key] for key in STORE_KEYS)